@@ -0,0 +1,90 @@
+"""
+Page latency of the publication index and job detail listings on a synthetic database, keyset
+pagination against the LIMIT/OFFSET queries it replaced. Walks every page of each listing and
+reports the latency at a few depths, e.g. `python bench_pagination.py -n 1000000`.
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+
+from webapp.db import initialize_db, get_connection
+from webapp.pagination import keyset_page
+from webapp.server import INDEX_SEGMENTS, JOB_REVIEWS_SEGMENTS, ITEMS_PER_PAGE
+
+# the queries before keyset pagination, pinned to the index they used before reviews_job_rating existed
+OFFSET_QUERIES = {
+    'index id': 'SELECT p.*, r.rating FROM publications as p LEFT OUTER JOIN reviews as r INDEXED BY reviews_slot ON p.id = r.publication_id AND r.job_id = ? ORDER BY p.id ASC LIMIT ? OFFSET ?',
+    'index -human': 'SELECT p.*, r.rating FROM publications as p LEFT OUTER JOIN reviews as r INDEXED BY reviews_slot ON p.id = r.publication_id AND r.job_id = ? ORDER BY p.human_score DESC LIMIT ? OFFSET ?',
+    'index ai': 'SELECT p.*, r.rating FROM publications as p LEFT OUTER JOIN reviews as r INDEXED BY reviews_slot ON p.id = r.publication_id AND r.job_id = ? ORDER BY r.rating ASC LIMIT ? OFFSET ?',
+    'job reviews': 'SELECT p.id, p.title, p.year, p.human_score, r.rating as score, r.id as review_id FROM publications as p JOIN reviews as r ON r.publication_id = p.id WHERE job_id = ? ORDER BY r.rating DESC LIMIT ? OFFSET ?',
+}
+
+LISTINGS = {
+    'index id': (INDEX_SEGMENTS['id'], False),
+    'index -human': (INDEX_SEGMENTS['human'], True),
+    'index ai': (INDEX_SEGMENTS['ai'], False),
+    'job reviews': (JOB_REVIEWS_SEGMENTS, True),
+}
+
+DEPTHS = (0, 0.1, 0.5, 0.9)
+
+
+def generate(path: str, count: int):
+    print(f"generating {count} publications in {path}...")
+    initialize_db(path)
+    conn = get_connection(path)
+    rng = random.Random(0)
+    conn.execute('BEGIN')
+    conn.executemany(
+        'INSERT INTO publications(id, ext_id, title, doi, abstract, year, human_score) VALUES (?,?,?,?,?,?,?)',
+        ((i, i, f'Publication {i}', '', 'abstract', 2000 + i % 25, rng.choice((None,) * 8 + (0, 100))) for i in range(count))
+    )
+    conn.execute("INSERT INTO jobs (id, name, model, prompt, repeats, status, time_created, time_started, time_taken, eval_run, num_completed) VALUES ('bench', 'bench', 'bench', '', 1, 'FINISHED', 0, 0, 0, 0, 0)")
+    # every tenth publication stays without review
+    conn.executemany(
+        "INSERT INTO reviews(job_id, publication_id, attempt, rating, reason, created) VALUES ('bench', ?, 0, ?, '', 0)",
+        ((i, rng.randint(0, 100)) for i in range(count) if i % 10)
+    )
+    conn.execute('COMMIT')
+    conn.close()
+
+
+def walk(conn, segments, descending: bool) -> list[float]:
+    """
+    Seconds per page for all pages of a listing, following the next links.
+    """
+    times = []
+    args = {}
+    while args is not None:
+        t0 = time.perf_counter()
+        page = keyset_page(conn, '*', segments, {'job_id': 'bench'}, args, ITEMS_PER_PAGE, descending)
+        times.append(time.perf_counter() - t0)
+        args = page.next_args
+    return times
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('-n', '--publications', help='number of synthetic publications', default=1_000_000, type=int)
+    args.add_argument('--db', help='database file, generated if missing', default='bench_pagination.db')
+    args.add_argument('--skip-offset', help='only measure keyset pagination', action='store_true')
+    ns = args.parse_args()
+
+    if not os.path.exists(ns.db):
+        generate(ns.db, ns.publications)
+    conn = get_connection(ns.db)
+
+    for name, (segments, descending) in LISTINGS.items():
+        times = walk(conn, segments, descending)
+        pages = len(times)
+        print(f"{name}: {pages} pages, keyset median {statistics.median(times) * 1000:.1f} ms, max {max(times) * 1000:.1f} ms")
+        for depth in DEPTHS:
+            page = int(depth * (pages - 1))
+            line = f"  page {page:>5}: keyset {times[page] * 1000:7.1f} ms"
+            if not ns.skip_offset:
+                t0 = time.perf_counter()
+                conn.execute(OFFSET_QUERIES[name], ('bench', ITEMS_PER_PAGE, ITEMS_PER_PAGE * page)).fetchall()
+                line += f", offset {(time.perf_counter() - t0) * 1000:8.1f} ms"
+            print(line)
@@ -0,0 +1,47 @@
+"""
+Measures the cold start of the web server: the time to import webapp.server and the time
+until the first request is answered, each in a fresh interpreter. Run from the directory
+with webapp.db, e.g. `python bench_startup.py -n 10 --path /jobs`.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# libraries that should only be loaded by the routes (or workers) that need them
+HEAVY_MODULES = ('openai', 'ollama', 'pydantic', 'httpx', 'rispy', 'numpy', 'matplotlib')
+
+PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+from webapp.server import app
+t1 = time.perf_counter()
+status = app.test_client().get({path!r}).status_code
+t2 = time.perf_counter()
+print(json.dumps({{'import': t1 - t0, 'first_response': t2 - t0, 'status': status,
+                  'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def run_probe(path: str) -> dict:
+    out = subprocess.run(
+        [sys.executable, '-c', PROBE.format(path=path, heavy=HEAVY_MODULES)],
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('-n', '--runs', help='number of fresh interpreters to start', default=5, type=int)
+    args.add_argument('--path', help='route requested as the first response', default='/jobs')
+    ns = args.parse_args()
+
+    runs = [run_probe(ns.path) for _ in range(ns.runs)]
+
+    for key in ('import', 'first_response'):
+        times = [r[key] * 1000 for r in runs]
+        print(f"{key:>15}: median {statistics.median(times):7.1f} ms, min {min(times):7.1f} ms, max {max(times):7.1f} ms")
+    print(f"{'status':>15}: {', '.join(sorted({str(r['status']) for r in runs}))}")
+    print(f"{'heavy modules':>15}: {', '.join(runs[-1]['heavy']) or 'none'}")
@@ -2,12 +2,14 @@ import ollama
 import argparse
 import rispy
 import json
-import re
 import time
 import sys
 import math
+from collections import Counter
 from enum import Flag, auto
 
+from webapp.extract import StreamedGeneration, is_result, parse_result, PARSE_STAGES
+
 COLOR_SUPPORT = hasattr(sys.stdout, "isatty") and sys.stdout.isatty()
 
 class FMT(Flag):
@@ -88,28 +90,34 @@ Criteria for exclusion:
 Please provide a written summary, followed by a JSON response containing a rating of relevancy for the work as well as a description. The JSON schema should be `{{"score": Number, "reason": String}}`, where score is between 0 and 100.
 """
 
-JSON_REGEX = re.compile(r'```(json)?\n(\{.*\})\n```', flags=re.DOTALL)
-
-
 def classify_work(chat: ollama.Client,model: str, work: dict, stream_stdout: bool = False) -> dict | None:
+    # generation is stopped as soon as the JSON result is complete
+    gen = StreamedGeneration(model)
     res = chat.generate(
         model=model, 
         prompt=PROMPT.format(title=work['title'], abstract=work['abstract']),
-        stream=stream_stdout
+        stream=True
     )
     if stream_stdout:
         print(f"============= {work['title']}")
-        chunks = []
+    try:
         for chunk in res:
-            print(chunk['response'], end='', flush=True)
-            chunks.append(chunk['response'])
+            if stream_stdout:
+                print(chunk['response'], end='', flush=True)
+            if gen.add(chunk):
+                break
+    finally:
+        res.close()
+    if stream_stdout:
         print()
-        text = "".join(chunks)
-    else:
-        text = res['response']
+    stats = gen.finish()
+    text = gen.text
     
-    # read JSON from response
-    data = extract_json(text)
+    # read JSON from response, the local parsers come first and the rescue call is the last resort
+    if gen.result is not None:
+        data, stage = gen.result, 'stream'
+    else:
+        data, stage = parse_result(text)
     if data is None:
         print(f"\n{ERR}JSON error{FMT.RESET}", file=sys.stderr, flush=True)
         # try to rescure the JSON from the response body
@@ -117,30 +125,35 @@ def classify_work(chat: ollama.Client,model: str, work: dict, stream_stdout: boo
             model=model,
             prompt=f'Please extract the JSON from the following response body, make sure it\'s properly enclosed in three backticks and a json tag, following the schema `{{"score": Number, "reason": String}}`. Leave an empty response if no JSON can be found or fields are missing.\n\n---\n{text}'
         )['response']
-        data = extract_json(new_text)
+        data, _ = parse_result(new_text)
+        stage = 'rescue' if data is not None else 'failed'
         # fail if second extraction did not work
         if data is None:
             return None
     
-    if 'score' not in data or 'reason' not in data:
+    if not is_result(data):
         return None
     
+    data['parse_stage'] = stage
     data['full_text'] = text
+    data['cancelled'] = stats['cancelled']
+    data['tokens_saved'] = stats['tokens_saved']
     return data
 
 
 
-def extract_json(text: str) -> dict | None:
-    if (match := JSON_REGEX.search(text)) is None:
-        return None
-    try:
-        res = json.loads(match.group(2))
-        if not isinstance(res, dict):
-            return None
-        return res
-    except json.JSONDecodeError:
-        return None
-
+def needs_escalation(results: list[dict | None], band: tuple[int, int]) -> bool:
+    """
+    An entry is uncertain if an attempt failed, a score lies inside the uncertainty band,
+    or the attempts ended up on different sides of it.
+    """
+    if any(res is None for res in results):
+        return True
+    low, high = band
+    scores = [res['score'] for res in results]
+    if any(low <= score <= high for score in scores):
+        return True
+    return any(score < low for score in scores) and any(score > high for score in scores)
 
 
 def print_progress(current, total, start_time):
@@ -163,11 +176,26 @@ if __name__ == '__main__':
     args.add_argument('-c', '--count', help="number of works to classify (-1 means all)", default=-1, type=int)
     args.add_argument('-k', '--classification-attempts', help="Number of times to re-classify the same work", default=1, type=int)
     args.add_argument('-m', '--model', help='The model to use', choices=MODELS)
+    args.add_argument('--cascade', help='comma separated models from cheap to expensive, uncertain entries are escalated to the next model (replaces -m)')
+    args.add_argument('--band', help='scores in this range (inclusive) count as uncertain in cascade mode', default='25,75')
     args.add_argument('--stream', help='stream the model output as it generates', default=False, action='store_true')
     args.add_argument('--ollama-host', help='set ollama host', default='http://10.100.0.2:11434')
 
     ns = args.parse_args()
 
+    if ns.cascade:
+        models = ns.cascade.split(',')
+        for m in models:
+            if m not in MODELS:
+                args.error(f'unknown model in cascade: {m}')
+        model_name = ns.cascade
+    elif ns.model:
+        models = [ns.model]
+        model_name = ns.model
+    else:
+        args.error('either -m or --cascade is required')
+    band = tuple(int(x) for x in ns.band.split(','))
+
     print("Loading bibliography...")
     filepath = ns.input
     with open(filepath, 'r') as bibliography_file:
@@ -204,22 +232,50 @@ if __name__ == '__main__':
 
     runs = len(entries[start:end]) * ns.classification_attempts
     start_time = time.time()
+    tokens_saved = 0
+    stages = Counter()
+    decided = Counter()
 
     # classify data:
     for i, entry in enumerate(entries[start:end]):
         if 'abstract' not in entry or 'title' not in entry:
             print(f"\n{ERR}unable to classify {i+start}: missing abstract or title{FMT.RESET}", file=sys.stderr)
             continue
-        for attempt in range(ns.classification_attempts):
-            res = classify_work(client, ns.model, entry, ns.stream)
+        # run the cheapest model first, escalate while the verdict is uncertain
+        escalations = []
+        for stage, model in enumerate(models):
+            results = [classify_work(client, model, entry, ns.stream) for _ in range(ns.classification_attempts)]
+            for res in results:
+                if res is None:
+                    stages['failed'] += 1
+                else:
+                    tokens_saved += res['tokens_saved']
+                    stages[res['parse_stage']] += 1
+            if stage == len(models) - 1 or not needs_escalation(results, band):
+                break
+            escalations.append({'model': model, 'scores': [res and res['score'] for res in results]})
+        decided[model] += 1
+
+        for attempt, res in enumerate(results):
             if res is None:
                 print(f"\n{ERR}unable to classify {i+start}: {entry['title']}{FMT.RESET}", file=sys.stderr)
                 continue
             res['id'] = i+start
-            res['model'] = ns.model
+            res['model'] = model_name
             res['attempt'] = attempt
+            if ns.cascade:
+                res['stage'] = stage
+                res['decided_by'] = model
+                res['escalations'] = escalations
             print(json.dumps(res), file=f, flush=attempt==ns.classification_attempts-1)
             print_progress(i*ns.classification_attempts + attempt, runs, start_time)
 
+    print(f"\nEstimated decode tokens saved by early stopping: {tokens_saved}", file=sys.stderr)
+    if ns.cascade:
+        print("Entries decided by:", ", ".join(f"{m} {decided[m]}" for m in models), file=sys.stderr)
+    total = sum(stages.values())
+    if total:
+        print("Result parsed by:", ", ".join(f"{stage} {stages[stage] / total:.1%}" for stage in PARSE_STAGES if stages[stage]), file=sys.stderr)
+
     if ns.output != '-':
         f.close()
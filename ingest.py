@@ -79,13 +79,14 @@ if __name__ == '__main__':
 
             for line in progress(f, count=lines, color=FMT.GREEN, file=ctx.ostream_for(0), message=file):
                 data = json.loads(line)
-                db.execute('INSERT INTO reviews (publication_id, job_id, created, rating, reason, raw_data) VALUES (?,?,?,?,?,?)', (
+                db.execute('INSERT INTO reviews (publication_id, job_id, created, rating, reason, raw_data, attempt) VALUES (?,?,?,?,?,?,?)', (
                     data['id'],
                     job,
                     time.time(),
                     data['score'],
                     data['reason'],
                     line,
+                    data.get('attempt', 0),
                 ))
         db.commit()
 
@@ -1,87 +1,25 @@
-from concurrent.futures import Future
+import asyncio
 from dataclasses import dataclass
-from functools import cache
 import os
-import re
 import json
 import sqlite3
 import time
 import ollama
 
-from webapp.db import get_connection
+from webapp.extract import StreamedGeneration, is_result, parse_result, parse_batch_result
+from webapp import metrics
 
-JSON_REGEX = re.compile(r'```(json)?\n(\{.*\})\n```', flags=re.DOTALL)
 
+BATCH_INSTRUCTIONS = """
 
-def classify_work(chat: ollama.Client, prompt: str, model: str, work: dict) -> dict | None:
-    res = chat.generate(
-        model=model, 
-        prompt=prompt.format(title=work['title'], abstract=work['abstract']),
-        stream=False
-    )
-    text = res['response']
-    
-    # read JSON from response
-    data = extract_json(text)
-    if data is None:
-        # try to rescure the JSON from the response body
-        new_text = chat.generate(
-            model=model,
-            prompt=f'Please extract the JSON from the following response body, make sure it\'s properly enclosed in three backticks and a json tag, following the schema `{{"score": Number, "reason": String}}`. Leave an empty response if no JSON can be found or fields are missing.\n\n---\n{text}'
-        )['response']
-        data = extract_json(new_text)
-        # fail if second extraction did not work
-        if data is None:
-            return None
-        data['re_extract'] = True
-    
-    if 'score' not in data or 'reason' not in data:
-        return None
+This request contains {count} publications, each starting with a "### Publication <id>" heading. Assess each of them separately. Instead of a single JSON object, respond with a JSON array containing one object per publication, following the schema `[{{"id": Number, "score": Number, "reason": String}}]`, where id is the number from the publication's heading.
+"""
 
-    data['re_extract'] = data.get('re_extract', False )
-    
-    data['full_text'] = text
-    return data
 
-
-
-def extract_json(text: str) -> dict | None:
-    if (match := JSON_REGEX.search(text)) is None:
-        return None
-    try:
-        res = json.loads(match.group(2))
-        if not isinstance(res, dict):
-            return None
-        if 'score' not in res or 'reason' not in res:
-            return None
-        if not isinstance(res['score'], int) or not isinstance(res['reason'], str):
-            return None
-        return res
-    except json.JSONDecodeError:
-        return None
-
-
-def process_item(client: ollama.Client, job_id: str, name: str, model: str, prompt: str, pub: sqlite3.Row):
-    res = classify_work(client, prompt, model, pub)
-
-    # skip broken model output
-    if res is None:
-        return False
-
-    res['id'] = pub['id']
-    res['model'] = model
-
-    conn = get_connection()
-    conn.execute('INSERT INTO reviews (publication_id, job_id, created, rating, reason, raw_data) VALUES (?,?,?,?,?,?)', (
-        pub['id'],
-        job_id,
-        time.time(),
-        res['score'],
-        res['reason'],
-        json.dumps(res),
-    ))
-    conn.commit()
-    return True
+class ExtractionError(Exception):
+    """
+    Raised when no valid JSON result could be extracted from the model output.
+    """
 
 
 @dataclass
@@ -91,50 +29,176 @@ class WorkItem:
     prompt: str
     work: dict
 
-async def process_item_async(w: WorkItem):
+
+async def classify_item_async(w: WorkItem) -> dict:
+    """
+    Classify a single work item. Raises ExtractionError if the model output could not
+    be parsed, transport errors are passed through to the caller.
+    """
     client = ollama.AsyncClient(host=os.environ['OLLAMA_HOST'])
 
-    text = (await client.generate(
+    # stream the response and stop generating once the result is complete, models
+    # tend to keep explaining themselves after the JSON block
+    prompt = w.prompt.format(title=w.work['title'], abstract=w.work['abstract'])
+    gen = StreamedGeneration(w.model, prompt=prompt)
+    t0 = time.perf_counter()
+    stream = await client.generate(
         model=w.model, 
-        prompt=w.prompt.format(title=w.work['title'], abstract=w.work['abstract']),
-        stream=False
-    ))['response']
+        prompt=prompt,
+        stream=True
+    )
+    try:
+        async for chunk in stream:
+            if gen.add(chunk):
+                break
+    finally:
+        await stream.aclose()
+    metrics.observe('ollama_request_seconds', time.perf_counter() - t0, model=w.model)
+    stats = gen.finish()
+    record_generation_stats(w.model, stats)
+    if stats['cancelled']:
+        metrics.inc('ollama_requests_cancelled_total', model=w.model)
+        metrics.inc('ollama_decode_tokens_saved_total', stats['tokens_saved'], model=w.model)
+    text = gen.text
     
-    # read JSON from response
-    data = extract_json(text)
+    # read JSON from response, the local parsers come first and the rescue call is the last resort
+    if gen.result is not None:
+        data, stage = gen.result, 'stream'
+    else:
+        data, stage = parse_result(text)
     if data is None:
         # try to rescure the JSON from the response body
         new_text = (await client.generate(
             model=w.model,
             prompt=f'Please extract the JSON from the following response body, make sure it\'s properly enclosed in three backticks and a json tag, following the schema `{{"score": Number, "reason": String}}`. Leave an empty response if no JSON can be found or fields are missing.\n\n---\n{text}'
         ))['response']
-        data = extract_json(new_text)
-        # fail if second extraction did not work
-        if data is None:
-            return False
-        data['re_extract'] = True
+        data, _ = parse_result(new_text)
+        stage = 'rescue' if data is not None else 'failed'
+        metrics.inc('items_re_extracted_total', model=w.model, success=data is not None)
+    metrics.inc('result_parse_total', model=w.model, stage=stage)
+    # fail if second extraction did not work
+    if data is None:
+        raise ExtractionError("no JSON found in response or rescue response")
     
-    if 'score' not in data or 'reason' not in data:
-        return False
+    if not is_result(data):
+        raise ExtractionError("JSON response needs a score from 0 to 100 and a reason")
 
-    data['re_extract'] = data.get('re_extract', False )
+    data['re_extract'] = stage == 'rescue'
+    data['parse_stage'] = stage
     
     data['full_text'] = text
+    data['cancelled'] = stats['cancelled']
+    data['tokens_saved'] = stats['tokens_saved']
+    data['usage'] = ollama_usage(stats)
     
     data['id'] = w.work['id']
     data['model'] = w.model
+    return data
+
+
+async def classify_batch_async(ws: list[WorkItem]) -> list[dict | Exception]:
+    """
+    Classify several work items of the same job with a single request. If the answer does not
+    contain exactly one result for every item, the items are classified one by one instead.
 
-    conn = get_connection()
-    conn.execute('INSERT INTO reviews (publication_id, job_id, created, rating, reason, raw_data) VALUES (?,?,?,?,?,?)', (
-        w.work['id'],
-        w.job_id,
-        time.time(),
-        data['score'],
-        data['reason'],
-        json.dumps(data),
-    ))
-    conn.commit()
-    return True
+    Returns a result or an exception per item.
+    """
+    w = ws[0]
+    client = ollama.AsyncClient(host=os.environ['OLLAMA_HOST'])
+
+    t0 = time.perf_counter()
+    res = await client.generate(
+        model=w.model,
+        prompt=batch_prompt(w.prompt, [x.work for x in ws]),
+        stream=False
+    )
+    metrics.observe('ollama_request_seconds', time.perf_counter() - t0, model=w.model)
+    record_generation_stats(w.model, res)
+    text = res['response']
+
+    ids = [x.work['id'] for x in ws]
+    results = parse_batch_result(text, ids)
+    if results is None:
+        metrics.inc('batch_fallbacks_total', model=w.model)
+        return await asyncio.gather(*(classify_item_async(x) for x in ws), return_exceptions=True)
+
+    metrics.inc('result_parse_total', len(ws), model=w.model, stage='batch')
+    out = []
+    for x in ws:
+        data = results[x.work['id']]
+        data['re_extract'] = False
+        data['parse_stage'] = 'batch'
+        data['batch'] = ids
+        data['full_text'] = text
+        data['model'] = w.model
+        # the request is shared by all items of the batch
+        data['usage'] = ollama_usage(res, len(ws))
+        out.append(data)
+    return out
+
+
+def batch_prompt(prompt: str, works: list[dict]) -> str:
+    """
+    Fill a single-publication prompt with several publications at once, the criteria are only sent once.
+    """
+    entries = '\n\n'.join(
+        f"### Publication {w['id']}\n\n**Title:**\n{w['title']}\n\n**Abstract:**\n{w['abstract']}"
+        for w in works
+    )
+    return prompt.format(title=f'(the {len(works)} publications listed below)', abstract='\n' + entries) + BATCH_INSTRUCTIONS.format(count=len(works))
+
+
+def store_review(conn: sqlite3.Connection, job_id: str, pub_id: int, attempt: int, data: dict) -> bool:
+    """
+    Insert a classification result as review. Returns False if the slot already had a review.
+    The token usage of the result goes into the ledger columns of the review.
+    """
+    usage = data.get('usage') or {}
+    with metrics.timed('sqlite_write_seconds', op='review'):
+        cur = conn.execute('INSERT OR IGNORE INTO reviews (publication_id, job_id, created, rating, reason, raw_data, attempt, input_tokens, output_tokens, duration, prefiltered) VALUES (?,?,?,?,?,?,?,?,?,?,?)', (
+            pub_id,
+            job_id,
+            time.time(),
+            data['score'],
+            data['reason'],
+            json.dumps({k: v for k, v in data.items() if k != 'usage'}),
+            attempt,
+            usage.get('input_tokens'),
+            usage.get('output_tokens'),
+            usage.get('duration'),
+            'prefilter' in data,
+        ))
+    return cur.rowcount > 0
+
+
+def ollama_usage(res, share: int = 1) -> dict:
+    """
+    Token counts and model time (prefill plus decode, in seconds) of an ollama generation,
+    split evenly over `share` items. Missing values stay None.
+    """
+    def split(count):
+        return None if count is None else round(count / share)
+    durations = [res.get(k) for k in ('prompt_eval_duration', 'eval_duration') if res.get(k) is not None]
+    return {
+        'input_tokens': split(res.get('prompt_eval_count')),
+        'output_tokens': split(res.get('eval_count')),
+        'duration': sum(durations) / 1e9 / share if durations else None,
+    }
+
+
+def record_generation_stats(model: str, res):
+    """
+    Record token counts and prefill/decode speed reported by ollama (durations are in ns).
+    The counts of a cancelled generation are estimates, they don't go into the speed histograms.
+    """
+    for phase, count_key, duration_key in (('prefill', 'prompt_eval_count', 'prompt_eval_duration'), ('decode', 'eval_count', 'eval_duration')):
+        count, duration = res.get(count_key), res.get(duration_key)
+        if not count:
+            continue
+        metrics.inc(f'ollama_{phase}_tokens_total', count, model=model)
+        if not duration or res.get('cancelled'):
+            continue
+        metrics.observe(f'ollama_{phase}_tokens_per_second', count / (duration / 1e9), metrics.RATE_BUCKETS, model=model)
 
 
 def get_ollama() -> ollama.Client:
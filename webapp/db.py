@@ -1,13 +1,15 @@
 import os
 import sqlite3
 import sys
-from typing import TextIO
-import rispy
+import time
+from typing import Callable, TextIO
 import json
 import csv
 from aalib.progress import progress
 from aalib.colors import FMT
 
+from webapp.scheduler import PRIORITIES, DEFAULT_PRIORITY
+
 SCHEMA = """
 CREATE TABLE publications (
     id INTEGER PRIMARY KEY,
@@ -19,7 +21,8 @@ CREATE TABLE publications (
     year INTEGER,
     raw_data TEXT,
     human_score INT,
-    human_reason TEXT
+    human_reason TEXT,
+    ris TEXT
 );
 
 CREATE TABLE jobs (
@@ -34,7 +37,16 @@ CREATE TABLE jobs (
     time_taken REAL NOT NULL,
     eval_run BOOLEAN NOT NULL,
     total_price REAL,
-    num_completed INTEGER NOT NULL
+    num_completed INTEGER NOT NULL,
+    priority TEXT NOT NULL DEFAULT 'human',
+    time_resumed REAL NOT NULL DEFAULT 0,
+    tokens_saved INTEGER NOT NULL DEFAULT 0,
+    batch_size INTEGER NOT NULL DEFAULT 1,
+    -- when the open slots were written into job_queue, NULL if they need to be (again),
+    -- negative while they are being written
+    queued REAL,
+    -- last sign of life of the worker running an OpenAI job, see oai.STALE_AFTER
+    heartbeat REAL
 );
 
 CREATE TABLE exports (
@@ -53,6 +65,16 @@ CREATE TABLE reviews (
     rating REAL NOT NULL,
     reason TEXT,
     raw_data TEXT,
+    attempt INTEGER,
+    origin TEXT,
+    input_tokens INTEGER,
+    cached_tokens INTEGER,
+    output_tokens INTEGER,
+    reasoning_tokens INTEGER,
+    duration REAL,
+    cost REAL,
+    -- rated by the job's prefilter instead of the model, left out of the job's stats
+    prefiltered BOOLEAN NOT NULL DEFAULT false,
     FOREIGN KEY (publication_id) REFERENCES publications(id) ON DELETE CASCADE,
     FOREIGN KEY (job_id) REFERENCES runs(id) ON DELETE CASCADE
 );
@@ -62,6 +84,165 @@ CREATE INDEX reviews_job ON reviews(job_id);
 CREATE INDEX reviews_pub ON reviews(publication_id);
 """
 
+# slots written into job_queue per write transaction
+QUEUE_CHUNK = 10_000
+# seconds after which a queue that is still being filled is taken over by another worker
+QUEUE_FILL_TIMEOUT = 600
+
+# idempotent schema additions, applied on top of SCHEMA for new and existing databases
+UPGRADES = """
+CREATE UNIQUE INDEX IF NOT EXISTS reviews_slot ON reviews(job_id, publication_id, attempt);
+-- where a review came from, e.g. the custom_id of an OpenAI batch request
+CREATE UNIQUE INDEX IF NOT EXISTS reviews_origin ON reviews(origin);
+
+CREATE TABLE IF NOT EXISTS retries (
+    job_id TEXT NOT NULL,
+    publication_id INTEGER NOT NULL,
+    attempt INTEGER NOT NULL,
+    tries INTEGER NOT NULL,
+    error TEXT NOT NULL,
+    message TEXT,
+    next_try REAL NOT NULL,
+    dead BOOLEAN NOT NULL DEFAULT false,
+    -- failed in a way retrying does not fix
+    permanent BOOLEAN NOT NULL DEFAULT false,
+    PRIMARY KEY (job_id, publication_id, attempt),
+    FOREIGN KEY (publication_id) REFERENCES publications(id) ON DELETE CASCADE,
+    FOREIGN KEY (job_id) REFERENCES jobs(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS retries_due ON retries(job_id, dead, next_try);
+
+CREATE TABLE IF NOT EXISTS leases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    publication_id INTEGER NOT NULL,
+    attempt INTEGER NOT NULL,
+    worker TEXT NOT NULL,
+    expires REAL NOT NULL,
+    UNIQUE (job_id, publication_id, attempt),
+    FOREIGN KEY (publication_id) REFERENCES publications(id) ON DELETE CASCADE,
+    FOREIGN KEY (job_id) REFERENCES jobs(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS leases_worker ON leases(worker);
+CREATE INDEX IF NOT EXISTS leases_expires ON leases(expires);
+
+CREATE TABLE IF NOT EXISTS metrics (
+    source TEXT NOT NULL,
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (source, name, labels)
+);
+
+CREATE TABLE IF NOT EXISTS openai_batches (
+    id TEXT PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    input_file_id TEXT NOT NULL,
+    requests INTEGER NOT NULL,
+    -- estimated input tokens, counted against the enqueued token limit
+    tokens INTEGER,
+    status TEXT NOT NULL,
+    imported BOOLEAN NOT NULL DEFAULT false,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    FOREIGN KEY (job_id) REFERENCES jobs(id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS openai_batches_job ON openai_batches(job_id, imported);
+
+CREATE TABLE IF NOT EXISTS prefilters (
+    job_id TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    recall_floor REAL NOT NULL,
+    sensitivity REAL NOT NULL,
+    filtered REAL NOT NULL,
+    created REAL NOT NULL,
+    FOREIGN KEY (job_id) REFERENCES jobs(id) ON DELETE CASCADE
+);
+
+-- seek indexes for the paginated publication and review listings (see pagination.py)
+CREATE INDEX IF NOT EXISTS reviews_job_rating ON reviews(job_id, rating, publication_id, attempt);
+CREATE INDEX IF NOT EXISTS publications_human ON publications(human_score, id);
+
+-- number of reviews per job, rating and human score of the publication, kept up to date by
+-- the triggers below so the stats don't need to go through all reviews (see stats.py). Reviews
+-- of the prefilter are not counted, it was trained on the human labels the stats compare against
+CREATE TABLE IF NOT EXISTS rating_histogram (
+    job_id TEXT NOT NULL,
+    rating REAL NOT NULL,
+    human_score INTEGER,
+    count INTEGER NOT NULL
+);
+
+-- human_score is NULL for unlabelled publications, which a plain unique index would not match
+CREATE UNIQUE INDEX IF NOT EXISTS rating_histogram_cell ON rating_histogram(job_id, rating, human_score IS NULL, IFNULL(human_score, 0));
+
+CREATE TRIGGER IF NOT EXISTS rating_histogram_review_insert AFTER INSERT ON reviews WHEN NOT NEW.prefiltered BEGIN
+    INSERT INTO rating_histogram (job_id, rating, human_score, count)
+    SELECT NEW.job_id, NEW.rating, p.human_score, 1 FROM publications AS p WHERE p.id = NEW.publication_id
+    ON CONFLICT (job_id, rating, human_score IS NULL, IFNULL(human_score, 0)) DO UPDATE SET count = count + excluded.count;
+END;
+
+CREATE TRIGGER IF NOT EXISTS rating_histogram_review_delete AFTER DELETE ON reviews WHEN NOT OLD.prefiltered BEGIN
+    INSERT INTO rating_histogram (job_id, rating, human_score, count)
+    SELECT OLD.job_id, OLD.rating, p.human_score, -1 FROM publications AS p WHERE p.id = OLD.publication_id
+    ON CONFLICT (job_id, rating, human_score IS NULL, IFNULL(human_score, 0)) DO UPDATE SET count = count + excluded.count;
+END;
+
+CREATE TRIGGER IF NOT EXISTS rating_histogram_review_update AFTER UPDATE OF job_id, publication_id, rating ON reviews WHEN NOT NEW.prefiltered BEGIN
+    INSERT INTO rating_histogram (job_id, rating, human_score, count)
+    SELECT OLD.job_id, OLD.rating, p.human_score, -1 FROM publications AS p WHERE p.id = OLD.publication_id
+    ON CONFLICT (job_id, rating, human_score IS NULL, IFNULL(human_score, 0)) DO UPDATE SET count = count + excluded.count;
+    INSERT INTO rating_histogram (job_id, rating, human_score, count)
+    SELECT NEW.job_id, NEW.rating, p.human_score, 1 FROM publications AS p WHERE p.id = NEW.publication_id
+    ON CONFLICT (job_id, rating, human_score IS NULL, IFNULL(human_score, 0)) DO UPDATE SET count = count + excluded.count;
+END;
+
+-- relabelling a publication moves all of its reviews to the cells of the new human score
+CREATE TRIGGER IF NOT EXISTS rating_histogram_label_update AFTER UPDATE OF human_score ON publications
+WHEN OLD.human_score IS NOT NEW.human_score BEGIN
+    INSERT INTO rating_histogram (job_id, rating, human_score, count)
+    SELECT job_id, rating, OLD.human_score, -COUNT(*) FROM reviews WHERE publication_id = OLD.id AND NOT prefiltered GROUP BY job_id, rating
+    ON CONFLICT (job_id, rating, human_score IS NULL, IFNULL(human_score, 0)) DO UPDATE SET count = count + excluded.count;
+    INSERT INTO rating_histogram (job_id, rating, human_score, count)
+    SELECT job_id, rating, NEW.human_score, COUNT(*) FROM reviews WHERE publication_id = NEW.id AND NOT prefiltered GROUP BY job_id, rating
+    ON CONFLICT (job_id, rating, human_score IS NULL, IFNULL(human_score, 0)) DO UPDATE SET count = count + excluded.count;
+END;
+
+CREATE TRIGGER IF NOT EXISTS rating_histogram_publication_delete AFTER DELETE ON publications BEGIN
+    INSERT INTO rating_histogram (job_id, rating, human_score, count)
+    SELECT job_id, rating, OLD.human_score, -COUNT(*) FROM reviews WHERE publication_id = OLD.id AND NOT prefiltered GROUP BY job_id, rating
+    ON CONFLICT (job_id, rating, human_score IS NULL, IFNULL(human_score, 0)) DO UPDATE SET count = count + excluded.count;
+END;
+
+-- the unreviewed slots of a job in priority order, written once when the job starts so that
+-- leasing only reads the head of the queue (see fill_job_queue and next_open_slots)
+CREATE TABLE IF NOT EXISTS job_queue (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    publication_id INTEGER NOT NULL,
+    attempt INTEGER NOT NULL,
+    PRIMARY KEY (job_id, seq),
+    FOREIGN KEY (publication_id) REFERENCES publications(id) ON DELETE CASCADE,
+    FOREIGN KEY (job_id) REFERENCES jobs(id) ON DELETE CASCADE
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS job_queue_slot ON job_queue(job_id, publication_id, attempt);
+
+CREATE TRIGGER IF NOT EXISTS job_queue_review_insert AFTER INSERT ON reviews BEGIN
+    DELETE FROM job_queue WHERE job_id = NEW.job_id AND publication_id = NEW.publication_id AND attempt = NEW.attempt;
+END;
+"""
+
+HISTOGRAM_TRIGGERS = (
+    'rating_histogram_review_insert', 'rating_histogram_review_delete', 'rating_histogram_review_update',
+    'rating_histogram_label_update', 'rating_histogram_publication_delete',
+)
+
 def initialize_db(db_path: str = 'webapp.db'):
     if os.path.exists(db_path):
         raise RuntimeError("Cannot create db: already exists")
@@ -72,6 +253,83 @@ def initialize_db(db_path: str = 'webapp.db'):
     conn.executescript(SCHEMA)
     conn.commit()
     conn.close()
+    upgrade_db(db_path)
+
+def upgrade_db(db_path: str = 'webapp.db'):
+    """
+    Bring an existing database up to the current schema. Safe to run repeatedly.
+    """
+    conn = get_connection(db_path)
+    if _add_column(conn, 'reviews', 'attempt', 'INTEGER'):
+        # number existing reviews per (job, publication) in insertion order
+        conn.execute(
+            'UPDATE reviews SET attempt = ('
+            'SELECT COUNT(*) FROM reviews AS r2 '
+            'WHERE r2.job_id = reviews.job_id AND r2.publication_id = reviews.publication_id AND r2.id < reviews.id'
+            ')'
+        )
+    _add_column(conn, 'jobs', 'priority', "TEXT NOT NULL DEFAULT 'human'")
+    if _add_column(conn, 'jobs', 'time_resumed', 'REAL NOT NULL DEFAULT 0'):
+        conn.execute('UPDATE jobs SET time_resumed = ? - time_taken', (time.time(),))
+    _add_column(conn, 'jobs', 'tokens_saved', 'INTEGER NOT NULL DEFAULT 0')
+    _add_column(conn, 'jobs', 'batch_size', 'INTEGER NOT NULL DEFAULT 1')
+    _add_column(conn, 'reviews', 'origin', 'TEXT')
+    ledger = _add_column(conn, 'reviews', 'input_tokens', 'INTEGER')
+    for column in ('cached_tokens', 'output_tokens', 'reasoning_tokens'):
+        _add_column(conn, 'reviews', column, 'INTEGER')
+    if ledger:
+        # OpenAI imports used to store the chat completion usage as raw_data
+        conn.execute(
+            "UPDATE reviews SET "
+            "input_tokens = json_extract(raw_data, '$.prompt_tokens'), "
+            "cached_tokens = IFNULL(json_extract(raw_data, '$.prompt_tokens_details.cached_tokens'), 0), "
+            "output_tokens = json_extract(raw_data, '$.completion_tokens'), "
+            "reasoning_tokens = IFNULL(json_extract(raw_data, '$.completion_tokens_details.reasoning_tokens'), 0), "
+            "raw_data = NULL "
+            "WHERE json_valid(raw_data) AND json_type(raw_data, '$.prompt_tokens') = 'integer'"
+        )
+    _add_column(conn, 'reviews', 'duration', 'REAL')
+    if _add_column(conn, 'publications', 'ris', 'TEXT'):
+        # the original bibliography isn't around anymore, serialize the parsed entries instead
+        conn.execute('BEGIN')
+        for row in conn.execute('SELECT id, raw_data FROM publications WHERE raw_data IS NOT NULL').fetchall():
+            try:
+                conn.execute('UPDATE publications SET ris = ? WHERE id = ?', (ris_text(json.loads(row['raw_data'])), row['id']))
+            except Exception as e:
+                print(f"unable to serialize publication {row['id']} as RIS: {e}", file=sys.stderr)
+        conn.execute('COMMIT')
+    _add_column(conn, 'reviews', 'cost', 'REAL')
+    new_histogram = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'rating_histogram'").fetchone() is None
+    if _add_column(conn, 'reviews', 'prefiltered', 'BOOLEAN NOT NULL DEFAULT false'):
+        # the histogram triggers count prefiltered reviews no more, recreate them with the counts
+        for trigger in HISTOGRAM_TRIGGERS:
+            conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        conn.execute('DROP TABLE IF EXISTS rating_histogram')
+        new_histogram = True
+        conn.execute("UPDATE reviews SET prefiltered = true WHERE json_valid(raw_data) AND json_extract(raw_data, '$.prefilter') IS NOT NULL")
+    conn.executescript(UPGRADES)
+    if new_histogram:
+        conn.execute(
+            'INSERT INTO rating_histogram (job_id, rating, human_score, count) '
+            'SELECT r.job_id, r.rating, p.human_score, COUNT(*) FROM reviews AS r JOIN publications AS p ON p.id = r.publication_id '
+            'WHERE NOT r.prefiltered GROUP BY r.job_id, r.rating, p.human_score'
+        )
+    _add_column(conn, 'openai_batches', 'tokens', 'INTEGER')
+    _add_column(conn, 'retries', 'permanent', 'BOOLEAN NOT NULL DEFAULT false')
+    _add_column(conn, 'jobs', 'queued', 'REAL')
+    if _add_column(conn, 'jobs', 'heartbeat', 'REAL'):
+        conn.execute('UPDATE jobs SET heartbeat = (SELECT MAX(updated) FROM openai_batches AS b WHERE b.job_id = jobs.id)')
+    conn.commit()
+    conn.close()
+
+def _add_column(conn: sqlite3.Connection, table: str, column: str, decl: str) -> bool:
+    """
+    Add a column to a table if it is missing, returns True if the column was added.
+    """
+    if any(row['name'] == column for row in conn.execute(f'PRAGMA table_info({table})')):
+        return False
+    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+    return True
 
 def get_connection(db_path: str = 'webapp.db') -> sqlite3.Connection:
     conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
@@ -89,9 +347,18 @@ def read_bibliography_db(source: str):
             entries = [
                 json.loads(line) for line in f
             ]
+        records = [ris_text(entry) for entry in entries]
     else:
         with open(source, 'r') as bibliography_file:
-            entries = rispy.load(bibliography_file)
+            # a byte order mark would hide the TY tag of the first record
+            text = bibliography_file.read().lstrip('\ufeff')
+        import rispy
+        entries = rispy.loads(text)
+        # keep the original text of every record, so exports reproduce the bibliography as-is
+        records = split_ris(text)
+        if len(records) != len(entries):
+            print(f"found {len(records)} RIS records but parsed {len(entries)} entries, re-serializing them instead", file=sys.stderr)
+            records = [ris_text(entry) for entry in entries]
 
     conn = get_connection('webapp_import.db')
     cur = conn.cursor()
@@ -100,13 +367,13 @@ def read_bibliography_db(source: str):
 
     existing_ids = set(r[0] for r in conn.execute('SELECT ext_id FROM publications'))
 
-    for i, entry in progress(enumerate(entries, start=id0), count=len(entries)):
+    for i, (entry, record) in progress(enumerate(zip(entries, records), start=id0), count=len(entries)):
         ext_id = int(entry['id'])
         if ext_id in existing_ids:
             continue
     
         cur.execute(
-            'INSERT INTO publications(id, ext_id, title, doi, authors, abstract, year, raw_data, human_score, human_reason) VALUES (?,?,?,?,?,?,?,?,?,?)',
+            'INSERT INTO publications(id, ext_id, title, doi, authors, abstract, year, raw_data, human_score, human_reason, ris) VALUES (?,?,?,?,?,?,?,?,?,?,?)',
             (
                 i,
                 ext_id,
@@ -118,6 +385,7 @@ def read_bibliography_db(source: str):
                 json.dumps(entry),
                 None,
                 "",
+                record,
             )
         )
 
@@ -126,6 +394,31 @@ def read_bibliography_db(source: str):
     
     conn.commit()
 
+def split_ris(text: str) -> list[str]:
+    """
+    Split RIS text into the text of its records, from the TY line up to and including the ER line.
+    Lines outside of records are dropped, same as rispy does.
+    """
+    records = []
+    current = None
+    for line in text.splitlines():
+        if current is None:
+            if line.startswith('TY'):
+                current = [line]
+            continue
+        current.append(line)
+        if line.startswith('ER  -'):
+            records.append('\n'.join(current) + '\n')
+            current = None
+    return records
+
+def ris_text(entry: dict) -> str:
+    """
+    The RIS text of a single parsed entry, without the record number rispy puts in front.
+    """
+    import rispy
+    return rispy.dumps([entry]).split('\n', 1)[1]
+
 def ensure_url(doi: str) -> str:
     if doi == '':
         return doi
@@ -173,31 +466,121 @@ def import_human_marked_irrelevant_cases(file: str):
         conn.commit()
 
 
-def items_left_in_job(job_id: str, count: int, max_num: int = 100_000):
-    conn = get_connection()
-
+def _open_slots_query(conn: sqlite3.Connection, job_id: str, columns: str = 'p.*, s.attempt AS attempt', pending: bool = True) -> str:
+    """
+    Build the query listing every (publication, attempt) slot of a job that has no review, no entry
+    in the retry queue and is not leased by a worker. Without `pending`, slots in the retry queue or
+    leased are listed too. Takes the named parameters :repeats and :job_id.
+    """
     # check if it's an eval job (just run on the human labelled data):
     additional_condition = ""
     if bool(conn.execute('SELECT eval_run FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]):
         # add an additional sql condition
         additional_condition = ' AND p.human_score IS NOT NULL'
-        print("EVAL RUN")
 
-    query = f"""SELECT p.*, ? - COALESCE(COUNT(r.id), 0) as num 
-FROM publications as p 
-LEFT JOIN reviews as r ON p.id = r.publication_id AND r.job_id = ?
-GROUP BY p.id 
-HAVING num > 0 {additional_condition}
-ORDER BY p.human_score DESC"""
+    if pending:
+        additional_condition += (
+            "\nAND NOT EXISTS (SELECT 1 FROM retries AS f WHERE f.job_id = :job_id AND f.publication_id = p.id AND f.attempt = s.attempt)"
+            "\nAND NOT EXISTS (SELECT 1 FROM leases AS l WHERE l.job_id = :job_id AND l.publication_id = p.id AND l.attempt = s.attempt)"
+        )
+
+    return f"""WITH RECURSIVE slots(attempt) AS (
+    SELECT 0 UNION ALL SELECT attempt + 1 FROM slots WHERE attempt + 1 < :repeats
+)
+SELECT {columns}
+FROM publications AS p CROSS JOIN slots AS s
+WHERE NOT EXISTS (SELECT 1 FROM reviews AS r WHERE r.job_id = :job_id AND r.publication_id = p.id AND r.attempt = s.attempt)
+{additional_condition}"""
+
+
+def _slot_order(conn: sqlite3.Connection, job_id: str) -> str:
+    priority = conn.execute('SELECT priority FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]
+    return PRIORITIES.get(priority, PRIORITIES[DEFAULT_PRIORITY])
 
-    for row in conn.execute(query, (count, job_id)):
-        for _ in range(row['num']):
-            # honor limits
-            max_num -= 1
-            if max_num <= 0:
-                return
 
-            yield row
+def _ordered_slots_query(conn: sqlite3.Connection, job_id: str) -> str:
+    return _open_slots_query(conn, job_id) + f"\nORDER BY {_slot_order(conn, job_id)}"
+
+
+def items_left_in_job(job_id: str, count: int, max_num: int = 100_000):
+    """
+    Yield the open (publication, attempt) slots of a job, in the order given by the job's priority.
+    """
+    conn = get_connection()
+
+    for row in conn.execute(_ordered_slots_query(conn, job_id), {'repeats': count, 'job_id': job_id}):
+        # honor limits
+        max_num -= 1
+        if max_num <= 0:
+            return
+
+        yield row
+
+def fill_job_queue(job_id: str, count: int, keep: Callable[[sqlite3.Connection, list[sqlite3.Row]], list[sqlite3.Row]] | None = None) -> bool:
+    """
+    Write the unreviewed slots of a job into job_queue in priority order. This is the only full
+    pass over the publications, run when a job is started or resumed. Reviews take their slot out
+    of the queue, leased and retried slots are skipped when leasing.
+
+    `keep` is called with every chunk of slots (id, attempt, title and abstract of the publication)
+    inside the chunk's write transaction and returns those that are queued, e.g. to review the
+    rest right away.
+
+    The slots are read outside of any write transaction and written in chunks, so that workers
+    keep submitting in the meantime and can lease from the head of the queue before it is
+    complete. Returns False if another worker is filling the queue already.
+    """
+    conn = get_connection()
+    now = time.time()
+    # jobs.queued is the negated start time while a worker fills the queue
+    claimed = conn.execute(
+        'UPDATE jobs SET queued = ? WHERE id = ? AND (queued IS NULL OR queued < 0 AND queued > ?)',
+        (-now, job_id, QUEUE_FILL_TIMEOUT - now)
+    ).rowcount
+    if not claimed:
+        return False
+
+    while conn.execute(
+        'DELETE FROM job_queue WHERE rowid IN (SELECT rowid FROM job_queue WHERE job_id = ? LIMIT ?)', (job_id, QUEUE_CHUNK)
+    ).rowcount:
+        pass
+
+    slots = get_connection().execute(
+        _open_slots_query(conn, job_id, 'p.id AS id, s.attempt AS attempt, p.title AS title, p.abstract AS abstract', pending=False) + f"\nORDER BY {_slot_order(conn, job_id)}",
+        {'repeats': count, 'job_id': job_id}
+    )
+    seq = 0
+    while chunk := slots.fetchmany(QUEUE_CHUNK):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            queued = keep(conn, chunk) if keep is not None else chunk
+            # slots reviewed since they were read are left out
+            conn.executemany(
+                'INSERT OR IGNORE INTO job_queue (job_id, seq, publication_id, attempt) SELECT ?, ?, ?, ? '
+                'WHERE NOT EXISTS (SELECT 1 FROM reviews WHERE job_id = ? AND publication_id = ? AND attempt = ?)',
+                ((job_id, seq + i, row['id'], row['attempt'], job_id, row['id'], row['attempt']) for i, row in enumerate(queued))
+            )
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        seq += len(chunk)
+    conn.execute('UPDATE jobs SET queued = ? WHERE id = ?', (time.time(), job_id))
+    return True
+
+
+def next_open_slots(conn: sqlite3.Connection, job_id: str, limit: int) -> list[sqlite3.Row]:
+    """
+    The first `limit` open slots from the queue of a job, read through the given connection
+    (e.g. inside a transaction). Only the leased and retried slots at the head are skipped.
+    """
+    return conn.execute("""
+        SELECT p.*, q.attempt AS attempt FROM job_queue AS q JOIN publications AS p ON p.id = q.publication_id
+        WHERE q.job_id = :job_id
+        AND NOT EXISTS (SELECT 1 FROM leases AS l WHERE l.job_id = q.job_id AND l.publication_id = q.publication_id AND l.attempt = q.attempt)
+        AND NOT EXISTS (SELECT 1 FROM retries AS f WHERE f.job_id = q.job_id AND f.publication_id = q.publication_id AND f.attempt = q.attempt)
+        ORDER BY q.seq LIMIT :limit
+    """, {'job_id': job_id, 'limit': limit}).fetchall()
 
 def remaining_items_count(job_id: str, job_k : int | None = None):
     conn = get_connection()
@@ -205,16 +588,9 @@ def remaining_items_count(job_id: str, job_k : int | None = None):
     if job_k is None:
         job_k = conn.execute('SELECT repeats FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]
     res = conn.execute(
-        "SELECT SUM(num) FROM ("
-        "SELECT p.*, ? - COALESCE(COUNT(r.id), 0) as num "
-        "FROM publications as p "
-        "LEFT JOIN reviews as r ON p.id = r.publication_id AND r.job_id = ? "
-        "GROUP BY p.id "
-        "HAVING num > 0)", 
-        (job_k, job_id)
+        f"SELECT COUNT(*) FROM ({_open_slots_query(conn, job_id)})",
+        {'repeats': job_k, 'job_id': job_id}
     ).fetchone()[0]
-    if res is None:
-        return 10 # fallback
     return res
 
 
@@ -224,11 +600,15 @@ if __name__ == '__main__':
     args.add_argument('-c', '--create', help='Create database', action='store_true')
     args.add_argument('-b', '--bib', help='bibliography file (JSON or txt)', nargs='?')
     args.add_argument('--human-marked-irrelevant', help='CSV export of marked irrelevant papers', nargs='?')
+    args.add_argument('-u', '--upgrade', help='Upgrade an existing database to the current schema', action='store_true')
 
     ns = args.parse_args()
 
     if ns.create:
         initialize_db()
+
+    if ns.upgrade:
+        upgrade_db()
     
     if ns.bib:
         read_bibliography_db(ns.bib)
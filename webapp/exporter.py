@@ -1,123 +1,241 @@
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
-from typing import Literal
-import uuid
+"""
+Streaming exports of the reviews of one or more jobs as CSV or RIS, either every review on its
+own or one row per publication with a consensus of its ratings.
+
+Rows are sent to the client as they are fetched, optionally gzip compressed. While streaming,
+the bytes are also written to a cache file keyed by the export parameters and the review
+high-water mark of the jobs, so repeating an export is served from disk until new reviews
+arrive. Stale cache entries of the same export are removed when a fresh one is completed.
+"""
+from typing import Iterator, Literal
+import hashlib
 import csv
+import io
 import json
-import rispy
-import traceback
-
-from dataclasses import dataclass
+import os
+import uuid
+import zlib
+
+from webapp.db import get_connection, ris_text
+
+CACHE_DIR = 'out/cache'
+FETCH_ROWS = 1024
+
+COMPARISONS = {'ge': '>=', 'le': '<=', 'lt': '<', 'gt': '>'}
+
+# how the ratings of a publication are combined, 'each' exports every review on its own
+CONSENSUS_MODES = ('each', 'mean', 'median', 'min', 'max', 'votes')
+# the units that are combined, single reviews or the mean rating of every job
+CONSENSUS_LEVELS = ('review', 'job')
+
+AGGREGATES = {
+    'mean': 'AVG(rating)',
+    'median': 'median(rating)',
+    'min': 'MIN(rating)',
+    'max': 'MAX(rating)',
+    # number of ratings passing the cutoff, the publication is kept if at least k of them do
+    'votes': 'SUM(rating {cmp} :rating)',
+}
+
+PUBLICATION_COLUMNS = {
+    'csv': """"https://domain.com/publication/" || p.id AS url, p.ext_id AS id, p.title, p.doi, p.authors, p.abstract, p.year,
+       p.human_score, p.human_reason""",
+    'ris': 'p.id, p.ris, p.raw_data',
+}
+
+CSV_HEADER = ['url', 'id', 'title', 'doi', 'authors', 'abstract', 'year', 'human_score', 'human_reason', 'model_score', 'model_reason']
+CONSENSUS_CSV_HEADER = CSV_HEADER[:-2] + ['consensus_score', 'ratings']
+
+REVIEWS_QUERY = """
+SELECT {columns}{review_columns}
+FROM reviews AS r JOIN publications AS p ON p.id = r.publication_id
+WHERE r.job_id IN ({jobs}) AND r.rating {cmp} :rating
+"""
+
+# one grouped pass over the reviews of all jobs, the job level averages the attempts of every job first
+CONSENSUS_QUERY = """
+SELECT {columns}{consensus_columns}
+FROM (
+    SELECT publication_id, {aggregate} AS score, COUNT(*) AS ratings
+    FROM {source}
+    GROUP BY publication_id
+    HAVING {having}
+) AS c JOIN publications AS p ON p.id = c.publication_id
+"""
+
+REVIEW_SOURCE = "(SELECT publication_id, rating FROM reviews WHERE job_id IN ({jobs}))"
+JOB_SOURCE = "(SELECT publication_id, AVG(rating) AS rating FROM reviews WHERE job_id IN ({jobs}) GROUP BY publication_id, job_id)"
+
+
+class Median:
+    """
+    SQLite aggregate for the median, which SQLite doesn't ship with.
+    """
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        if value is not None:
+            self.values.append(value)
+
+    def finalize(self):
+        if not self.values:
+            return None
+        values = sorted(self.values)
+        mid = len(values) // 2
+        return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
+
+
+def export_query(format: str, jobs: list[str], cmp: str, consensus: str, level: str) -> str:
+    """
+    The query for an export, its parameters are :rating, :k and :job0 ... :jobN.
+    """
+    job_params = ', '.join(f':job{i}' for i in range(len(jobs)))
+    columns = PUBLICATION_COLUMNS[format]
+    if consensus == 'each':
+        review_columns = ', r.rating AS model_rating, r.reason AS model_reason' if format == 'csv' else ''
+        return REVIEWS_QUERY.format(columns=columns, review_columns=review_columns, jobs=job_params, cmp=cmp)
+
+    source = REVIEW_SOURCE if level == 'review' else JOB_SOURCE
+    return CONSENSUS_QUERY.format(
+        columns=columns,
+        consensus_columns=', c.score, c.ratings' if format == 'csv' else '',
+        aggregate=AGGREGATES[consensus].format(cmp=cmp),
+        source=source.format(jobs=job_params),
+        having='score >= :k' if consensus == 'votes' else f'score {cmp} :rating',
+    )
 
-from webapp.db import get_connection
 
-@dataclass
 class Export:
-    uuid: str
-    job_id: str
-    comparison: str
-    rating: str
-    format: str
-    total: int = 1
-    processed: int = 0
-    done: bool = False
-
-    def file_name(self):
-        return f'out/{self.uuid}.{self.format}'
-
-class Exporter:
-    def __init__(self, num_threads: int):
-        self.pool = ThreadPoolExecutor(num_threads)
-        self.by_job = defaultdict(list)
-        self.by_id = dict()
-        self.outdir = 'out/'
-
-        # load jobs from database
-        conn = get_connection()
-        for row in conn.execute('SELECT * FROM exports'):
-            exp = Export(row['id'], row['job_id'], row['comparison'], row['rating'], row['format'], 1, 1, True)
-            self.by_id[exp.uuid] = exp
-            self.by_job[exp.job_id].append(exp)
-
-
-    def get_files_for_job(self, job_id: str) -> list[Export]:
-        return self.by_job[job_id]
-
-    def submit(self, job_id: str, comparison: Literal['ge', 'gt', 'le', 'lt'], rating: int, format: Literal['csv', 'ris']) -> Export:
-        cmp = {'ge': '>=', 'le': '<=', 'lt': '<', 'gt': '>'}.get(comparison, None)
+    """
+    One export request. `cached` is set if a finished file for the current reviews exists,
+    otherwise `stream()` produces the file while filling the cache.
+
+    Reviews of several jobs can be exported together. With a consensus mode other than 'each',
+    every publication appears once and is filtered on the combined rating of its reviews (or
+    of its jobs, see `level`), 'votes' keeps publications with at least `k` passing ratings.
+    """
+    def __init__(self, jobs: list[str], comparison: Literal['ge', 'gt', 'le', 'lt'], rating: int, format: Literal['csv', 'ris'], gzip: bool = False,
+                 consensus: str = 'each', level: str = 'review', k: int = 1):
+        cmp = COMPARISONS.get(comparison)
         if cmp is None:
-            raise ValueError(cmp)
-        
-        exp = Export(
-            uuid=str(uuid.uuid4()),
-            job_id=job_id,
-            comparison=cmp,
-            rating=rating,
-            format=format,
-        )
-        self.by_job[job_id].append(exp)
-        self.by_id[exp.uuid] = exp
-
-        self.pool.submit(_run_export, exp)
-
-        return exp
-    
-    def get(self, uuid: str) -> Export | None:
-        return self.by_id.get(uuid, None)
-
-def _run_export(export: Export):
-    try:
+            raise ValueError("Unsupported comparison", comparison)
+        if format not in ('csv', 'ris'):
+            raise ValueError("Unsupported export format", format)
+        if consensus not in CONSENSUS_MODES:
+            raise ValueError("Unsupported consensus mode", consensus)
+        if level not in CONSENSUS_LEVELS:
+            raise ValueError("Unsupported consensus level", level)
+        if not jobs:
+            raise ValueError("No jobs to export")
+
+        self.jobs = sorted(set(jobs))
+        self.cmp = cmp
+        self.rating = rating
+        self.format = format
+        self.gzip = gzip
+        self.consensus = consensus
+        self.level = level
+        self.k = k
+        self.params = {'rating': rating, 'k': k} | {f'job{i}': job for i, job in enumerate(self.jobs)}
+
+        key = [self.jobs, cmp, rating, format, gzip, consensus, level, k]
+        self.prefix = hashlib.sha256(json.dumps(key).encode()).hexdigest()[:16]
+        # no connection is held until stream() runs, a response that is never sent leaks nothing
+        self.conn = None
         conn = get_connection()
-
-        cmp = export.comparison
-        rating = export.rating
-        job_id = export.job_id
-
-        export.total = conn.execute(f'SELECT COUNT(*) FROM reviews WHERE job_id = ? AND rating {cmp} ?', (job_id, rating)).fetchone()[0]
-
-        print(f'set export total to {export.total}')
-
-        with open(export.file_name(), 'w') as f:
-            if export.format == 'csv':
-                # export csv
-                data = conn.execute(f'SELECT "https://domain.com/publication/" || p.id as url, p.ext_id as id, p.title as title, p.doi as doi, p.authors as authors, p.abstract as abstract, p.year as year, p.human_score as human_score, p.human_reason as human_reason, r.rating as model_rating, r.reason as model_reason FROM publications AS p RIGHT JOIN reviews as R ON p.id = r.publication_id AND r.job_id = ? WHERE r.rating {cmp} ?', (job_id, rating))
-                w = csv.writer(f)
-                w.writerow(['url', 'id', 'title', 'doi', 'authors', 'abstract', 'year', 'human_score', 'human_reason', 'model_score', 'model_reason'])
-
-                while True:
-                    rows = data.fetchmany(1024)
-                    if not rows:
-                        break
-                    w.writerows(rows)
-                    export.processed += len(rows)
-
-            elif export.format == 'ris':
-                    # export ris
-                    data = conn.execute(f'SELECT p.raw_data FROM publications AS p JOIN reviews as r ON p.id = r.publication_id AND r.job_id = ? WHERE r.rating {cmp} ?', (job_id, rating))
-
-                    while True:
-                        chunk = data.fetchmany(1024)
-                        if not chunk:
-                            break
+        try:
+            self.file_name = self._cache_file(conn)
+        finally:
+            conn.close()
+        self.cached = os.path.exists(self.file_name)
+
+    @property
+    def extension(self) -> str:
+        return f'{self.format}.gz' if self.gzip else self.format
+
+    @property
+    def mimetype(self) -> str:
+        if self.gzip:
+            return 'application/gzip'
+        return 'text/csv' if self.format == 'csv' else 'application/x-research-info-systems'
+
+    def _cache_file(self, conn) -> str:
+        """
+        The cache file for the current reviews of the jobs, keyed by their high-water mark.
+        """
+        job_params = ', '.join(f':job{i}' for i in range(len(self.jobs)))
+        max_id, count = conn.execute(f'SELECT MAX(id), COUNT(*) FROM reviews WHERE job_id IN ({job_params})', self.params).fetchone()
+        return os.path.join(CACHE_DIR, f'{self.prefix}.{max_id or 0}-{count}.{self.extension}')
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.execute('COMMIT')
+            self.conn.close()
+            self.conn = None
+
+    def stream(self) -> Iterator[bytes]:
+        # the high-water mark and the exported rows are read in one transaction, so a review
+        # committed in between can't end up in a file cached under the older key
+        self.conn = get_connection()
+        self.conn.create_aggregate('median', 1, Median)
+        self.conn.execute('BEGIN')
+        part = None
+        try:
+            self.file_name = self._cache_file(self.conn)
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            part = f'{self.file_name}.{uuid.uuid4()}.part'
+            with open(part, 'wb') as f:
+                chunks = (text.encode() for text in self._text_chunks())
+                for chunk in (_gzip(chunks) if self.gzip else chunks):
+                    f.write(chunk)
+                    yield chunk
+            os.replace(part, self.file_name)
+            self._remove_stale()
+        finally:
+            # aborted downloads leave no partial file in the cache
+            if part is not None and os.path.exists(part):
+                os.remove(part)
+            self.close()
+
+    def _text_chunks(self) -> Iterator[str]:
+        data = self.conn.execute(export_query(self.format, self.jobs, self.cmp, self.consensus, self.level), self.params)
+        if self.format == 'csv':
+            buf = io.StringIO()
+            w = csv.writer(buf)
+            w.writerow(CSV_HEADER if self.consensus == 'each' else CONSENSUS_CSV_HEADER)
+            while rows := data.fetchmany(FETCH_ROWS):
+                w.writerows(rows)
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        else:
+            # publications carry their RIS text from the import, only older rows need rispy
+            while rows := data.fetchmany(FETCH_ROWS):
+                records = []
+                for id, ris, raw_data in rows:
+                    if ris is None:
                         try:
-                            rispy.dump([json.loads(row[0]) for row in chunk], f)
+                            ris = ris_text(json.loads(raw_data))
                         except Exception as e:
-                            print("error:")
-                            print(e)
-                        export.processed += len(chunk)
-
-            else:
-                raise ValueError("Unsupported export format", export.format)
-        print("Export complete")
-        export.done = True
-        # write to db
-        conn.execute('INSERT INTO exports (id, job_id, rating, comparison, format) VALUES (?,?,?,?,?)', (export.uuid, job_id, rating, cmp, export.format))
-        conn.commit()
-
-    except Exception as ex:
-        print(ex)
-        traceback.print_exc(ex)
-        traceback.print_tb()
-
-
-EXPORTER = Exporter(8)
+                            print(f"error writing publication {id} as RIS: {e}")
+                            continue
+                    records.append(ris)
+                yield '\n'.join(records) + '\n'
+
+    def _remove_stale(self):
+        for name in os.listdir(CACHE_DIR):
+            if name.startswith(f'{self.prefix}.') and name.endswith(f'.{self.extension}') \
+                    and os.path.join(CACHE_DIR, name) != self.file_name:
+                try:
+                    os.remove(os.path.join(CACHE_DIR, name))
+                except FileNotFoundError:
+                    pass
+
+
+def _gzip(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    comp = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        if out := comp.compress(chunk):
+            yield out
+    yield comp.flush()
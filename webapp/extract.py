@@ -0,0 +1,328 @@
+"""
+Extraction of the `{"score": Number, "reason": String}` result from model output.
+"""
+import ast
+import json
+import math
+import random
+import re
+import time
+
+from webapp.scheduler import estimate_tokens
+
+JSON_REGEX = re.compile(r'```(json)?\n(\{.*\})\n```', flags=re.DOTALL)
+TRAILING_COMMA_REGEX = re.compile(r',\s*([}\]])')
+# a score written as a fraction ("85 out of 100", "8/10") is on an unknown scale and not taken
+SCORE_PROSE_REGEX = re.compile(r'\bscore\b\W{0,3}\s*(?:of\s+|is\s+)?(\d{1,3}(?:\.\d+)?)(?![\d.]|\s*(?:/|out\s+of\b))', flags=re.IGNORECASE)
+REASON_PROSE_REGEX = re.compile(r'\breason(?:ing)?\b\W{0,3}\s*(.+)', flags=re.IGNORECASE)
+QUOTED_REGEX = re.compile(r'(["\'])(.*)\1[.,]?')
+
+# stages of parse_result, from strict to tolerant. Results found while streaming count as
+# 'stream', 'rescue' and 'failed' are used by the callers for the LLM rescue call.
+# 'batch' counts results taken from the array answer of a batched prompt.
+PARSE_STAGES = ('stream', 'fenced', 'object', 'repaired', 'prose', 'rescue', 'batch', 'failed')
+
+# fraction of streamed requests that run to completion instead of being cancelled after the
+# JSON object, so that the length of the text models write after it keeps being measured
+TAIL_SAMPLE_RATE = 0.05
+
+# model -> (sum, count) of decode tokens generated after the JSON object in uncancelled runs
+_tails: dict[str, tuple[int, int]] = {}
+
+
+def extract_json(text: str) -> dict | None:
+    if (match := JSON_REGEX.search(text)) is None:
+        return None
+    try:
+        res = json.loads(match.group(2))
+    except json.JSONDecodeError:
+        return None
+    return res if is_result(res) else None
+
+
+def parse_result(text: str) -> tuple[dict | None, str | None]:
+    """
+    Extract the result with a cascade of increasingly tolerant parsers:
+
+    - fenced: a ```json block (the format the prompt asks for)
+    - object: any valid JSON object with score and reason, e.g. without a fence
+    - repaired: objects with trailing commas, single quotes or a score given as string or float
+    - prose: a "score: 85" and "reason: ..." written out in text
+
+    Returns the result and the name of the stage that found it, or (None, None).
+    """
+    if (res := extract_json(text)) is not None:
+        return res, 'fenced'
+
+    candidates = list(_balanced(text))
+    for candidate in candidates:
+        try:
+            res = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if is_result(res):
+            return res, 'object'
+
+    for candidate in candidates:
+        if (res := _coerce(_loads_tolerant(candidate))) is not None:
+            return res, 'repaired'
+
+    # the final verdict usually comes last
+    scores = [round(float(score)) for score in SCORE_PROSE_REGEX.findall(text)]
+    reasons = REASON_PROSE_REGEX.findall(text)
+    if scores and reasons:
+        reason = reasons[-1].strip(' *}')
+        if quoted := QUOTED_REGEX.fullmatch(reason):
+            reason = quoted.group(2)
+        res = {'score': scores[-1], 'reason': reason}
+        if is_result(res):
+            return res, 'prose'
+    return None, None
+
+
+def parse_batch_result(text: str, ids: list[int]) -> dict[int, dict] | None:
+    """
+    Extract the results of a batched prompt, a JSON array of `{"id": Number, "score": Number, "reason": String}`.
+
+    Returns the results by id, or None unless the answer has exactly one valid result for each of the ids.
+    """
+    expected = set(ids)
+    # the final answer usually comes last
+    for candidate in reversed(list(_balanced(text, '[', ']'))):
+        items = _loads_tolerant(candidate)
+        if not isinstance(items, list):
+            continue
+        results = {}
+        for item in items:
+            res = _coerce(item)
+            if res is None:
+                break
+            try:
+                pub_id = int(res['id'])
+            except (KeyError, TypeError, ValueError):
+                break
+            if pub_id in results:
+                break
+            results[pub_id] = {**res, 'id': pub_id}
+        else:
+            if set(results) == expected:
+                return results
+    return None
+
+
+def _balanced(text: str, opening: str = '{', closing: str = '}'):
+    """
+    Yield all top-level {...} (or [...]) substrings of a text, ignoring brackets in double-quoted strings.
+    """
+    depth = start = 0
+    in_string = escape = False
+    for i, c in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif c == '\\':
+                escape = True
+            elif c == '"':
+                in_string = False
+        elif c == '"' and depth:
+            in_string = True
+        elif c == opening:
+            if depth == 0:
+                start = i
+            depth += 1
+        elif c == closing and depth:
+            depth -= 1
+            if depth == 0:
+                yield text[start:i + 1]
+
+
+def _loads_tolerant(candidate: str):
+    candidate = TRAILING_COMMA_REGEX.sub(r'\1', candidate)
+    try:
+        return json.loads(candidate)
+    except json.JSONDecodeError:
+        pass
+    # python literal syntax covers single quotes
+    try:
+        return ast.literal_eval(candidate)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+
+def _coerce(res) -> dict | None:
+    """
+    Turn a parsed object with a numeric-ish score and a reason into a valid result.
+    """
+    if not isinstance(res, dict) or not isinstance(res.get('reason'), str):
+        return None
+    score = res.get('score')
+    if isinstance(score, str):
+        try:
+            score = float(score.strip().rstrip('%'))
+        except ValueError:
+            return None
+    if isinstance(score, bool) or not isinstance(score, (int, float)) or not math.isfinite(score):
+        return None
+    res = {**res, 'score': round(score)}
+    return res if is_result(res) else None
+
+
+def is_result(res) -> bool:
+    """
+    A score between 0 and 100 (True and False are no scores) and a non-empty reason.
+    """
+    return (
+        isinstance(res, dict)
+        and isinstance(res.get('score'), int)
+        and not isinstance(res.get('score'), bool)
+        and 0 <= res['score'] <= 100
+        and isinstance(res.get('reason'), str)
+        and res['reason'].strip() != ''
+    )
+
+
+class JsonStreamDetector:
+    """
+    Scans streamed model output for the first complete JSON object with a valid score and
+    reason, so that generation can be stopped as soon as the result is known.
+
+    Reasoning models wrap their chain of thought in <think> tags, objects inside them are ignored.
+    """
+    def __init__(self):
+        self.text = ''
+        self.result: dict | None = None
+        self._pos = 0
+        self._depth = 0
+        self._start = 0
+        self._in_string = False
+        self._escape = False
+        self._skipped_think = False
+
+    def feed(self, chunk: str) -> dict | None:
+        """
+        Add a chunk of output. Returns the result once it is complete.
+        """
+        self.text += chunk
+        if self.result is not None:
+            return self.result
+
+        text = self.text
+        if not self._skipped_think:
+            head = text.lstrip()
+            if '<think>'.startswith(head):
+                return None
+            if head.startswith('<think>'):
+                end = text.find('</think>')
+                if end < 0:
+                    return None
+                self._pos = end + len('</think>')
+            self._skipped_think = True
+
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"' and self._depth:
+                self._in_string = True
+            elif c == '{':
+                if self._depth == 0:
+                    self._start = i
+                self._depth += 1
+            elif c == '}' and self._depth:
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        res = json.loads(text[self._start:i + 1])
+                    except json.JSONDecodeError:
+                        continue
+                    if is_result(res):
+                        self._pos = i + 1
+                        self.result = res
+                        return res
+        self._pos = len(text)
+        return None
+
+
+def record_tail(model: str, tokens: int):
+    """
+    Record how many tokens a model generated after the result in an uncancelled run.
+    """
+    total, count = _tails.get(model, (0, 0))
+    _tails[model] = (total + tokens, count + 1)
+
+
+def expected_tail(model: str) -> int:
+    """
+    Mean number of tokens a model generates after the result, i.e. the tokens saved by
+    cancelling the request. Zero until an uncancelled run was observed.
+    """
+    total, count = _tails.get(model, (0, 0))
+    return round(total / count) if count else 0
+
+
+class StreamedGeneration:
+    """
+    Bookkeeping for a streamed ollama generation that is cancelled as soon as the result is
+    complete. Feed it the streamed chunks, and stop reading once add() returns True.
+    The prompt is only used to estimate the prompt tokens of a cancelled generation.
+    """
+    def __init__(self, model: str, sample: bool | None = None, prompt: str | None = None):
+        self.model = model
+        self.prompt = prompt
+        self.detector = JsonStreamDetector()
+        # sampled generations run to completion to measure the tail
+        self.sample = random.random() < TAIL_SAMPLE_RATE if sample is None else sample
+        self.tokens = 0
+        self.result_at = 0
+        self.final = None
+        self.t_first = None
+
+    @property
+    def text(self) -> str:
+        return self.detector.text
+
+    @property
+    def result(self) -> dict | None:
+        return self.detector.result
+
+    def add(self, chunk) -> bool:
+        """
+        Add a streamed chunk, returns True if the generation should be cancelled.
+        """
+        if self.t_first is None:
+            self.t_first = time.perf_counter()
+        # ollama streams one token per chunk
+        self.tokens += 1
+        if chunk.get('done'):
+            self.final = chunk
+        found = self.detector.result is not None
+        self.detector.feed(chunk['response'])
+        if not found and self.detector.result is not None:
+            self.result_at = self.tokens
+            return not self.sample
+        return False
+
+    def finish(self) -> dict:
+        """
+        Token counts in the format of ollama's final response, plus whether the generation
+        was cancelled and the estimated number of decode tokens that saved. ollama doesn't
+        report a cancelled generation, its prompt tokens are estimated from the prompt and
+        its durations are measured on our side, so they are approximate.
+        """
+        if self.final is not None:
+            if self.result_at:
+                record_tail(self.model, max((self.final.get('eval_count') or self.tokens) - self.result_at, 0))
+            stats = {k: self.final.get(k) for k in ('prompt_eval_count', 'prompt_eval_duration', 'eval_count', 'eval_duration')}
+            return {**stats, 'cancelled': False, 'tokens_saved': 0}
+        return {
+            'prompt_eval_count': estimate_tokens(self.prompt) if self.prompt is not None else None,
+            'eval_count': self.tokens,
+            'eval_duration': int((time.perf_counter() - (self.t_first or time.perf_counter())) * 1e9),
+            'cancelled': True,
+            'tokens_saved': expected_tail(self.model) if self.result is not None else 0,
+        }
@@ -0,0 +1,306 @@
+"""
+Lease-based distribution of work items to any number of local or remote workers.
+
+Workers lease batches of (publication, attempt) slots, keep them alive with heartbeats and
+submit a result (or a failure) per slot. Leases of crashed workers expire after LEASE_TTL
+seconds and the slots become available again.
+"""
+import os
+import socket
+import sqlite3
+import time
+
+from webapp.db import get_connection, next_open_slots, fill_job_queue
+from webapp.models import OPENAI_MODELS
+from webapp.prefilter import get_prefilter, filtered_review
+from webapp.retries import record_failure, clear_retry
+
+# seconds until a lease expires without a heartbeat
+LEASE_TTL = 120
+
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+
+class LeaseConflict(Exception):
+    """
+    A result or failure for a slot the worker may not fill: leased to another worker, already
+    reviewed, or not a slot of the job at all.
+    """
+
+
+def lease_items(worker: str, count: int, ttl: float = LEASE_TTL) -> tuple[dict[str, dict], list[dict]]:
+    """
+    Lease up to `count` work items for a worker.
+
+    Items are taken from the running (or waiting) ollama job with the fewest active leases,
+    so concurrent jobs share the available workers fairly. Due retries come before new work.
+
+    Returns the involved jobs (id -> model and prompt) and the leased items.
+    """
+    conn = get_connection()
+    # started or resumed jobs get their queue of open slots first, outside of the lease transaction
+    for job in conn.execute(f"""
+        SELECT id, repeats FROM jobs
+        WHERE status IN ('RUNNING', 'WAITING') AND (queued IS NULL OR queued < 0) AND model NOT IN ({','.join('?' * len(OPENAI_MODELS))})
+    """, OPENAI_MODELS).fetchall():
+        pf = get_prefilter(conn, job['id'])
+        fill_job_queue(job['id'], job['repeats'], None if pf is None else lambda c, rows: _prefilter(c, job['id'], pf, rows))
+
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DELETE FROM leases WHERE expires < ?', (now,))
+
+        jobs = conn.execute(f"""
+            SELECT j.*, (SELECT COUNT(*) FROM leases AS l WHERE l.job_id = j.id) AS active
+            FROM jobs AS j
+            WHERE j.status IN ('RUNNING', 'WAITING') AND j.model NOT IN ({','.join('?' * len(OPENAI_MODELS))})
+            ORDER BY active ASC, j.time_created ASC
+        """, OPENAI_MODELS).fetchall()
+
+        for job in jobs:
+            rows = conn.execute("""
+                SELECT p.*, f.attempt AS attempt FROM retries AS f JOIN publications AS p ON p.id = f.publication_id
+                WHERE f.job_id = ? AND NOT f.dead AND f.next_try <= ?
+                AND NOT EXISTS (SELECT 1 FROM leases AS l WHERE l.job_id = f.job_id AND l.publication_id = f.publication_id AND l.attempt = f.attempt)
+                ORDER BY f.next_try LIMIT ?
+            """, (job['id'], now, count)).fetchall()
+            if len(rows) < count:
+                rows += next_open_slots(conn, job['id'], count - len(rows))
+
+            if not rows:
+                # an empty queue that is still being filled doesn't mean the job is done
+                if job['queued'] is not None and job['queued'] > 0 and job['active'] == 0 and not _has_pending_retries(conn, job['id']):
+                    _finish_job(conn, job['id'])
+                continue
+
+            if job['status'] == 'WAITING':
+                # keep the time already spent on the job, so time_taken stays cumulative
+                conn.execute(
+                    "UPDATE jobs SET status = 'RUNNING', time_started = ?, time_resumed = ? WHERE id = ?",
+                    (now, now - job['time_taken'], job['id'])
+                )
+                print(f"Started job {job['id']}")
+
+            items = []
+            for row in rows:
+                cur = conn.execute(
+                    'INSERT INTO leases (job_id, publication_id, attempt, worker, expires) VALUES (?,?,?,?,?)',
+                    (job['id'], row['id'], row['attempt'], worker, now + ttl)
+                )
+                items.append({
+                    'lease_id': cur.lastrowid,
+                    'job_id': job['id'],
+                    'work': {k: row[k] for k in ('id', 'title', 'abstract', 'attempt')},
+                })
+            conn.execute('COMMIT')
+            return {job['id']: {'name': job['name'], 'model': job['model'], 'prompt': job['prompt'], 'batch_size': job['batch_size']}}, items
+
+        conn.execute('COMMIT')
+        return {}, []
+    except:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def heartbeat(worker: str, lease_ids: list[int], ttl: float = LEASE_TTL) -> list[int]:
+    """
+    Extend the given leases. Returns the ids of leases the worker no longer holds, either because
+    they expired and were handed out again, or because their job is not running anymore.
+    """
+    if not lease_ids:
+        return []
+    conn = get_connection()
+    marks = ','.join('?' * len(lease_ids))
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(
+            f"UPDATE leases SET expires = ? WHERE worker = ? AND id IN ({marks}) "
+            f"AND job_id IN (SELECT id FROM jobs WHERE status = 'RUNNING')",
+            (time.time() + ttl, worker, *lease_ids)
+        )
+        held = {row[0] for row in conn.execute(
+            f"SELECT l.id FROM leases AS l JOIN jobs AS j ON j.id = l.job_id "
+            f"WHERE l.worker = ? AND l.id IN ({marks}) AND j.status = 'RUNNING'",
+            (worker, *lease_ids)
+        )}
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    return [i for i in lease_ids if i not in held]
+
+
+def _check_slot(conn: sqlite3.Connection, worker: str, lease_id: int, job_id: str, pub_id: int, attempt: int):
+    """
+    Raise LeaseConflict unless the worker holds the lease on the slot, or the slot is an open slot
+    of the job that nobody holds a lease on (e.g. after the worker's lease expired).
+    """
+    lease = conn.execute(
+        'SELECT id, worker FROM leases WHERE job_id = ? AND publication_id = ? AND attempt = ?', (job_id, pub_id, attempt)
+    ).fetchone()
+    if lease is not None:
+        if (lease['id'], lease['worker']) != (lease_id, worker):
+            raise LeaseConflict(f"publication {pub_id} (attempt {attempt}) of job {job_id} is leased to another worker")
+        return
+    job = conn.execute('SELECT repeats FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if job is None or not 0 <= attempt < job['repeats']:
+        raise LeaseConflict(f"publication {pub_id} (attempt {attempt}) is not a slot of job {job_id}")
+    if conn.execute('SELECT 1 FROM publications WHERE id = ?', (pub_id,)).fetchone() is None:
+        raise LeaseConflict(f"unknown publication {pub_id}")
+    if conn.execute(
+        'SELECT 1 FROM reviews WHERE job_id = ? AND publication_id = ? AND attempt = ?', (job_id, pub_id, attempt)
+    ).fetchone() is not None:
+        raise LeaseConflict(f"publication {pub_id} (attempt {attempt}) of job {job_id} is already reviewed")
+
+
+def submit_result(worker: str, lease_id: int, job_id: str, pub_id: int, attempt: int, data: dict) -> bool:
+    """
+    Store the result of a leased item. Results of expired leases are still accepted as long as
+    nobody else leased or filled the slot in the meantime, see `_check_slot`.
+    """
+    # imported here, classify pulls in the ollama client which the web server doesn't need otherwise
+    from webapp.classify import store_review
+
+    conn = get_connection()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        _check_slot(conn, worker, lease_id, job_id, pub_id, attempt)
+        stored = store_review(conn, job_id, pub_id, attempt, data)
+        conn.execute('DELETE FROM leases WHERE id = ? AND worker = ?', (lease_id, worker))
+        clear_retry(conn, job_id, pub_id, attempt)
+        if stored:
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET num_completed = num_completed + 1, time_taken = ? - time_resumed WHERE id = ? AND status = 'RUNNING'",
+                (now, job_id)
+            )
+            conn.execute(
+                'UPDATE jobs SET tokens_saved = tokens_saved + ? WHERE id = ?',
+                (data.get('tokens_saved', 0), job_id)
+            )
+        conn.execute('COMMIT')
+        return stored
+    except:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def fail_item(worker: str, lease_id: int, job_id: str, pub_id: int, attempt: int, error: str, message: str) -> bool:
+    """
+    Record that a leased item failed and release its lease. Returns True if the item got dead-lettered.
+    """
+    conn = get_connection()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        _check_slot(conn, worker, lease_id, job_id, pub_id, attempt)
+        dead = record_failure(conn, job_id, pub_id, attempt, error, message)
+        conn.execute('DELETE FROM leases WHERE id = ? AND worker = ?', (lease_id, worker))
+        conn.execute('COMMIT')
+        return dead
+    except:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def release(worker: str, lease_ids: list[int] | None = None) -> set[str]:
+    """
+    Give up leases (all of the worker's leases if lease_ids is None). Returns the affected job ids.
+    """
+    conn = get_connection()
+    if lease_ids is None:
+        rows = conn.execute('DELETE FROM leases WHERE worker = ? RETURNING job_id', (worker,)).fetchall()
+    else:
+        rows = conn.execute(
+            f"DELETE FROM leases WHERE worker = ? AND id IN ({','.join('?' * len(lease_ids))}) RETURNING job_id",
+            (worker, *lease_ids)
+        ).fetchall()
+    return {row[0] for row in rows}
+
+
+def _prefilter(conn: sqlite3.Connection, job_id: str, pf, rows: list[sqlite3.Row]) -> list[sqlite3.Row]:
+    """
+    Rate the slots the prefilter rejects right away, returns the ones it keeps. Called once per
+    chunk while the queue of the job is filled, so leasing never sees rejected slots.
+    """
+    from webapp.classify import store_review
+
+    kept = []
+    for row in rows:
+        if pf.rejects(row):
+            store_review(conn, job_id, row['id'], row['attempt'], filtered_review(pf, row))
+        else:
+            kept.append(row)
+    if len(kept) < len(rows):
+        conn.execute('UPDATE jobs SET num_completed = num_completed + ? WHERE id = ?', (len(rows) - len(kept), job_id))
+    return kept
+
+
+def _has_pending_retries(conn: sqlite3.Connection, job_id: str) -> bool:
+    return conn.execute('SELECT 1 FROM retries WHERE job_id = ? AND NOT dead LIMIT 1', (job_id,)).fetchone() is not None
+
+
+def _finish_job(conn: sqlite3.Connection, job_id: str):
+    print(f"Completed {job_id}")
+    conn.execute("""
+        UPDATE jobs
+        SET status = 'FINISHED', num_completed = (SELECT COUNT(*) FROM reviews WHERE job_id = ?)
+        WHERE id = ? AND status IN ('RUNNING', 'WAITING')
+    """, (job_id, job_id))
+
+
+class LocalWorkSource:
+    """
+    Work source for workers running next to the database.
+    """
+    def __init__(self, worker: str = WORKER_ID):
+        self.worker = worker
+
+    def lease(self, count: int) -> tuple[dict[str, dict], list[dict]]:
+        return lease_items(self.worker, count)
+
+    def heartbeat(self, lease_ids: list[int]) -> list[int]:
+        return heartbeat(self.worker, lease_ids)
+
+    def submit(self, item: dict, data: dict) -> bool:
+        w = item['work']
+        return submit_result(self.worker, item['lease_id'], item['job_id'], w['id'], w['attempt'], data)
+
+    def fail(self, item: dict, error: str, message: str) -> bool:
+        w = item['work']
+        return fail_item(self.worker, item['lease_id'], item['job_id'], w['id'], w['attempt'], error, message)
+
+    def release(self, lease_ids: list[int] | None = None) -> set[str]:
+        return release(self.worker, lease_ids)
+
+
+class RemoteWorkSource:
+    """
+    Work source for remote workers, talking to the lease API of the web server.
+    """
+    def __init__(self, base_url: str, worker: str = WORKER_ID, token: str | None = None):
+        import httpx
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        self.client = httpx.Client(base_url=base_url, headers=headers, timeout=60)
+        self.worker = worker
+
+    def _post(self, path: str, **body) -> dict:
+        res = self.client.post(path, json={'worker': self.worker, **body})
+        res.raise_for_status()
+        return res.json()
+
+    def lease(self, count: int) -> tuple[dict[str, dict], list[dict]]:
+        res = self._post('/api/lease', count=count)
+        return res['jobs'], res['items']
+
+    def heartbeat(self, lease_ids: list[int]) -> list[int]:
+        return self._post('/api/heartbeat', leases=lease_ids)['lost']
+
+    def submit(self, item: dict, data: dict) -> bool:
+        return self._post('/api/submit', item=item, result=data)['stored']
+
+    def fail(self, item: dict, error: str, message: str) -> bool:
+        return self._post('/api/submit', item=item, error={'type': error, 'message': message})['dead']
+
+    def release(self, lease_ids: list[int] | None = None) -> set[str]:
+        return set(self._post('/api/release', leases=lease_ids)['jobs'])
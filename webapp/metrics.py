@@ -0,0 +1,158 @@
+"""
+Minimal Prometheus-style metrics.
+
+Every process keeps its metrics in memory and periodically flushes a snapshot into the
+`metrics` table, keyed by a per-process source id. The web server renders the sum over
+all sources in the Prometheus text exposition format on `/metrics`.
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from webapp.db import get_connection
+
+# default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# buckets for token throughput histograms, in tokens/s
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# seconds between two flushes of the in-memory registry
+FLUSH_INTERVAL = 5
+# gauges of sources that did not flush for this long are no longer reported
+STALE_AFTER = 300
+
+SOURCE = f'{socket.gethostname()}:{os.getpid()}'
+
+_lock = threading.Lock()
+_counters: dict[tuple[str, str], float] = {}
+_gauges: dict[tuple[str, str], float] = {}
+# (name, labels) -> (bucket bounds, bucket counts, sum, count)
+_histograms: dict[tuple[str, str], tuple[tuple[float, ...], list[int], float, int]] = {}
+_last_flush = 0.0
+
+
+def _key(name: str, labels: dict) -> tuple[str, str]:
+    return name, json.dumps(labels, sort_keys=True)
+
+
+def inc(name: str, value: float = 1, **labels):
+    """
+    Increment a counter.
+    """
+    k = _key(name, labels)
+    with _lock:
+        _counters[k] = _counters.get(k, 0) + value
+
+
+def set_gauge(name: str, value: float, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, buckets: tuple[float, ...] = LATENCY_BUCKETS, **labels):
+    """
+    Record a single observation in a histogram.
+    """
+    k = _key(name, labels)
+    with _lock:
+        bounds, counts, total, count = _histograms.get(k, (buckets, [0] * len(buckets), 0.0, 0))
+        for i, bound in enumerate(bounds):
+            if value <= bound:
+                counts[i] += 1
+        _histograms[k] = (bounds, counts, total + value, count + 1)
+
+
+class timed:
+    """
+    Context manager observing the duration of its body in a histogram.
+    """
+    def __init__(self, name: str, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.t0, **self.labels)
+
+
+def flush(conn: sqlite3.Connection | None = None):
+    """
+    Write a snapshot of this process' metrics into the shared metrics table.
+    """
+    global _last_flush
+    with _lock:
+        now = time.time()
+        rows = [
+            (SOURCE, name, labels, 'counter', json.dumps(v), now) for (name, labels), v in _counters.items()
+        ] + [
+            (SOURCE, name, labels, 'gauge', json.dumps(v), now) for (name, labels), v in _gauges.items()
+        ] + [
+            (SOURCE, name, labels, 'histogram', json.dumps([bounds, counts, total, count]), now)
+            for (name, labels), (bounds, counts, total, count) in _histograms.items()
+        ]
+        _last_flush = now
+
+    conn = conn or get_connection()
+    conn.executemany('INSERT OR REPLACE INTO metrics (source, name, labels, kind, value, updated) VALUES (?,?,?,?,?,?)', rows)
+    conn.commit()
+
+
+def maybe_flush(conn: sqlite3.Connection | None = None):
+    """
+    Flush, but at most once every FLUSH_INTERVAL seconds.
+    """
+    if time.time() - _last_flush >= FLUSH_INTERVAL:
+        flush(conn)
+
+
+def _fmt_labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in sorted(labels.items())) + '}'
+
+
+def render(conn: sqlite3.Connection | None = None) -> str:
+    """
+    Render the metrics of all sources in the Prometheus text format.
+    """
+    conn = conn or get_connection()
+    stale = time.time() - STALE_AFTER
+
+    merged: dict[tuple[str, str], tuple[str, object]] = {}
+    for row in conn.execute('SELECT * FROM metrics ORDER BY name, labels'):
+        if row['kind'] == 'gauge' and row['updated'] < stale:
+            continue
+        k = (row['name'], row['labels'])
+        value = json.loads(row['value'])
+        if k not in merged:
+            merged[k] = (row['kind'], value)
+        elif row['kind'] == 'histogram':
+            bounds, counts, total, count = merged[k][1]
+            merged[k] = ('histogram', [bounds, [a + b for a, b in zip(counts, value[1])], total + value[2], count + value[3]])
+        else:
+            merged[k] = (row['kind'], merged[k][1] + value)
+
+    lines = []
+    typed = set()
+    for (name, labels), (kind, value) in merged.items():
+        if name not in typed:
+            lines.append(f'# TYPE {name} {kind}')
+            typed.add(name)
+        labels = json.loads(labels)
+        if kind == 'histogram':
+            bounds, counts, total, count = value
+            for bound, c in zip(bounds, counts):
+                lines.append(f'{name}_bucket{_fmt_labels(labels, le=bound)} {c}')
+            lines.append(f'{name}_bucket{_fmt_labels(labels, le="+Inf")} {count}')
+            lines.append(f'{name}_sum{_fmt_labels(labels)} {total}')
+            lines.append(f'{name}_count{_fmt_labels(labels)} {count}')
+        else:
+            lines.append(f'{name}{_fmt_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,12 @@
+"""
+Model names and limits that are needed without the client libraries, e.g. by the web server.
+"""
+
+OPENAI_MODELS = (
+    'gpt-5',
+    'gpt-5-mini',
+    'gpt-5-nano',
+)
+
+# upper limit for the number of publications packed into one prompt
+MAX_BATCH_SIZE = 16
@@ -1,19 +1,25 @@
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
 from dataclasses import dataclass
 import tempfile, os, json
+import asyncio
+import itertools
+import multiprocessing
+import math
+import random
+import sqlite3
 import time
 from typing import Generator
 from aalib.progress import progress
 
 
 from webapp.db import get_connection, items_left_in_job
+from webapp.extract import is_result
+from webapp.retries import record_failure, clear_retry
+from webapp import metrics
+from webapp.models import OPENAI_MODELS
 from pydantic import BaseModel
-from openai import OpenAI
-
-OPENAI_MODELS = (
-    'gpt-5',
-    'gpt-5-mini',
-    'gpt-5-nano',
-)
+from openai import OpenAI, AsyncOpenAI, APIStatusError, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
 
 # structure for output
 class ScoringResult(BaseModel):
@@ -27,44 +33,208 @@ class ScoringResult(BaseModel):
     """
 
 
-def build_jsonl_doc(job_id: str, i: int, prompt: str, model: str, elm) -> str:
-    """
-    Build the document for the 
-    """
-    return json.dumps(
-        {
-            "custom_id": f"batch:{job_id}:{elm["id"]}:{i}",
-            "method": "POST",
-            "url": "/v1/chat/completions",
-            "body": {
-                "model": model,
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": prompt,
-                    },
-                    {
-                        "role": "user",
-                        "content": f"title: '{elm["title"]}'\nabstract:\n{elm["abstract"]}"
-                    }
-                ],
-                "response_format": {
-                    "type": "json_schema",
-                    "json_schema": {
-                        "name": "ScoringResult",
-                        "schema": ScoringResult.model_json_schema(),
-                    },
-                },
-                "reasoning_effort": "minimal",
-                "max_completion_tokens": 2000,
+# numbers the batch files of a process, retry rounds must not reuse file names
+_chunk_numbers = itertools.count()
+
+# placeholders for the per-request parts of the request template
+_ID_SLOT = "\x00custom_id\x00"
+_USER_SLOT = "\x00user\x00"
+
+
+@dataclass
+class RequestTemplate:
+    """
+    A batch request line with everything except the custom_id and the publication serialized
+    once per job, and the estimated input tokens of those static parts.
+    """
+    parts: tuple[str, str, str]
+    static_tokens: int
+
+    @classmethod
+    def build(cls, prompt: str, model: str) -> 'RequestTemplate':
+        doc = json.dumps(
+            {
+                "custom_id": _ID_SLOT,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": request_body(prompt, model, _USER_SLOT),
+            }
+        )
+        head, rest = doc.split(json.dumps(_ID_SLOT))
+        middle, tail = rest.split(json.dumps(_USER_SLOT))
+        schema = json.dumps(ScoringResult.model_json_schema())
+        return cls((head, middle, tail), estimate_tokens(prompt) + estimate_tokens(schema) + REQUEST_OVERHEAD_TOKENS)
+
+    def render(self, job_id: str, elm) -> tuple[str, int]:
+        """
+        The request line for a slot, and its estimated input tokens.
+        """
+        head, middle, tail = self.parts
+        user = user_content(elm)
+        line = head + json.dumps(f"batch:{job_id}:{elm['id']}:{elm['attempt']}") + middle + json.dumps(user) + tail
+        return line, self.static_tokens + estimate_tokens(user)
+
+    def estimate(self, elm) -> int:
+        return self.static_tokens + estimate_tokens(user_content(elm))
+
+
+def request_body(prompt: str, model: str, user: str) -> dict:
+    """
+    The chat completion request, for batches and realtime requests alike.
+    """
+    return {
+        "model": model,
+        "messages": [
+            {
+                "role": "system",
+                "content": prompt,
             },
-        }
-    )
+            {
+                "role": "user",
+                "content": user,
+            }
+        ],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "ScoringResult",
+                "schema": ScoringResult.model_json_schema(),
+            },
+        },
+        "reasoning_effort": "minimal",
+        "max_completion_tokens": MAX_COMPLETION_TOKENS,
+    }
+
+
+def user_content(elm) -> str:
+    return f"title: '{elm['title']}'\nabstract:\n{elm['abstract']}"
 
 
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+# hard limits of a single batch file
 CHUNK_LIMIT = 2e8
 CHUNK_ELM_LIMIT = 5000
 
+# OpenAI limits the input tokens enqueued in batches per model (tier 1 values at the time
+# of writing, raise them for higher usage tiers)
+ENQUEUED_TOKEN_LIMITS = {
+    'gpt-5': 1_500_000,
+    'gpt-5-mini': 5_000_000,
+    'gpt-5-nano': 2_000_000,
+}
+# token counts are estimates, leave some room below the limit
+ENQUEUE_HEADROOM = 0.9
+CHARS_PER_TOKEN = 4
+# chat formatting tokens per request
+REQUEST_OVERHEAD_TOKENS = 12
+MAX_COMPLETION_TOKENS = 2000
+
+# requests and tokens per minute for realtime requests (tier 1 values at the time of writing)
+RATE_LIMITS = {
+    'gpt-5': (500, 500_000),
+    'gpt-5-mini': (500, 500_000),
+    'gpt-5-nano': (500, 200_000),
+}
+# jobs that can be done within this many seconds under the rate limits run in realtime mode
+LATENCY_TARGET = 30 * 60
+# realtime requests cost twice as much, larger jobs always go through the batch API
+REALTIME_MAX_REQUESTS = 5000
+REALTIME_CONCURRENCY = 32
+REALTIME_RETRIES = 5
+
+# number of parallel OpenAI API calls for uploads and status requests
+API_THREADS = 8
+# bounds of the adaptive status polling interval, in seconds
+MIN_POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 300
+# jobs without a heartbeat (see touch_jobs) for this long lost their worker and get picked up again
+STALE_AFTER = 3 * MAX_POLL_INTERVAL
+# slots of submitted batches stay reserved for the 24h completion window plus some slack
+BATCH_LEASE_TTL = 26 * 3600
+# lines of a result file parsed per task, each chunk is written in its own transaction on import
+PARSE_CHUNK_LINES = 5000
+# chunks handed to the parser processes ahead of the import, bounds the memory used
+PARSE_WINDOW = 2 * (os.cpu_count() or 1)
+
+
+def process_job(
+    job_id: str,
+    name: str,
+    model: str,
+    prompt: str,
+    repeats: int,
+    update_job_progress,
+):
+    """
+    Run an OpenAI job in batch or realtime mode, see choose_mode. Jobs with submitted batches
+    always continue in batch mode. Failed requests are retried afterwards, see retry_failures.
+    """
+    conn = get_connection()
+    if conn.execute('SELECT 1 FROM openai_batches WHERE job_id = ? AND NOT imported LIMIT 1', (job_id,)).fetchone() is None:
+        template = RequestTemplate.build(prompt, model)
+        requests = tokens = 0
+        for elm in items_left_in_job(job_id, repeats):
+            requests += 1
+            tokens += template.estimate(elm)
+        mode = choose_mode(model, requests, tokens)
+        print(f"{requests} requests, ~{tokens} input tokens, running in {mode} mode")
+    else:
+        mode = 'batch'
+
+    if mode == 'realtime':
+        process_realtime(job_id, model, prompt, list(items_left_in_job(job_id, repeats)), update_job_progress)
+    else:
+        process_batch(job_id, name, model, prompt, repeats, update_job_progress)
+    retry_failures(job_id, model, prompt, update_job_progress)
+
+
+def retry_failures(job_id: str, model: str, prompt: str, update_job_progress):
+    """
+    Send the requests that failed with a retriable error again, in a follow-up batch or in
+    realtime depending on their number, until none are left. Every failure counts against the
+    retry budget of its slot (retries.MAX_TRIES), so this ends.
+    """
+    conn = get_connection()
+    template = RequestTemplate.build(prompt, model)
+    while items := retry_items(conn, job_id):
+        mode = choose_mode(model, len(items), sum(template.estimate(elm) for elm in items))
+        print(f"retrying {len(items)} failed requests in {mode} mode")
+        offset = conn.execute('SELECT COUNT(*) FROM reviews WHERE job_id = ?', (job_id,)).fetchone()[0]
+        if mode == 'realtime':
+            process_realtime(job_id, model, prompt, items, update_job_progress, offset)
+        else:
+            with tempfile.TemporaryDirectory(prefix="oai-batch-") as dir:
+                client = OpenAI()
+                batch_ids = run_batches(client, dir, job_id, model, template, items, update_job_progress, offset)
+                add_batch_price(conn, job_id, total_batch_price(client, model, batch_ids))
+
+
+def retry_items(conn: sqlite3.Connection, job_id: str) -> list[sqlite3.Row]:
+    """
+    Slots of a job waiting for a retry that are not part of a running batch.
+    """
+    return conn.execute("""
+        SELECT p.*, f.attempt AS attempt FROM retries AS f JOIN publications AS p ON p.id = f.publication_id
+        WHERE f.job_id = :job_id AND NOT f.dead
+        AND NOT EXISTS (SELECT 1 FROM leases AS l WHERE l.job_id = :job_id AND l.publication_id = f.publication_id AND l.attempt = f.attempt)
+        ORDER BY f.publication_id, f.attempt
+    """, {'job_id': job_id}).fetchall()
+
+
+def choose_mode(model: str, requests: int, tokens: int, latency_target: float = LATENCY_TARGET) -> str:
+    """
+    'realtime' if the requests can be done within the latency target under the model's rate
+    limits, 'batch' otherwise. Rate limits count the completion tokens a request may use.
+    """
+    if requests == 0 or requests > REALTIME_MAX_REQUESTS:
+        return 'batch'
+    rpm, tpm = RATE_LIMITS.get(model, min(RATE_LIMITS.values()))
+    minutes = max(requests / rpm, (tokens + requests * MAX_COMPLETION_TOKENS) / tpm)
+    return 'realtime' if minutes * 60 <= latency_target else 'batch'
+
 
 def process_batch(
     job_id: str,
@@ -74,81 +244,354 @@ def process_batch(
     repeats: int,
     update_job_progress,
 ):
-    with tempfile.TemporaryDirectory(prefix="oai-batch-") as dir:
-        # state vars
-        chunk_num = 0
-        chunk_size = 0
-        chunk_elems = 0
-        # chunk file vars
-        chunk_name = f"batch-{job_id}-{chunk_num}.jsonl"
-        chunk_files = [chunk_name]
-        chunk_file = open(os.path.join(dir, chunk_name), "w")
-        # write chunks to disk:
-        for i, elm in enumerate(items_left_in_job(job_id, repeats)):
-            doc = build_jsonl_doc(job_id, i, prompt, model, elm)
-
-            # make new chunk if chunk is full
-            if (
-                len(doc.encode()) + chunk_size > CHUNK_LIMIT
-                or chunk_elems >= CHUNK_ELM_LIMIT
-            ):
-                chunk_file.close()
-                chunk_num += 1
-                chunk_name = f"batch-{job_id}-{chunk_num}.jsonl"
-                chunk_files.append(chunk_name)
-                chunk_file = open(os.path.join(dir, chunk_name), "w")
-                chunk_size = 0
-                chunk_elems = 0
-            # use print to add newlines
-            print(doc, file=chunk_file)
-            chunk_size += len(doc.encode())
-            chunk_elems += 1
-        # close last file
-        chunk_file.close()
-
-        print(f"created batch files: {chunk_files}")
+    # batches launched before a restart are monitored again instead of being re-submitted,
+    # their slots are leased and thus not part of items_left_in_job
+    conn = get_connection()
+    reattached = conn.execute('SELECT id, requests, tokens FROM openai_batches WHERE job_id = ? AND NOT imported ORDER BY created', (job_id,)).fetchall()
+    if reattached:
+        print(f"reattaching to batches: {[row['id'] for row in reattached]}")
 
+    with tempfile.TemporaryDirectory(prefix="oai-batch-") as dir:
         # create openai client
         client = OpenAI()
+        template = RequestTemplate.build(prompt, model)
+        batch_ids = run_batches(client, dir, job_id, model, template, items_left_in_job(job_id, repeats), update_job_progress, reattached=reattached)
+
+        # print batch costs to stdout
+        print(f'batch cost:', price := total_batch_price(client, model, batch_ids), sep=" ")
+        add_batch_price(conn, job_id, price)
+
+
+def add_batch_price(conn: sqlite3.Connection, job_id: str, price: 'BatchPrice'):
+    # use coalesce(x + ?, ?) to increment or set in case of NULL value
+    conn.execute('UPDATE jobs SET total_price = coalesce(total_price + ?, ?) WHERE id = ?', (price.total(), price.total(), job_id))
 
-        t0 = time.time()
-        # launch and monitor batches now:
-        batch_ids = [launch_batch(client, dir, chunk) for chunk in chunk_files]
 
-        print(f"launched batches: {batch_ids}")
+def run_batches(
+    client: OpenAI,
+    dir: str,
+    job_id: str,
+    model: str,
+    template: 'RequestTemplate',
+    items,
+    update_job_progress,
+    offset: int = 0,
+    reattached: list[sqlite3.Row] = (),
+) -> list[str]:
+    """
+    Submit the items as token-balanced batches, monitor them alongside the reattached batches
+    and import their results. Returns the ids of all batches.
+    """
+    token_limit = ENQUEUED_TOKEN_LIMITS.get(model, min(ENQUEUED_TOKEN_LIMITS.values())) * ENQUEUE_HEADROOM
+    batch_ids = [row['id'] for row in reattached]
+
+    # serialize every request once into a spool file, the chunks are cut from it once planned
+    spool_name = os.path.join(dir, "spool.jsonl")
+    slots, tokens, sizes = [], [], []
+    with open(spool_name, "wb") as spool:
+        for elm in items:
+            line, estimate = template.render(job_id, elm)
+            data = line.encode() + b"\n"
+            spool.write(data)
+            slots.append((elm['id'], elm['attempt']))
+            tokens.append(estimate)
+            sizes.append(len(data))
+
+    # (file, slots, estimated tokens) per chunk
+    chunks = []
+    with open(spool_name, "rb") as spool:
+        start = 0
+        for count in plan_chunks(tokens, sizes, token_limit):
+            chunk_name = f"batch-{job_id}-{next(_chunk_numbers)}.jsonl"
+            with open(os.path.join(dir, chunk_name), "wb") as chunk_file:
+                chunk_file.write(spool.read(sum(sizes[start:start + count])))
+            chunks.append((chunk_name, slots[start:start + count], sum(tokens[start:start + count])))
+            start += count
+    os.remove(spool_name)
+
+    print(f"created batch files: {[(chunk, f'~{estimate} tokens') for chunk, _, estimate in chunks]}")
+
+    t0 = time.time()
+    # upload and launch chunks in parallel, each batch is recorded right after its launch
+    def launch(chunk, slots, estimate):
+        batch = launch_batch(client, dir, chunk)
+        record_batch(job_id, batch, slots, estimate)
+        return batch.id
+
+    # chunks that don't fit into the queue together are launched in waves, the
+    # first wave shares the queue with the reattached batches
+    pending = list(batch_ids)
+    for wave in plan_waves([estimate for *_, estimate in chunks], token_limit, sum(row['tokens'] or 0 for row in reattached)):
+        with ThreadPoolExecutor(API_THREADS) as pool:
+            launched = list(pool.map(lambda i: launch(*chunks[i]), wave))
+        batch_ids += launched
+
+        print(f"launched batches: {launched}")
         print("=" * 60)
 
-        # check progress:
-        remaining_batches = set(batch_ids)
-        while remaining_batches:
-            time.sleep(30)
+        monitor_batches(client, pending + launched, update_job_progress, job_id, t0, offset)
+        offset += sum(len(chunks[i][1]) for i in wave) + sum(row['requests'] for row in reattached if row['id'] in pending)
+        pending = []
+    return batch_ids
+
+
+def plan_chunks(tokens: list[int], sizes: list[int], token_limit: float) -> list[int]:
+    """
+    Split requests, in order, into as few chunks as the token, size and line limits allow, with
+    about the same number of tokens each so they finish at about the same time.
+    Returns the number of requests per chunk.
+    """
+    if not tokens:
+        return []
+    total = sum(tokens)
+    count = max(
+        math.ceil(total / token_limit),
+        math.ceil(len(tokens) / CHUNK_ELM_LIMIT),
+        math.ceil(sum(sizes) / CHUNK_LIMIT),
+    )
+
+    lengths = []
+    planned = 0
+    n = chunk_tokens = chunk_size = 0
+    for t, size in zip(tokens, sizes):
+        # spread the tokens not yet planned evenly over the remaining chunks
+        target = (total - planned) / (count - len(lengths)) if len(lengths) < count else math.inf
+        if n and (
+            chunk_tokens + t > token_limit
+            or chunk_size + size > CHUNK_LIMIT
+            or n >= CHUNK_ELM_LIMIT
+            # cut at the request closest to the balanced size
+            or chunk_tokens + t / 2 > target
+        ):
+            lengths.append(n)
+            planned += chunk_tokens
+            n = chunk_tokens = chunk_size = 0
+        n += 1
+        chunk_tokens += t
+        chunk_size += size
+    lengths.append(n)
+    return lengths
+
+
+def plan_waves(chunk_tokens: list[int], token_limit: float, enqueued: int = 0) -> list[list[int]]:
+    """
+    Group consecutive chunks (by index) into waves that fit into the enqueued token limit together.
+    The first wave shares the limit with `enqueued` tokens of batches that are already running,
+    and may be empty if they take up all of it.
+    """
+    waves = [[]]
+    used = enqueued
+    for i, t in enumerate(chunk_tokens):
+        if used and used + t > token_limit:
+            waves.append([])
+            used = 0
+        waves[-1].append(i)
+        used += t
+    return waves
+
+
+def monitor_batches(client: OpenAI, batch_ids: list[str], update_job_progress = None, job_id = None, t0 = None, offset: int = 0):
+    """
+    Poll the batches until all of them are done. Every batch is imported as soon as it is done,
+    in the background while the remaining ones are polled. `offset` requests of the job were
+    finished before these batches.
+    """
+    # status of the batches that are done, they don't need to be polled again
+    done: dict[str, BatchStatus] = {}
+    imports: list[Future] = []
+    interval = MIN_POLL_INTERVAL
+    last_poll = None
+    with ThreadPoolExecutor(1, thread_name_prefix='batch-import') as importer:
+        while len(done) < len(batch_ids):
+            time.sleep(interval)
+
+            polled = get_batch_status(client, [b for b in batch_ids if b not in done])
+            status = list(done.values()) + polled
+            conn = get_connection()
+            conn.executemany(
+                'UPDATE openai_batches SET status = ?, updated = ? WHERE id = ?',
+                [(s.completion_state, time.time(), s.id) for s in polled]
+            )
+            touch_jobs(conn, batch_ids)
+            report_batch_status(status, update_job_progress, job_id, t0, offset)
 
-            # get list of completed batches
-            status = print_batch_status(client, batch_ids, update_job_progress, job_id, t0)
+            for s in polled:
+                if s.is_done:
+                    done[s.id] = s
+                    imports.append(importer.submit(import_batch_results, client, [s.id], s.completed))
 
-            # keep just the ones that are actually remaining to be imported
-            new_batches = [batch for batch in status if batch in remaining_batches]
+            finished = sum(s.completed + s.failed for s in status)
+            total = sum(s.total for s in status)
+            now = time.time()
+            rate = (finished - last_poll[1]) / (now - last_poll[0]) if last_poll else 0
+            last_poll = (now, finished)
+            interval = next_poll_interval(interval, total - finished, rate, any(s.completion_state == 'finalizing' for s in status))
 
-            # if any new batches are here, import them
-            if new_batches:
-                import_batch_results(client, new_batches)            
-                # and remove them from the remaining batch list
-                remaining_batches.difference_update(new_batches)
+        # surface import errors
+        for f in imports:
+            f.result()
 
-        # print batch costs to stdout
-        print(f'batch cost:', price := total_batch_price(client, model, batch_ids), sep=" ")
 
-        # write total price to db
-        conn = get_connection()
-        # use coalesce(x + ?, ?) to increment or set in case of NULL value
-        conn.execute('UPDATE jobs SET total_price = coalesce(total_price + ?, ?) WHERE job_id = ?', (price.total(), price.total(), job_id))
+def process_realtime(job_id: str, model: str, prompt: str, items: list, update_job_progress, offset: int = 0):
+    """
+    Classify the items with concurrent chat completion requests, every review is stored as soon
+    as it arrives. Failed requests go into the retry queue.
+    """
+    print(f"starting {len(items)} realtime requests")
+    done, failed = asyncio.run(_run_realtime(job_id, model, prompt, items, update_job_progress, offset))
+    print(f"realtime requests done: {done} stored, {failed} failed")
 
 
+async def _run_realtime(job_id: str, model: str, prompt: str, items: list, update_job_progress, offset: int) -> tuple[int, int]:
+    client = AsyncOpenAI(max_retries=0)
+    limiter = RateLimiter(*RATE_LIMITS.get(model, min(RATE_LIMITS.values())))
+    template = RequestTemplate.build(prompt, model)
+    semaphore = asyncio.Semaphore(REALTIME_CONCURRENCY)
+    conn = get_connection()
+    t0 = time.time()
+    done = failed = 0
 
-def launch_batch(client: OpenAI, base_dir: str, batch_file: str) -> str:
+    async def run(elm):
+        nonlocal done, failed
+        custom_id = f"realtime:{job_id}:{elm['id']}:{elm['attempt']}"
+        async with semaphore:
+            try:
+                response = await complete_realtime(client, limiter, request_body(prompt, model, user_content(elm)), template.estimate(elm))
+                res = result_from_body(custom_id, response.model_dump())
+            except Exception as e:
+                error, retriable = realtime_failure(e)
+                print(f"realtime request {custom_id} failed: {error}: {e}")
+                record_failure(conn, job_id, elm['id'], elm['attempt'], error, str(e), permanent=not retriable)
+                metrics.inc('openai_requests_failed_total', mode='realtime', error=error)
+                failed += 1
+                return
+        row = review_row(res, model, batch=False)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # batches add their price to the job after the import, realtime requests as they arrive
+                if conn.execute(REVIEW_INSERT, row).rowcount:
+                    conn.execute('UPDATE jobs SET total_price = coalesce(total_price + ?, ?) WHERE id = ?', (row[-1], row[-1], job_id))
+                clear_retry(conn, job_id, elm['id'], elm['attempt'])
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            # the other requests are in flight and paid for, only this one is lost
+            print(f"unable to store realtime result {custom_id}: {e}")
+            try:
+                record_failure(conn, job_id, elm['id'], elm['attempt'], 'database_error', str(e))
+            except sqlite3.Error as e:
+                print(f"unable to record failure of {custom_id}: {e}")
+            metrics.inc('openai_requests_failed_total', mode='realtime', error='database_error')
+            failed += 1
+            return
+        metrics.inc('realtime_requests_total', model=model)
+        done += 1
+        if update_job_progress:
+            update_job_progress(job_id, offset + done + failed, time.time() - t0)
+
+    try:
+        await asyncio.gather(*(run(elm) for elm in items))
+    finally:
+        await client.close()
+    return done, failed
+
+
+def realtime_failure(ex: Exception) -> tuple[str, bool]:
+    """
+    Error code of a failed realtime request, and whether it is worth retrying.
+    """
+    if isinstance(ex, APIStatusError):
+        return ex.code or type(ex).__name__, is_retriable(ex.status_code, ex.code)
+    if isinstance(ex, ValueError):
+        return 'malformed_output', True
+    return type(ex).__name__, True
+
+
+# error codes of requests that fail the same way when they are sent again
+PERMANENT_ERRORS = {
+    'invalid_request_error',
+    'context_length_exceeded',
+    'invalid_prompt',
+    'content_filter',
+    'model_not_found',
+    'insufficient_quota',
+}
+
+
+def is_retriable(status_code: int | None, code: str | None) -> bool:
+    """
+    Rate limits, server errors, timeouts and expired batches are retried, invalid requests are not.
+    """
+    if code in PERMANENT_ERRORS:
+        return False
+    if status_code is not None and 400 <= status_code < 500 and status_code not in (408, 409, 429):
+        return False
+    return True
+
+
+async def complete_realtime(client: AsyncOpenAI, limiter: 'RateLimiter', body: dict, tokens: int):
+    """
+    Send a chat completion request within the rate limits, retrying rate limit, connection and
+    server errors with exponential backoff.
+    """
+    for attempt in range(REALTIME_RETRIES + 1):
+        await limiter.acquire(tokens + body['max_completion_tokens'])
+        try:
+            return await client.chat.completions.create(**body)
+        except (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError) as e:
+            if attempt == REALTIME_RETRIES:
+                raise
+            delay = min(2 ** attempt, 60) * random.uniform(1, 2)
+            metrics.inc('realtime_retries_total', error=type(e).__name__)
+            print(f"{type(e).__name__}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+class RateLimiter:
+    """
+    Requests and tokens per minute, over a sliding window of one minute.
+    """
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.tokens = 0
+        self.events: deque[tuple[float, int]] = deque()
+
+    async def acquire(self, tokens: int):
+        # a single request above the token limit would wait forever
+        tokens = min(tokens, self.tpm)
+        while True:
+            now = time.monotonic()
+            while self.events and self.events[0][0] <= now - 60:
+                self.tokens -= self.events.popleft()[1]
+            if len(self.events) < self.rpm and self.tokens + tokens <= self.tpm:
+                self.events.append((now, tokens))
+                self.tokens += tokens
+                return
+            await asyncio.sleep(self.events[0][0] + 60 - now)
+
+
+def next_poll_interval(interval: float, remaining: int, rate: float, finalizing: bool) -> float:
+    """
+    Poll often when batches are about to finish, and back off while nothing happens.
+    """
+    if finalizing:
+        return MIN_POLL_INTERVAL
+    if rate > 0:
+        # aim for about ten polls over the expected remaining time
+        interval = remaining / rate / 10
+    else:
+        interval *= 2
+    return min(max(interval, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL)
+
+
+def launch_batch(client: OpenAI, base_dir: str, batch_file: str):
     """
     Uploads the batch file to OpenAI and creates a batch job.
-    Returns the batch id.
+    Returns the batch.
     """
     # Upload the JSONL file first
     file_path = os.path.join(base_dir, batch_file)
@@ -162,7 +605,31 @@ def launch_batch(client: OpenAI, base_dir: str, batch_file: str) -> str:
         completion_window="24h",  # batches must have a window (1h, 24h)
     )
 
-    return batch.id
+    return batch
+
+
+def record_batch(job_id: str, batch, slots: list[tuple[int, int]], tokens: int | None = None):
+    """
+    Persist a launched batch and lease its slots to it, so that a restarted worker
+    reattaches to the batch instead of submitting the slots again.
+    """
+    conn = get_connection()
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(
+            'INSERT INTO openai_batches (id, job_id, input_file_id, requests, tokens, status, created, updated) VALUES (?,?,?,?,?,?,?,?)',
+            (batch.id, job_id, batch.input_file_id, len(slots), tokens, batch.status, now, now)
+        )
+        conn.executemany(
+            'INSERT OR REPLACE INTO leases (job_id, publication_id, attempt, worker, expires) VALUES (?,?,?,?,?)',
+            [(job_id, pub_id, attempt, f'openai:{batch.id}', now + BATCH_LEASE_TTL) for pub_id, attempt in slots]
+        )
+        conn.execute('UPDATE jobs SET heartbeat = ? WHERE id = ?', (now, job_id))
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
 
 
 @dataclass
@@ -180,40 +647,41 @@ def get_batch_status(client: OpenAI, batches: list[str]) -> list[BatchStatus]:
     Get the status from OpenAI for a list of batch IDs.
     Returns a list of BatchStatus objects with counts and completion flag.
     """
-    results: list[BatchStatus] = []
-
-    for batch_id in batches:
-        batch = client.batches.retrieve(batch_id)
-
-        total = batch.request_counts.total or 0
-        completed = batch.request_counts.completed or 0
-        failed = batch.request_counts.failed or 0
-
-        # Track the raw completion state
-        state = batch.status
-        is_done = state in ("completed", "failed", "expired", "cancelled")
-
-        results.append(
-            BatchStatus(
-                id=batch.id,
-                total=total,
-                completed=completed,
-                failed=failed,
-                is_done=is_done,
-                completion_state=state,
-            )
-        )
-
-    return results
+    with ThreadPoolExecutor(API_THREADS) as pool:
+        return list(pool.map(lambda batch_id: _batch_status(client.batches.retrieve(batch_id)), batches))
+
+
+def _batch_status(batch) -> BatchStatus:
+    total = batch.request_counts.total or 0
+    completed = batch.request_counts.completed or 0
+    failed = batch.request_counts.failed or 0
+
+    # Track the raw completion state
+    state = batch.status
+    is_done = state in ("completed", "failed", "expired", "cancelled")
+
+    return BatchStatus(
+        id=batch.id,
+        total=total,
+        completed=completed,
+        failed=failed,
+        is_done=is_done,
+        completion_state=state,
+    )
 
 @dataclass
 class ClassificationResult:
     job_id: str
-    elm_id: str
+    elm_id: int
+    attempt: int
+    custom_id: str
     completion_time: float
     score: int
     reason: str
-    token_usage: dict
+    input_tokens: int
+    cached_tokens: int
+    output_tokens: int
+    reasoning_tokens: int
 
 
 def print_batch_status(client: OpenAI, batch_ids: list[str], update_job_progress = None, job_id = None, t0 = None) -> list[str]:
@@ -221,11 +689,21 @@ def print_batch_status(client: OpenAI, batch_ids: list[str], update_job_progress
     print batch statuses and return list of finished batch ids
     """
     status = get_batch_status(client, batch_ids)
+    report_batch_status(status, update_job_progress, job_id, t0)
+    return [s.id for s in status if s.is_done]
+
 
+def report_batch_status(status: list[BatchStatus], update_job_progress = None, job_id = None, t0 = None, offset: int = 0):
     total = sum(s.total for s in status)
     completed = sum(s.completed for s in status)
     failed = sum(s.failed for s in status)
 
+    for s in status:
+        metrics.inc('batch_polls_total', state=s.completion_state)
+    metrics.set_gauge('batch_requests', completed, state='completed')
+    metrics.set_gauge('batch_requests', failed, state='failed')
+    metrics.set_gauge('batch_requests', total - completed - failed, state='pending')
+
     # Build a per-batch breakdown
     batch_lines = []
     for s in status:
@@ -241,115 +719,242 @@ def print_batch_status(client: OpenAI, batch_ids: list[str], update_job_progress
     print("=" * 60)
 
     if update_job_progress:
-        update_job_progress(job_id, completed + failed, time.time() - t0)
+        update_job_progress(job_id, offset + completed + failed, time.time() - t0)
 
-    return [s.id for s in status if s.is_done]
-
-def parse_batch_results(client: OpenAI, batch_ids: list[str]) -> Generator[ClassificationResult, None, None]:
+def parse_batch_results(client: OpenAI, batch_ids: list[str]) -> Generator[tuple[list[ClassificationResult], list[tuple]], None, None]:
     """
-    Download completed batch results and return a list of ClassificationResult objects.
-    Uses the 'created' field as completion_time and 'usage.total_tokens' for tokens_used.
-    Prints errors for malformed lines or missing fields.
+    Download the output and error files of finished batches and yield them in chunks of
+    ClassificationResult objects and failures (custom_id, error, message, retriable).
+    Files are streamed to a spool file first and parsed in a process pool, with at most
+    PARSE_WINDOW chunks read ahead. The pool spawns its processes, forking this multi-threaded
+    process could deadlock on a lock held by another thread.
     """
-    for batch_id in batch_ids:
-        batch = client.batches.retrieve(batch_id)
+    with tempfile.TemporaryDirectory(prefix="oai-import-") as dir, ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn')) as pool:
+        for batch_id in batch_ids:
+            batch = client.batches.retrieve(batch_id)
 
-        if batch.status != "completed":
-            print(f"Skipping batch {batch_id}: not completed (status={batch.status})")
+            # expired and cancelled batches still have results for the requests they completed
+            if batch.status not in ("completed", "expired", "cancelled", "failed"):
+                print(f"Skipping batch {batch_id}: not completed (status={batch.status})")
+                continue
+
+            if batch.output_file_id is None:
+                print(f"Batch {batch_id} has no output file (status={batch.status})")
+
+            for file_id, parse in ((batch.output_file_id, parse_result_lines), (batch.error_file_id, parse_error_lines)):
+                if file_id is None:
+                    continue
+                path = os.path.join(dir, f"{file_id}.jsonl")
+                with client.files.with_streaming_response.content(file_id) as response:
+                    response.stream_to_file(path)
+
+                with open(path) as f:
+                    pending = deque()
+                    for first_idx in itertools.count(1, PARSE_CHUNK_LINES):
+                        lines = list(itertools.islice(f, PARSE_CHUNK_LINES))
+                        if not lines:
+                            break
+                        pending.append(pool.submit(parse, batch_id, first_idx, lines))
+                        if len(pending) >= PARSE_WINDOW:
+                            yield pending.popleft().result()
+                    while pending:
+                        yield pending.popleft().result()
+                os.remove(path)
+
+
+def parse_result_lines(batch_id: str, first_idx: int, lines: list[str]) -> tuple[list[ClassificationResult], list[tuple]]:
+    """
+    Parse a chunk of lines of a batch output file, idx is the line number of the first line.
+    Requests with unusable output are returned as failures.
+    """
+    results = []
+    failures = []
+    for idx, line in enumerate(lines, first_idx):
+        if not line.strip():
             continue
 
-        file_id = batch.output_file_id
+        try:
+            data = json.loads(line)
+        except json.JSONDecodeError as e:
+            print(f"JSON decode error in batch {batch_id}, line {idx}: {e}")
+            continue
 
-        if file_id is None:
-            print(f"Batch {batch_id} has no output file, skipped")
-            continue 
+        try:
+            results.append(result_from_body(data.get("custom_id"), data["response"]["body"]))
+        except (KeyError, TypeError):
+            print(f"Missing response body in batch {batch_id}, line {idx}")
+            failures.append((data.get("custom_id"), 'missing_response', None, True))
+        except ValueError as e:
+            print(f"{e} in batch {batch_id}, line {idx}")
+            failures.append((data.get("custom_id"), 'malformed_output', str(e), True))
+    return results, failures
 
-        for idx, line in enumerate(client.files.content(file_id).iter_lines(), 1):
-            if not line.strip():
-                continue
 
-            try:
-                data = json.loads(line)
-            except json.JSONDecodeError as e:
-                print(f"JSON decode error in batch {batch_id}, line {idx}: {e}")
-                continue
+def parse_error_lines(batch_id: str, first_idx: int, lines: list[str]) -> tuple[list[ClassificationResult], list[tuple]]:
+    """
+    Parse a chunk of lines of a batch error file into failures.
+    """
+    failures = []
+    for idx, line in enumerate(lines, first_idx):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except json.JSONDecodeError as e:
+            print(f"JSON decode error in error file of batch {batch_id}, line {idx}: {e}")
+            continue
 
-            custom_id = data.get("custom_id")
-            if not custom_id:
-                print(f"Missing custom_id in batch {batch_id}, line {idx}")
-                continue
+        # either the request got an error response, or it was never run (e.g. batch_expired)
+        response = data.get("response") or {}
+        error = data.get("error") or ((response.get("body") or {}).get("error")) or {}
+        status_code = response.get("status_code")
+        code = error.get("code") or error.get("type") or (f"http_{status_code}" if status_code else "unknown")
+        failures.append((data.get("custom_id"), code, error.get("message"), is_retriable(status_code, code)))
+    return [], failures
 
-            try:
-                _, job_id, elm_id, _ = custom_id.split(":")
-            except ValueError:
-                print(f"Malformed custom_id '{custom_id}' in batch {batch_id}, line {idx}")
-                continue
 
-            response_body = None
-            try:
-                response_body = data["response"]["body"]
-            except KeyError:
-                print(f"Missing response body in batch {batch_id}, line {idx}")
-                continue
+def result_from_body(custom_id: str, body: dict) -> ClassificationResult:
+    """
+    Read the review from a chat completion response body. Raises ValueError if the
+    custom_id or the output is unusable.
+    """
+    try:
+        _, job_id, elm_id, attempt = custom_id.split(":")
+        elm_id, attempt = int(elm_id), int(attempt)
+    except (AttributeError, ValueError):
+        raise ValueError(f"Malformed custom_id '{custom_id}'")
+
+    # Extract usage tokens
+    input_tokens, cached_tokens, output_tokens, reasoning_tokens = token_counts(body.get("usage"))
+
+    # Extract structured output
+    output = (body.get("choices") or [{}])[0].get('message', {}).get('content')
+    if not output:
+        raise ValueError(f"Missing output for {custom_id}")
+
+    try:
+        output = json.loads(output)
+    except json.JSONDecodeError:
+        raise ValueError(f"Malformed json: {output} for {custom_id}")
+
+    if not is_result(output):
+        raise ValueError(f"Invalid output for {custom_id}: {output}")
+    score, reason = output['score'], output['reason']
+
+    return ClassificationResult(
+        job_id=job_id,
+        elm_id=elm_id,
+        attempt=attempt,
+        custom_id=custom_id,
+        completion_time=body.get("created") or 0,
+        score=score,
+        reason=reason,
+        input_tokens=input_tokens,
+        cached_tokens=cached_tokens,
+        output_tokens=output_tokens,
+        reasoning_tokens=reasoning_tokens,
+    )
 
-            # Extract completion timestamp
-            completion_time = response_body.get("created")
-            if completion_time is None:
-                print(f"Missing 'created' timestamp in batch {batch_id}, line {idx}")
-                completion_time = 0
 
-            # Extract usage tokens
-            usage = response_body.get("usage", {})
+REVIEW_INSERT = 'INSERT OR IGNORE INTO reviews (publication_id, job_id, created, rating, reason, attempt, origin, input_tokens, cached_tokens, output_tokens, reasoning_tokens, cost) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)'
 
-            # Extract structured output
-            output = response_body.get("choices", [{}])[0].get('message', {}).get('content')
-            if not output:
-                print(f"Missing output in batch {batch_id}, line {idx}")
-                continue
 
-            try:
-                output = json.loads(output)
-            except json.JSONDecodeError:
-                print(f"Malformed json: {output} on request {line} (line {idx})")
-                continue
+def review_row(res: ClassificationResult, model: str, batch: bool) -> tuple:
+    """
+    Parameters of REVIEW_INSERT for a result.
+    """
+    return (
+        res.elm_id, res.job_id, res.completion_time, res.score, res.reason, res.attempt, res.custom_id,
+        res.input_tokens, res.cached_tokens, res.output_tokens, res.reasoning_tokens,
+        token_price(model, res.input_tokens, res.cached_tokens, res.output_tokens, batch).total(),
+    )
 
-            score = output.get("score", None)
-            reason = output.get("reason", None)
-            if score is None or reason is None:
-                print(f"Incomplete output in batch {batch_id}, line {idx}: {output}")
-                continue
 
-            yield ClassificationResult(
-                job_id=job_id,
-                elm_id=elm_id,
-                completion_time=completion_time,
-                score=score,
-                reason=reason,
-                token_usage=usage,
-            )
+def import_batch_results(client: OpenAI, batch_ids: list[str], ttl: int | None = None):
+    """
+    Import the results of finished batches. Reviews are keyed by their custom_id (and slot), so
+    importing a batch twice does not create duplicates.
 
+    Slots of the batches that got no review are put into the retry queue, with the error from the
+    batch's error file if there is one.
 
-def import_batch_results(client: OpenAI, batch_ids: list[str]):
-    count = 0
-    ttl = sum(b.completed for b in get_batch_status(client, batch_ids))
+    Nothing is downloaded while a write transaction is open: the batch states are fetched up front
+    and every parsed chunk is written in its own short transaction, so the polling thread and the
+    workers submitting ollama results don't time out waiting for the database.
+    """
+    batches = get_batch_status(client, batch_ids)
+    status = {b.id: b.completion_state for b in batches}
+    if ttl is None:
+        ttl = sum(b.completed for b in batches)
     print("starting import")
     conn = get_connection()
-    for res in progress(parse_batch_results(client, batch_ids), count=ttl):
-        conn.execute('INSERT INTO reviews (publication_id, job_id, created, rating, reason, raw_data) VALUES (?,?,?,?,?,?)', (
-            res.elm_id,
-            res.job_id,
-            res.completion_time,
-            res.score,
-            res.reason,
-            json.dumps(res.token_usage)
-        ))
-        count += 1
-        if count >= 1000:
-            count = 0
-            conn.commit()
-    conn.commit()
+    models = dict(conn.execute('SELECT id, model FROM jobs').fetchall())
+    failures = {}
+    for results, failed in progress(parse_batch_results(client, batch_ids), count=math.ceil(ttl / PARSE_CHUNK_LINES)):
+        failures.update((custom_id, rest) for custom_id, *rest in failed)
+        if not results:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(REVIEW_INSERT, [review_row(res, models.get(res.job_id), batch=True) for res in results])
+            conn.executemany(
+                'DELETE FROM retries WHERE job_id = ? AND publication_id = ? AND attempt = ?',
+                [(res.job_id, res.elm_id, res.attempt) for res in results]
+            )
+            # a long import keeps the job from looking abandoned while nothing is polled
+            touch_jobs(conn, batch_ids)
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for batch_id in batch_ids:
+            record_batch_failures(conn, batch_id, status[batch_id], failures)
+        # the slots of items without result are free again
+        conn.executemany('UPDATE openai_batches SET imported = true WHERE id = ?', [(b,) for b in batch_ids])
+        conn.executemany('DELETE FROM leases WHERE worker = ?', [(f'openai:{b}',) for b in batch_ids])
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
     print("Completed!")
 
+
+def touch_jobs(conn: sqlite3.Connection, batch_ids: list[str]):
+    """
+    Record a heartbeat on the jobs of the batches, the liveness signal of the worker running
+    them. Jobs without one for STALE_AFTER seconds are claimed again, see Runner._claim_next_job.
+    """
+    conn.execute(
+        f'UPDATE jobs SET heartbeat = ? WHERE id IN (SELECT job_id FROM openai_batches WHERE id IN ({",".join("?" * len(batch_ids))}))',
+        (time.time(), *batch_ids)
+    )
+
+
+def record_batch_failures(conn: sqlite3.Connection, batch_id: str, status: str, failures: dict[str, list]):
+    """
+    Put the slots of a batch without review into the retry queue, `status` is the final state of the batch.
+    """
+    missing = conn.execute("""
+        SELECT l.job_id, l.publication_id, l.attempt FROM leases AS l
+        WHERE l.worker = ? AND NOT EXISTS (
+            SELECT 1 FROM reviews AS r WHERE r.job_id = l.job_id AND r.publication_id = l.publication_id AND r.attempt = l.attempt
+        )
+    """, (f'openai:{batch_id}',)).fetchall()
+    if not missing:
+        return
+    # requests of failed batches never ran, those of completed ones should all have a line somewhere
+    default = (f'batch_{status}', None, True) if status != 'completed' else ('missing_result', None, True)
+    given_up = 0
+    for job_id, pub_id, attempt in missing:
+        error, message, retriable = failures.get(f'batch:{job_id}:{pub_id}:{attempt}', default)
+        given_up += record_failure(conn, job_id, pub_id, attempt, error, message, permanent=not retriable)
+        metrics.inc('openai_requests_failed_total', mode='batch', error=error)
+    print(f"{len(missing)} requests of batch {batch_id} failed, {given_up} of them given up on")
+
+
 # prices per 1m tokens
 PRICES = {
     'gpt-5-nano': {
@@ -403,21 +1008,44 @@ class BatchPrice:
     def __str__(self):
         return f'${self.total():.2f} (${self.input:.4f} in, ${self.output:.4f} out, ${self.in_cached:.4f} cached)'
 
-def calculate_price(model: str, usage: dict, batch: bool) -> BatchPrice:
-    price = PRICES.get(model)
+def token_counts(usage) -> tuple[int, int, int, int]:
+    """
+    Input, cached, output and reasoning tokens of a usage object. Chat completions report
+    prompt/completion tokens, batches and the responses API input/output tokens.
+    """
+    if hasattr(usage, 'model_dump'):
+        usage = usage.model_dump()
+    usage = usage or {}
+    input_details = usage.get('prompt_tokens_details') or usage.get('input_tokens_details') or {}
+    output_details = usage.get('completion_tokens_details') or usage.get('output_tokens_details') or {}
+    return (
+        usage.get('prompt_tokens', usage.get('input_tokens')) or 0,
+        input_details.get('cached_tokens') or 0,
+        usage.get('completion_tokens', usage.get('output_tokens')) or 0,
+        output_details.get('reasoning_tokens') or 0,
+    )
 
-    cached = usage.get('input_tokens_details', {}).get('cached_tokens', 0)
-    input = usage.get('input_tokens', 0) - cached
-    output = usage.get('output_tokens')
 
-    print(f'{cached / (input + cached):.2f} cached rate')
+def calculate_price(model: str, usage, batch: bool) -> BatchPrice:
+    input, cached, output, _ = token_counts(usage)
+    return token_price(model, input, cached, output, batch)
+
+
+def token_price(model: str, input: int, cached: int, output: int, batch: bool) -> BatchPrice:
+    """
+    Price of a request, cached tokens are part of the input tokens and reasoning tokens part
+    of the output tokens. Models without known price are free.
+    """
+    price = PRICES.get(model)
+    if price is None:
+        return BatchPrice.zero()
 
     factor = 0.5 if batch else 1
 
     return BatchPrice(
-        (input / 1e6) * price.get('input'),
-        (output / 1e6) * price.get('input'),
-        (cached / 1e6) * price.get('input_cached'),
+        ((input - cached) / 1e6) * price['input'],
+        (output / 1e6) * price['output'],
+        (cached / 1e6) * price['input_cached'],
     ) * factor
 
 
@@ -0,0 +1,124 @@
+"""
+Keyset pagination: pages continue after (or before) the sort key of the last row shown instead
+of skipping rows with OFFSET, so every page costs the same regardless of how deep it is.
+
+A listing is made of segments that are shown one after the other, e.g. publications without a
+human score before the labelled ones. Within a segment rows are ordered by its key columns,
+which must be unique per row and backed by an index. The cursor in the URL is the segment
+number and the key of the row the page starts after.
+"""
+from dataclasses import dataclass
+import math
+import sqlite3
+
+
+@dataclass
+class Segment:
+    # everything after SELECT ... FROM, must end in a WHERE clause
+    source: str
+    # sort key, the leading keys should be plain indexed columns so the seek can use the index
+    keys: tuple[str, ...]
+
+
+@dataclass
+class Page:
+    rows: list[sqlite3.Row]
+    number: int
+    # query arguments of the neighbouring pages, None if there is none
+    prev_args: dict | None
+    next_args: dict | None
+
+
+def encode_cursor(segment: int, key) -> str:
+    return f"{segment}:{','.join(repr(v) for v in key)}"
+
+
+def decode_cursor(cursor: str, segments: list[Segment]) -> tuple[int, tuple]:
+    """
+    The segment number and key of a cursor, raises ValueError if it doesn't fit the segments.
+    """
+    segment, _, key = cursor.partition(':')
+    values = []
+    for v in key.split(','):
+        try:
+            values.append(int(v))
+        except ValueError:
+            if not math.isfinite(value := float(v)):
+                raise ValueError(f"invalid cursor key {v!r}")
+            values.append(value)
+    segment = int(segment)
+    if not 0 <= segment < len(segments) or len(values) != len(segments[segment].keys):
+        raise ValueError(f"cursor {cursor!r} doesn't match the listing")
+    return segment, tuple(values)
+
+
+def _fetch(conn, columns: str, segment: Segment, params: dict, key, descending: bool, limit: int) -> list[sqlite3.Row]:
+    op = '<' if descending else '>'
+    direction = 'DESC' if descending else 'ASC'
+    where = ''
+    args = dict(params, _limit=limit)
+    if key is not None:
+        names = [f':_k{i}' for i in range(len(key))]
+        args |= {f'_k{i}': v for i, v in enumerate(key)}
+        # the seek over the leading keys is what lets SQLite start inside the index
+        lead = len(key) - 1 or 1
+        where = (
+            f" AND ({', '.join(segment.keys[:lead])}) {op}= ({', '.join(names[:lead])})"
+            f" AND ({', '.join(segment.keys)}) {op} ({', '.join(names)})"
+        )
+    key_columns = ', '.join(f'{k} AS _k{i}' for i, k in enumerate(segment.keys))
+    order = ', '.join(f'{k} {direction}' for k in segment.keys)
+    return conn.execute(
+        f'SELECT {columns}, {key_columns} FROM {segment.source}{where} ORDER BY {order} LIMIT :_limit', args
+    ).fetchall()
+
+
+def keyset_page(conn: sqlite3.Connection, columns: str, segments: list[Segment], params: dict, args: dict,
+                per_page: int, descending: bool = False) -> Page:
+    """
+    The page described by the `after`/`before` cursor and page number `p` in the request
+    arguments `args`. Segments are listed in ascending order and walked backwards for
+    descending listings.
+    """
+    backwards = 'before' in args
+    cursor = args.get('before') if backwards else args.get('after')
+    try:
+        number = int(args.get('p', 0))
+        start, key = decode_cursor(cursor, segments) if cursor else (None, None)
+    except ValueError:
+        # stale or edited links show the first page instead of failing
+        number, backwards, cursor, start, key = 0, False, None, None, None
+
+    # the order in which segments are visited for this request
+    order = list(range(len(segments)))
+    if descending != backwards:
+        order.reverse()
+    if start is not None:
+        order = order[order.index(start):]
+
+    rows = []
+    for i in order:
+        fetched = _fetch(conn, columns, segments[i], params, key if i == start else None, descending != backwards, per_page + 1 - len(rows))
+        rows += [(i, row) for row in fetched]
+        if len(rows) > per_page:
+            break
+
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    has_prev = more if backwards else cursor is not None
+    has_next = True if backwards else more
+
+    base = {k: v for k, v in args.items() if k not in ('after', 'before', 'p')}
+    first, last = rows[0] if rows else None, rows[-1] if rows else None
+    prev_args = next_args = None
+    if has_prev and first is not None:
+        prev_args = base | {'p': number - 1, 'before': encode_cursor(first[0], _key(first[1], segments[first[0]]))}
+    if has_next and last is not None:
+        next_args = base | {'p': number + 1, 'after': encode_cursor(last[0], _key(last[1], segments[last[0]]))}
+    return Page([row for _, row in rows], number, prev_args, next_args)
+
+
+def _key(row: sqlite3.Row, segment: Segment) -> tuple:
+    return tuple(row[f'_k{i}'] for i in range(len(segment.keys)))
@@ -1,42 +1,79 @@
-import matplotlib.pyplot as plt
-import io
-import numpy as np
+from functools import lru_cache
+from html import escape
+import math
 
+# matplotlib colormaps as evenly spaced color stops
+COLORMAPS = {
+    'Blues': ['#f7fbff', '#deebf7', '#c6dbef', '#9ecae1', '#6baed6', '#4292c6', '#2171b5', '#08519c', '#08306b'],
+}
+
+CELL_WIDTH = 72
+CELL_HEIGHT = 36
+FONT_SIZE = 12
+CHAR_WIDTH = 0.6 * FONT_SIZE
+MARGIN = 8
 
-cache = {}
 
 def render_heatmap(data, models, thresholds, title, cmap='Blues'):
-    key = (
-        tuple(data), tuple(models), tuple(thresholds), title, cmap
+    """
+    Render a heatmap with a row per threshold and a column per model as an inline SVG.
+    Values are between 0 and 1, None is drawn as an empty cell.
+    """
+    return _render_heatmap(tuple(tuple(row) for row in data), tuple(models), tuple(thresholds), title, cmap)
+
+
+@lru_cache(maxsize=64)
+def _render_heatmap(data, models, thresholds, title, cmap):
+    stops = [_hex_to_rgb(c) for c in COLORMAPS[cmap]]
+
+    # room for the threshold labels on the left and the rotated model names below
+    label_drop = CHAR_WIDTH * max((len(str(m)) for m in models), default=0) / math.sqrt(2)
+    left = max(
+        MARGIN + CHAR_WIDTH * max((len(f'>{t}') for t in thresholds), default=0) + 6,
+        MARGIN + label_drop - CELL_WIDTH / 2,
     )
+    top = MARGIN + FONT_SIZE * 2
+    width = left + CELL_WIDTH * len(models) + MARGIN
+    height = top + CELL_HEIGHT * len(thresholds) + 6 + label_drop + FONT_SIZE + MARGIN
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.0f}" height="{height:.0f}" viewBox="0 0 {width:.0f} {height:.0f}" '
+        f'font-family="sans-serif" font-size="{FONT_SIZE}">',
+        f'<text x="{left + CELL_WIDTH * len(models) / 2:.1f}" y="{MARGIN + FONT_SIZE * 1.2:.1f}" text-anchor="middle" font-size="{FONT_SIZE * 1.2:.0f}">{escape(title)}</text>',
+    ]
+    for i, t in enumerate(thresholds):
+        y = top + CELL_HEIGHT * i
+        parts.append(f'<text x="{left - 6:.1f}" y="{y + CELL_HEIGHT / 2:.1f}" text-anchor="end" dominant-baseline="central">&gt;{escape(str(t))}</text>')
+        for j in range(len(models)):
+            val = data[i][j]
+            x = left + CELL_WIDTH * j
+            if val is None or math.isnan(val):
+                fill, text, color = 'none', 'nan', 'black'
+            else:
+                fill, text, color = _color(stops, val), f'{val:.2f}', 'white' if val > 0.7 else 'black'
+            parts.append(
+                f'<rect x="{x:.1f}" y="{y:.1f}" width="{CELL_WIDTH}" height="{CELL_HEIGHT}" fill="{fill}"/>'
+                f'<text x="{x + CELL_WIDTH / 2:.1f}" y="{y + CELL_HEIGHT / 2:.1f}" text-anchor="middle" dominant-baseline="central" fill="{color}">{text}</text>'
+            )
+    bottom = top + CELL_HEIGHT * len(thresholds)
+    parts.append(f'<rect x="{left:.1f}" y="{top:.1f}" width="{CELL_WIDTH * len(models)}" height="{CELL_HEIGHT * len(thresholds)}" fill="none" stroke="black"/>')
+    for j, m in enumerate(models):
+        x = left + CELL_WIDTH * (j + 0.5)
+        parts.append(f'<text transform="translate({x:.1f},{bottom + 6 + FONT_SIZE:.1f}) rotate(-45)" text-anchor="end">{escape(str(m))}</text>')
+    parts.append('</svg>')
+    return ''.join(parts)
+
+
+def _hex_to_rgb(color: str) -> tuple[int, int, int]:
+    return int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16)
+
 
-    if key in cache:
-        return cache[key]
-
-    fig, ax = plt.subplots(figsize=(len(models), len(thresholds)))
-    data_array = np.array(data)
-    data_array = np.where(data_array == None, np.nan, data_array).astype(float)
-    
-    ax.imshow(data_array, cmap=cmap, vmin=0, vmax=1)
-
-    ax.set_yticks(np.arange(len(thresholds)))
-    ax.set_xticks(np.arange(len(models)))
-    ax.set_yticklabels([f">{t}" for t in thresholds])
-    ax.set_xticklabels(models)
-
-    for j in range(len(models)):
-        for i in range(len(thresholds)):
-            val = data_array[i, j]
-            text_color = "white" if val > 0.7 else "black"
-            ax.text(j, i, f"{val:.2f}", ha="center", va="center", color=text_color)
-
-    plt.setp(ax.get_xticklabels(), rotation=45, ha="right", rotation_mode="anchor")
-    ax.set_title(title)
-    plt.tight_layout()
-
-    buf = io.BytesIO()
-    plt.savefig(buf, format="svg")
-    plt.close(fig)
-    svg = buf.getvalue().decode("utf-8")
-    cache[key] = svg
-    return svg[svg.index('<svg'):]
+def _color(stops, val: float) -> str:
+    """
+    Linear interpolation between the color stops, values are clamped to [0, 1].
+    """
+    pos = min(max(val, 0.0), 1.0) * (len(stops) - 1)
+    i = min(int(pos), len(stops) - 2)
+    frac = pos - i
+    r, g, b = (round(a + (b - a) * frac) for a, b in zip(stops[i], stops[i + 1]))
+    return f'#{r:02x}{g:02x}{b:02x}'
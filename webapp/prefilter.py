@@ -0,0 +1,159 @@
+"""
+Cheap lexical prefilter in front of the LLM.
+
+A naive Bayes model over the words of title and abstract is trained on the human labels
+(plus publications that several reviews clearly agree on). Publications it is very sure
+are irrelevant get an automatic rating of 0 instead of an LLM generation. The cutoff is
+chosen so that at least `recall_floor` of the relevant publications pass, measured with
+cross-validation on the human-labelled set.
+"""
+from dataclasses import dataclass, asdict
+import json
+import math
+import re
+import sqlite3
+import time
+
+# ratings above this count as relevant, for human scores and reviews alike
+RELEVANCE_THRESHOLD = 50
+# reviews of publications without human score are used for training if at least this many
+# reviews exist and all of them are on the same side of the threshold
+MIN_AGREEING_REVIEWS = 3
+# too few relevant labels make the recall estimate meaningless
+MIN_RELEVANT = 5
+FOLDS = 5
+# words seen fewer times are dropped from the model
+MIN_WORD_COUNT = 2
+
+RECALL_FLOORS = (0.95, 0.99, 0.995)
+
+WORD_REGEX = re.compile(r'[a-z][a-z\-]{2,}')
+
+FILTERED_REASON = 'Filtered out by the prefilter as clearly irrelevant.'
+
+_cache: dict[str, 'Prefilter | None'] = {}
+
+
+@dataclass
+class Prefilter:
+    prior: float
+    weights: dict[str, float]
+    cutoff: float
+    recall_floor: float
+    # cross-validated share of relevant publications that pass the filter
+    sensitivity: float
+    # cross-validated share of all labelled publications that get filtered out
+    filtered: float
+
+    def score(self, pub) -> float:
+        """
+        Log-odds of the publication being relevant.
+        """
+        return self.prior + sum(self.weights.get(w, 0.0) for w in words(pub))
+
+    def rejects(self, pub) -> bool:
+        return self.score(pub) < self.cutoff
+
+
+def words(pub) -> set[str]:
+    return set(WORD_REGEX.findall(f"{pub['title'] or ''} {pub['abstract'] or ''}".lower()))
+
+
+def _fit(samples: list[tuple[set[str], bool]]) -> tuple[float, dict[str, float]]:
+    """
+    Bernoulli-style naive Bayes: the log-likelihood ratio of every word, with add-one smoothing.
+    """
+    counts = ({}, {})
+    totals = [0, 0]
+    for ws, relevant in samples:
+        totals[relevant] += 1
+        for w in ws:
+            counts[relevant][w] = counts[relevant].get(w, 0) + 1
+
+    vocab = {w for c in counts for w in c if counts[0].get(w, 0) + counts[1].get(w, 0) >= MIN_WORD_COUNT}
+    weights = {
+        w: math.log((counts[1].get(w, 0) + 1) / (totals[1] + 2)) - math.log((counts[0].get(w, 0) + 1) / (totals[0] + 2))
+        for w in vocab
+    }
+    prior = math.log((totals[1] + 1) / (totals[0] + 1))
+    return prior, weights
+
+
+def training_data(conn: sqlite3.Connection) -> tuple[list[tuple[set[str], bool]], list[tuple[set[str], bool]]]:
+    """
+    Returns the human-labelled samples and the samples taken from agreeing reviews.
+    """
+    human = [
+        (words(row), row['human_score'] > RELEVANCE_THRESHOLD)
+        for row in conn.execute('SELECT title, abstract, human_score FROM publications WHERE human_score IS NOT NULL')
+    ]
+    agreed = [
+        (words(row), row['lo'] > RELEVANCE_THRESHOLD)
+        for row in conn.execute("""
+            SELECT p.title, p.abstract, MIN(r.rating) AS lo, MAX(r.rating) AS hi
+            FROM publications AS p JOIN reviews AS r ON r.publication_id = p.id
+            WHERE p.human_score IS NULL AND json_extract(r.raw_data, '$.prefilter') IS NULL
+            GROUP BY p.id
+            HAVING COUNT(*) >= ? AND (lo > ? OR hi <= ?)
+        """, (MIN_AGREEING_REVIEWS, RELEVANCE_THRESHOLD, RELEVANCE_THRESHOLD))
+    ]
+    return human, agreed
+
+
+def train_prefilter(conn: sqlite3.Connection, recall_floor: float) -> Prefilter | None:
+    """
+    Train a prefilter and pick its cutoff from cross-validated scores of the human-labelled
+    publications. Returns None if there are not enough relevant labels.
+    """
+    human, agreed = training_data(conn)
+    if sum(relevant for _, relevant in human) < MIN_RELEVANT:
+        return None
+
+    # out-of-fold scores, the agreed samples are only ever used for training
+    scored = []
+    for fold in range(FOLDS):
+        prior, weights = _fit([s for i, s in enumerate(human) if i % FOLDS != fold] + agreed)
+        for ws, relevant in human[fold::FOLDS]:
+            scored.append((prior + sum(weights.get(w, 0.0) for w in ws), relevant))
+
+    relevant_scores = sorted(score for score, relevant in scored if relevant)
+    # at most this many relevant publications may fall below the cutoff
+    misses = math.floor((1 - recall_floor) * len(relevant_scores))
+    cutoff = relevant_scores[misses]
+
+    prior, weights = _fit(human + agreed)
+    return Prefilter(
+        prior=prior,
+        weights=weights,
+        cutoff=cutoff,
+        recall_floor=recall_floor,
+        sensitivity=sum(score >= cutoff for score in relevant_scores) / len(relevant_scores),
+        filtered=sum(score < cutoff for score, _ in scored) / len(scored),
+    )
+
+
+def save_prefilter(conn: sqlite3.Connection, job_id: str, pf: Prefilter):
+    data = asdict(pf)
+    conn.execute(
+        'INSERT OR REPLACE INTO prefilters (job_id, model, recall_floor, sensitivity, filtered, created) VALUES (?,?,?,?,?,?)',
+        (job_id, json.dumps(data), pf.recall_floor, pf.sensitivity, pf.filtered, time.time())
+    )
+    _cache[job_id] = pf
+
+
+def get_prefilter(conn: sqlite3.Connection, job_id: str) -> Prefilter | None:
+    """
+    The prefilter of a job, or None if the job runs without one. Cached per process.
+    """
+    if job_id not in _cache:
+        row = conn.execute('SELECT model FROM prefilters WHERE job_id = ?', (job_id,)).fetchone()
+        _cache[job_id] = Prefilter(**json.loads(row['model'])) if row else None
+    return _cache[job_id]
+
+
+def filtered_review(pf: Prefilter, pub) -> dict:
+    return {
+        'score': 0,
+        'reason': FILTERED_REASON,
+        'prefilter': round(pf.score(pub), 3),
+    }
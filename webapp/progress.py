@@ -0,0 +1,103 @@
+"""
+Snapshot of the running job and its ETA, shown in the navbar of every page.
+
+Workers write the snapshot into a small JSON file next to the database whenever they flush
+their progress, the web server keeps the last one it read in memory. Pages are rendered from
+that copy without touching the database, only a snapshot that nobody refreshed for
+SNAPSHOT_TTL seconds (e.g. while no worker is running) is computed again from the database.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from webapp.db import get_connection
+
+SNAPSHOT_PATH = 'job_progress.json'
+# seconds a snapshot is trusted before it is computed again from the database
+SNAPSHOT_TTL = 30
+# seconds the web server keeps a snapshot in memory before looking at the file again
+CACHE_TTL = 2
+# seconds between two snapshots written by the same worker
+WRITE_INTERVAL = 5
+
+_lock = threading.Lock()
+# (time read, snapshot)
+_cached: tuple[float, dict] | None = None
+_last_write = 0.0
+
+
+def compute(conn: sqlite3.Connection) -> dict:
+    """
+    The running job with an estimate of the remaining seconds, None if no job is running.
+    """
+    job = conn.execute("SELECT * FROM jobs WHERE status = 'RUNNING'").fetchone()
+    if job is not None:
+        count, complete = conn.execute(
+            'SELECT (SELECT COUNT(*) FROM publications) as ttl, (SELECT COUNT(*) FROM reviews WHERE job_id = ?) as complete',
+            (job['id'],)
+        ).fetchone()
+        job = {
+            **job,
+            'eta': (job['time_taken'] / complete) * (job['repeats'] * count - complete) if complete else None
+        }
+    return {'updated': time.time(), 'job': job}
+
+
+def write_snapshot(conn: sqlite3.Connection | None = None) -> dict:
+    """
+    Compute the snapshot and replace the file, readers never see a partially written one.
+    A file that can't be written only costs the other processes their cached copy.
+    """
+    global _last_write, _cached
+    snapshot = compute(conn or get_connection())
+    tmp = f'{SNAPSHOT_PATH}.{os.getpid()}.{threading.get_ident()}'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, SNAPSHOT_PATH)
+    except OSError as e:
+        print(f"Error writing job progress snapshot: {e}")
+    with _lock:
+        _last_write = snapshot['updated']
+        _cached = (time.monotonic(), snapshot)
+    return snapshot
+
+
+def maybe_write_snapshot(conn: sqlite3.Connection | None = None):
+    """
+    Write the snapshot, but at most once every WRITE_INTERVAL seconds.
+    """
+    if time.time() - _last_write >= WRITE_INTERVAL:
+        try:
+            write_snapshot(conn)
+        except sqlite3.Error as e:
+            print(f"Error computing job progress snapshot: {e}")
+
+
+def _read_snapshot() -> dict | None:
+    try:
+        with open(SNAPSHOT_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def job_in_progress() -> dict | None:
+    """
+    The running job from the latest snapshot, see `compute`.
+    """
+    global _cached
+    with _lock:
+        cached = _cached
+    if cached is not None and time.monotonic() - cached[0] < CACHE_TTL:
+        return cached[1]['job']
+
+    snapshot = _read_snapshot()
+    if snapshot is None or time.time() - snapshot['updated'] >= SNAPSHOT_TTL:
+        snapshot = write_snapshot()
+    else:
+        with _lock:
+            _cached = (time.monotonic(), snapshot)
+    return snapshot['job']
@@ -0,0 +1,70 @@
+import sqlite3
+import time
+
+# number of failed tries after which an item is moved to the dead-letter state
+MAX_TRIES = 5
+# delay before the first retry, doubled with every further failure
+BASE_DELAY = 30
+MAX_DELAY = 30 * 60
+
+
+def backoff(tries: int) -> float:
+    """
+    Seconds to wait before retrying an item that failed `tries` times.
+    """
+    return min(BASE_DELAY * 2 ** (tries - 1), MAX_DELAY)
+
+
+def record_failure(conn: sqlite3.Connection, job_id: str, pub_id: int, attempt: int, error: str, message: str, permanent: bool = False) -> bool:
+    """
+    Put a failed (publication, attempt) slot into the retry queue, or bump its try counter.
+    Permanent failures are dead-lettered right away.
+
+    Returns True if the item is now dead-lettered.
+    """
+    row = conn.execute(
+        'SELECT tries FROM retries WHERE job_id = ? AND publication_id = ? AND attempt = ?',
+        (job_id, pub_id, attempt)
+    ).fetchone()
+    tries = (row['tries'] if row else 0) + 1
+    dead = permanent or tries >= MAX_TRIES
+
+    conn.execute(
+        'INSERT OR REPLACE INTO retries (job_id, publication_id, attempt, tries, error, message, next_try, dead, permanent) VALUES (?,?,?,?,?,?,?,?,?)',
+        (job_id, pub_id, attempt, tries, error, message, time.time() + backoff(tries), dead, permanent)
+    )
+    return dead
+
+
+def clear_retry(conn: sqlite3.Connection, job_id: str, pub_id: int, attempt: int):
+    conn.execute(
+        'DELETE FROM retries WHERE job_id = ? AND publication_id = ? AND attempt = ?',
+        (job_id, pub_id, attempt)
+    )
+
+
+def dead_letters(conn: sqlite3.Connection, job_id: str) -> list[sqlite3.Row]:
+    return conn.execute(
+        'SELECT f.*, p.title FROM retries AS f JOIN publications AS p ON p.id = f.publication_id '
+        'WHERE f.job_id = ? AND f.dead ORDER BY f.publication_id, f.attempt',
+        (job_id,)
+    ).fetchall()
+
+
+def failure_summary(conn: sqlite3.Connection, job_id: str) -> list[sqlite3.Row]:
+    """
+    Failed slots of a job per error, split into those still being retried and those given up on.
+    """
+    return conn.execute(
+        'SELECT error, permanent, SUM(NOT dead) AS pending, SUM(dead) AS dead, MAX(message) AS message '
+        'FROM retries WHERE job_id = ? GROUP BY error, permanent ORDER BY COUNT(*) DESC',
+        (job_id,)
+    ).fetchall()
+
+
+def revive_dead_letters(conn: sqlite3.Connection, job_id: str):
+    """
+    Drop the dead-lettered items of a job so that they get scheduled again.
+    """
+    conn.execute('DELETE FROM retries WHERE job_id = ? AND dead', (job_id,))
+    conn.commit()
@@ -1,26 +1,45 @@
-from concurrent.futures import Future
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from collections import deque
 import asyncio
-from dataclasses import dataclass
 import sqlite3
 import time
 import signal
 import threading
-import tempfile
 import os
-from aalib.progress import progress
 from aalib.colors import FMT
 
-from webapp.classify import WorkItem, get_ollama, process_item, process_item_async
-from webapp.db import items_left_in_job, get_connection, remaining_items_count
-from webapp.oai import process_batch, OPENAI_MODELS
+from webapp.classify import WorkItem, classify_item_async, classify_batch_async
+from webapp.db import get_connection, upgrade_db
+from webapp.oai import process_job, OPENAI_MODELS, STALE_AFTER
+from webapp.leases import LocalWorkSource, RemoteWorkSource, LEASE_TTL, WORKER_ID
+from webapp.scheduler import bucket_by_length
+from webapp import metrics
+from webapp.progress import maybe_write_snapshot, write_snapshot
+
+# number of concurrent requests sent to ollama
+MAX_IN_FLIGHT = 10
+# number of items leased at once, also the window for length bucketing
+LEASE_BATCH = 4 * MAX_IN_FLIGHT
+# default seconds to wait for in-flight requests on shutdown
+DRAIN_TIMEOUT = 300
 
 class JobWorker:
     """
-    Processes jobs in order of creation.
+    Leases work items from any running ollama job and classifies them, processes OpenAI
+    jobs in order of creation. Any number of workers can run concurrently.
     """
-    def __init__(self, loop: asyncio.BaseEventLoop):
+    def __init__(self, loop: asyncio.BaseEventLoop, source: LocalWorkSource | RemoteWorkSource | None = None, drain_timeout: float = DRAIN_TIMEOUT):
         self.current_job_id = None
         self.loop = loop
+        self.drain_timeout = drain_timeout
+        # set once a shutdown was requested, in-flight work is finished until then
+        self.drain_deadline: float | None = None
+        self.in_flight = 0
+        # jobs worked on while draining, paused on exit even if all their items got submitted
+        self.drained_jobs: set[str] = set()
+        self.source = source or LocalWorkSource()
+        # remote workers have no database, they only lease ollama work through the API
+        self.local = isinstance(self.source, LocalWorkSource)
 
     def start(self):
         """Main worker loop. Registers signal handlers and begins processing jobs."""
@@ -28,7 +47,10 @@ class JobWorker:
         signal.signal(signal.SIGTERM, self._handle_exit)
 
         while True:
-            job = self._claim_next_job()
+            if self._process_leases():
+                continue
+
+            job = self._claim_next_job() if self.local else None
 
             if job is not None:
                 self._process_job(*job)
@@ -36,24 +58,34 @@ class JobWorker:
                 time.sleep(.5)
 
     def _claim_next_job(self) -> tuple[str, str, str, str, int, float, int] | None:
+        """
+        Claim the oldest waiting OpenAI job. Ollama jobs are not claimed, their items are leased.
+
+        Running jobs with submitted batches and no heartbeat for a while lost their worker to a
+        crash and are claimed again, to reattach to the batches.
+        """
         try:
             conn = get_connection()
             conn.execute("BEGIN EXCLUSIVE")
-            row = conn.execute("""
+            row = conn.execute(f"""
                 SELECT id, name, model, prompt, repeats, time_taken, num_completed FROM jobs
-                WHERE status = 'WAITING'
+                WHERE model IN ({','.join('?' * len(OPENAI_MODELS))}) AND (
+                    status = 'WAITING' OR status = 'RUNNING' AND IFNULL(heartbeat, 0) < ? AND EXISTS (
+                        SELECT 1 FROM openai_batches AS b WHERE b.job_id = jobs.id AND NOT b.imported
+                    )
+                )
                 ORDER BY time_created ASC
                 LIMIT 1
-            """).fetchone()
+            """, (*OPENAI_MODELS, time.time() - STALE_AFTER)).fetchone()
 
             if row:
                 job_id, name, model, prompt, repeats, time_taken, completed = row
                 start_time = time.time()
                 conn.execute("""
                     UPDATE jobs
-                    SET status = 'RUNNING', time_started = ?
+                    SET status = 'RUNNING', time_started = ?, heartbeat = ?
                     WHERE id = ?
-                """, (start_time, job_id))
+                """, (start_time, start_time, job_id))
                 conn.commit()
                 self.current_job_id = job_id
                 print(f"Claimed job {job_id}")
@@ -74,69 +106,158 @@ class JobWorker:
         return True
 
 
-    def _process_job(self, job_id: str, name: str, model: str, prompt: str, repeats: int, time_taken: float, completed: int):
-        if model in OPENAI_MODELS:
-            self._process_openai_job(job_id, name, model, prompt, repeats, time_taken, completed)
-            return
-        try:
-            conn = get_connection()
+    def _process_leases(self) -> bool:
+        """
+        Lease items and classify them with at most MAX_IN_FLIGHT requests in flight, until no
+        more work can be leased. Returns False if there was nothing to do.
+        """
+        jobs: dict[str, dict] = {}
+        queue: deque[dict] = deque()
+        # in-flight requests, with the items they classify (more than one for batched jobs)
+        live: dict[Future, list[dict]] = {}
+        last_heartbeat = time.time()
+        # time of the last lease attempt that came back empty
+        last_empty = 0.0
+        did_work = False
+
+        while True:
+            if self.drain_deadline is not None:
+                # shutting down: hand back what was not started yet, finish the rest
+                self.drained_jobs.update(i['job_id'] for i in [*queue, *(i for b in live.values() for i in b)])
+                if queue:
+                    self.source.release([i['lease_id'] for i in queue])
+                    queue.clear()
+                if not live or time.time() > self.drain_deadline:
+                    for fut in live:
+                        fut.cancel()
+                    print(f"Drained, {sum(map(len, live.values()))} in-flight items abandoned.")
+                    self._exit()
+
+            # top up the local queue before it runs dry
+            elif len(queue) < MAX_IN_FLIGHT * self._batch_size(jobs) and time.time() - last_empty > 5:
+                new_jobs, items = self.source.lease(LEASE_BATCH * self._batch_size(jobs))
+                jobs.update(new_jobs)
+                # group similarly long abstracts so parallel requests finish together
+                queue.extend(bucket_by_length(items, LEASE_BATCH, lambda i: i['work']['abstract']))
+                if not items:
+                    last_empty = time.time()
 
-            live_coros: list[Future[bool]] = []
-            active_coros = 10
-            remaining = remaining_items_count(job_id, repeats)
-            start_count = completed
-
-            t0 = time.time()
-            for item in progress(items_left_in_job(job_id, repeats), count=remaining, message=f'{name} ({model})', color=FMT.BLUE):
-                # reduce live_coros to be at most active_coros
-                while len(live_coros) > active_coros:
-                    for c in tuple(live_coros):
-                        if not c.done():
-                            continue
-                        live_coros.remove(c)
-                        completed += c.result()
-                    if len(live_coros) > active_coros:
-                        c = live_coros.pop(0)
-                        completed += c.result()
-
-                res = asyncio.run_coroutine_threadsafe(
-                    process_item_async(
-                        WorkItem(
-                            job_id,
-                            model,
-                            prompt,
-                            dict(item)
-                        )
-                    ), self.loop
+            while queue and len(live) < MAX_IN_FLIGHT:
+                batch = self._take_batch(queue, jobs)
+                job = jobs[batch[0]['job_id']]
+                works = [WorkItem(i['job_id'], job['model'], job['prompt'], i['work']) for i in batch]
+                fut = asyncio.run_coroutine_threadsafe(
+                    classify_item_async(works[0]) if len(works) == 1 else classify_batch_async(works),
+                    self.loop
                 )
-                live_coros.append(res)
+                live[fut] = batch
+                did_work = True
 
-                self._update_job_progress(job_id, completed, time_taken + (time.time() - t0))
-                # check for liveness:
-                if not self._check_alive(job_id, conn):
-                    for coro in live_coros:
-                        coro.cancel()
-                    return
+            self.in_flight = len(live)
+            metrics.set_gauge('in_flight_requests', len(live), worker=WORKER_ID)
+            metrics.set_gauge('queue_depth', len(queue), worker=WORKER_ID)
+            if not live:
+                return did_work
 
-            print("awaiting trailing coros")
-            for res in live_coros:
-                completed += res.result()
+            done, _ = wait(live, timeout=1, return_when=FIRST_COMPLETED)
+            for fut in done:
+                self._collect(fut, live.pop(fut), jobs)
+            self.in_flight = len(live)
 
-            conn.commit()
-            final_time = time_taken + (time.time() - t0)
-            self._update_job_progress(job_id, completed, final_time)
+            if time.time() - last_heartbeat > LEASE_TTL / 4:
+                last_heartbeat = time.time()
+                self._heartbeat(queue, live)
 
-            if start_count + remaining != completed:
-                return self._process_job(job_id, name, model, prompt, repeats, final_time, completed)
+            if self.local:
+                metrics.maybe_flush()
+                maybe_write_snapshot()
 
-            self._finalize_job(job_id)
+    @staticmethod
+    def _batch_size(jobs: dict[str, dict]) -> int:
+        return max((job.get('batch_size', 1) for job in jobs.values()), default=1)
+
+    @staticmethod
+    def _take_batch(queue: deque[dict], jobs: dict[str, dict]) -> list[dict]:
+        """
+        Take the next item off the queue, along with following items of the same job if it is batched.
+        A batch never holds two attempts of the same publication, those would get the same answer.
+        """
+        batch = [queue.popleft()]
+        job_id = batch[0]['job_id']
+        size = jobs[job_id].get('batch_size', 1)
+        ids = {batch[0]['work']['id']}
+        skipped = []
+        while queue and len(batch) < size and queue[0]['job_id'] == job_id:
+            item = queue.popleft()
+            if item['work']['id'] in ids:
+                skipped.append(item)
+            else:
+                ids.add(item['work']['id'])
+                batch.append(item)
+        # skipped attempts go first in one of the next batches
+        queue.extendleft(reversed(skipped))
+        return batch
+
+    def _heartbeat(self, queue: deque[dict], live: dict[Future, list[dict]]):
+        """
+        Extend all held leases, and drop items whose lease was lost (e.g. the job was stopped).
+        """
+        lost = set(self.source.heartbeat([i['lease_id'] for i in queue] + [i['lease_id'] for b in live.values() for i in b]))
+        if not lost:
+            return
+        for item in [i for i in queue if i['lease_id'] in lost]:
+            queue.remove(item)
+        for fut, batch in list(live.items()):
+            if any(i['lease_id'] in lost for i in batch):
+                # the whole request is dropped, so the rest of the batch is given up as well
+                fut.cancel()
+                del live[fut]
+                lost.update(i['lease_id'] for i in batch)
+        self.source.release(list(lost))
+        print(f"dropped {len(lost)} items of stopped jobs")
+
+    def _collect(self, fut: Future, batch: list[dict], jobs: dict[str, dict]):
+        """
+        Submit the results of a finished request, or report the failure of its items.
+        """
+        try:
+            results = fut.result()
+        except Exception as ex:
+            results = [ex] * len(batch)
+        else:
+            # batched requests return a result (or an exception) per item
+            if len(batch) == 1:
+                results = [results]
+        for item, data in zip(batch, results):
+            try:
+                self._collect_item(item, data, jobs)
+            except Exception as e:
+                # e.g. the server is unreachable or the database locked, the lease expires and
+                # the item is handed out again
+                print(f"{FMT.RED}unable to report publication {item['work']['id']} (attempt {item['work']['attempt']}): {type(e).__name__}: {e}{FMT.RESET}")
+
+    def _collect_item(self, item: dict, data: dict | BaseException, jobs: dict[str, dict]):
+        model = jobs[item['job_id']]['model']
+        work = item['work']
+        if isinstance(data, BaseException):
+            metrics.inc('items_failed_total', model=model, error=type(data).__name__)
+            if self.source.fail(item, type(data).__name__, str(data)):
+                metrics.inc('items_dead_lettered_total', model=model)
+                print(f"{FMT.RED}giving up on publication {work['id']} (attempt {work['attempt']}): {type(data).__name__}: {data}{FMT.RESET}")
+            return
+        self.source.submit(item, data)
+        metrics.inc('items_completed_total', model=model)
+
+    def _process_job(self, job_id: str, name: str, model: str, prompt: str, repeats: int, time_taken: float, completed: int):
+        try:
+            self._process_openai_job(job_id, name, model, prompt, repeats, time_taken, completed)
             self.current_job_id = None
         except:
             self._pause_current_job()
             raise
 
     def _process_openai_job(self, job_id: str, name: str, model: str, prompt: str, repeats: int, time_taken: float, completed: int):
-        process_batch(
+        process_job(
             job_id,
             name,
             model,
@@ -150,12 +271,15 @@ class JobWorker:
     def _update_job_progress(self, job_id: str, num_completed: int, time_taken: float):
         conn = get_connection()
         try:
-            conn.execute("""
-                UPDATE jobs
-                SET time_taken = ?, num_completed = ?
-                WHERE id = ?
-            """, (time_taken, num_completed, job_id))
-            conn.commit()
+            with metrics.timed('sqlite_write_seconds', op='progress'):
+                conn.execute("""
+                    UPDATE jobs
+                    SET time_taken = ?, num_completed = ?
+                    WHERE id = ?
+                """, (time_taken, num_completed, job_id))
+                conn.commit()
+            metrics.maybe_flush(conn)
+            maybe_write_snapshot(conn)
         except Exception as e:
             print(f"Error updating job progress for job {job_id}: {e}")
 
@@ -169,29 +293,76 @@ class JobWorker:
                 WHERE id = ?
             """, (job_id,job_id))
             conn.commit()
+            metrics.set_gauge('queue_depth', 0, job=job_id)
+            metrics.flush(conn)
+            write_snapshot(conn)
         except Exception as e:
                 print(f"Error finalizing job {job_id}: {e}")
 
-    def _pause_current_job(self):
+    def _pause_current_job(self, requeue: bool = False):
+        """
+        Pause the claimed job. With requeue, a job with submitted batches is put back into the
+        queue instead, so that the next worker reattaches to the batches.
+        """
         job_id = self.current_job_id
         if job_id:
             try:
                 conn = get_connection()
+                pending = requeue and conn.execute(
+                    'SELECT 1 FROM openai_batches WHERE job_id = ? AND NOT imported LIMIT 1', (job_id,)
+                ).fetchone() is not None
+                status = 'WAITING' if pending else 'PAUSED'
                 conn.execute("""
                     UPDATE jobs
-                    SET status = 'PAUSED'
+                    SET status = ?
                     WHERE id = ? AND status = 'RUNNING'
-                """, (job_id,))
+                """, (status, job_id))
                 conn.commit()
-                print(f"Job {job_id} paused due to shutdown.")
+                write_snapshot(conn)
+                print(f"Job {job_id} {'requeued' if pending else 'paused'} due to shutdown.")
                 self.current_job_id = None
             except Exception as e:
                 print(f"Error pausing job {job_id}: {e}")
 
+    def _release_leases(self):
+        """
+        Give up all leases of this worker, and pause jobs that no other worker is working on.
+        """
+        try:
+            jobs = self.source.release() | self.drained_jobs
+        except Exception as e:
+            print(f"Error releasing leases: {e}")
+            return
+        if not self.local:
+            return
+        conn = get_connection()
+        for job_id in jobs:
+            conn.execute("""
+                UPDATE jobs
+                SET status = 'PAUSED'
+                WHERE id = ? AND status = 'RUNNING' AND NOT EXISTS (SELECT 1 FROM leases WHERE job_id = ?)
+            """, (job_id, job_id))
+            print(f"Released leases of job {job_id}")
+        try:
+            write_snapshot(conn)
+        except sqlite3.Error as e:
+            print(f"Error writing job progress snapshot: {e}")
+
     def _handle_exit(self, signum, frame):
-        """Signal handler for graceful shutdown."""
+        """
+        Signal handler for graceful shutdown. The first signal stops leasing new work and lets
+        in-flight requests finish (up to the drain timeout), a second one exits immediately.
+        """
+        if self.drain_deadline is None and self.in_flight:
+            self.drain_deadline = time.time() + self.drain_timeout
+            print(f"Interrupt received, finishing {self.in_flight} in-flight items (at most {self.drain_timeout}s). Interrupt again to exit immediately.")
+            return
         print("Interrupt received, cleaning up...")
-        self._pause_current_job()
+        self._exit()
+
+    def _exit(self):
+        self._pause_current_job(requeue=True)
+        self._release_leases()
         raise SystemExit()
 
     def __del__(self):
@@ -206,11 +377,24 @@ def run_event_loop(loop):
 
 
 if __name__ == '__main__':
+    import argparse
+    args = argparse.ArgumentParser()
+    args.add_argument('--remote', help='lease work from the web server at this url instead of the local database', default=None)
+    args.add_argument('--token', help='API token of the web server (defaults to $WORKER_TOKEN)', default=os.environ.get('WORKER_TOKEN'))
+    args.add_argument('--drain-timeout', help='seconds to wait for in-flight requests on shutdown', default=DRAIN_TIMEOUT, type=float)
+    ns = args.parse_args()
+
+    if ns.remote:
+        source = RemoteWorkSource(ns.remote, token=ns.token)
+    else:
+        upgrade_db()
+        source = LocalWorkSource()
+
     # run the loop in a separate thread:
     loop = asyncio.new_event_loop()
     threading.Thread(target=run_event_loop, args=(loop,), daemon=True).start()
 
-    w=JobWorker(loop)
+    w=JobWorker(loop, source, ns.drain_timeout)
     try:
         w.start()
     except:
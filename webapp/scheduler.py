@@ -0,0 +1,43 @@
+from typing import Any, Callable, Iterable, Iterator
+
+# ORDER BY clauses for the open slots of a job (see db._open_slots_query), keyed by the
+# job's priority setting. `p` is the publication, `s.attempt` the attempt number. The order is
+# fixed when the job queue is filled, so it can't depend on the reviews of the job itself.
+# Jobs with a priority that no longer exists are processed in the default order.
+PRIORITIES = {
+    # highest human score first, then unlabelled (the original ordering)
+    'human': 'p.human_score DESC, p.id, s.attempt',
+    # human-labelled items first in id order, included and excluded mixed, so both sides of the
+    # eval stats become meaningful early on ('human' reviews all included items first)
+    'eval': 'p.human_score IS NULL, p.id, s.attempt',
+    # every publication once before any publication gets its second attempt
+    'breadth': 's.attempt, p.human_score DESC, p.id',
+}
+
+DEFAULT_PRIORITY = 'human'
+
+
+def estimate_tokens(text: str | None) -> int:
+    """
+    Rough token count of a text, about four characters per token for english prose.
+    """
+    return len(text or '') // 4 + 1
+
+
+def bucket_by_length(items: Iterable, window: int, abstract: Callable[[Any], str] = lambda x: x['abstract']) -> Iterator:
+    """
+    Reorder items inside consecutive windows by abstract length.
+
+    The priority order is kept at the granularity of `window`, while requests that run
+    in parallel have similar lengths and finish at roughly the same time.
+    """
+    key = lambda x: estimate_tokens(abstract(x))
+    buf = []
+    for item in items:
+        buf.append(item)
+        if len(buf) >= window:
+            buf.sort(key=key)
+            yield from buf
+            buf.clear()
+    buf.sort(key=key)
+    yield from buf
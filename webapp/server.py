@@ -1,84 +1,126 @@
-from io import StringIO
 import json
-from flask import Flask, render_template, g, request, redirect, send_file, url_for, abort, flash, Response
+from flask import Flask, render_template, g, request, redirect, send_file, url_for, abort, flash, Response, stream_with_context
 from datetime import datetime, date
-import csv
 import uuid
-import rispy
 import time
 import os
 
 from markupsafe import Markup
-from webapp.db import get_connection
+from webapp.db import get_connection, upgrade_db
 from webapp.plot import render_heatmap
+from webapp.stats import load_histograms, auc
+from webapp.pagination import Segment, keyset_page
+from webapp.progress import job_in_progress, write_snapshot
 from aalib.duration import duration
-from webapp.oai import OPENAI_MODELS
+from webapp.models import OPENAI_MODELS, MAX_BATCH_SIZE
+from webapp.retries import dead_letters, revive_dead_letters, failure_summary
+from webapp.scheduler import PRIORITIES, DEFAULT_PRIORITY
+from webapp.prefilter import RECALL_FLOORS, train_prefilter, save_prefilter
+from webapp import metrics
+from webapp import leases
 
-from webapp.exporter import EXPORTER
+from webapp.exporter import Export, CONSENSUS_MODES, CONSENSUS_LEVELS
+from webapp.extract import is_result
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET")
 
+# the server may be the first to open a database created by an older version, before any worker
+if os.path.exists('webapp.db'):
+    upgrade_db()
+
 if app.secret_key is not None:
     print("SECRETSSSS")
 
 
-STATS_QUERY = """
-WITH human_labels AS (
-    SELECT id as publication_id,
-            CASE WHEN human_score > ? THEN 1 ELSE 0 END AS is_relevant
-    FROM publications
-),
-model_reviews AS (
-    SELECT 
-        jobs.model AS model_name,
-        jobs.name as job_name,
-        jobs.id as job_id,
-        publication_id,
-        CASE WHEN rating > ? THEN 1 ELSE 0 END AS predicted_relevant
-    FROM reviews JOIN jobs ON reviews.job_id = jobs.id
-),
-joined AS (
-    SELECT m.model_name, h.is_relevant, m.predicted_relevant, job_name, job_id
-    FROM model_reviews m
-    JOIN human_labels h ON m.publication_id = h.publication_id
+# the prefilter of each job: its sensitivity is the cross-validated estimate from training, the
+# human-labelled publications of a job are the ones it was trained on and would overstate it.
+# The job's own stats leave the prefiltered reviews out for the same reason (see rating_histogram).
+PREFILTER_STATS_QUERY = """
+SELECT
+    f.job_id,
+    f.sensitivity AS cv_sensitivity,
+    (SELECT COUNT(*) FROM reviews AS r WHERE r.job_id = f.job_id AND r.prefiltered) AS filtered
+FROM prefilters AS f;
+"""
+
+# per-job rollup of the token ledger kept on the reviews, items without a count (e.g. from before
+# the ledger) don't skew the per-item averages but still count as items
+USAGE_QUERY = """
+SELECT
+    job_id,
+    COUNT(*) AS items,
+    SUM(cost) AS cost,
+    SUM(cost) / NULLIF(COUNT(cost), 0) AS cost_per_item,
+    1.0 * SUM(cached_tokens) / NULLIF(SUM(input_tokens), 0) AS cache_hit_rate,
+    1.0 * SUM(input_tokens) / NULLIF(COUNT(input_tokens), 0) AS input_per_item,
+    1.0 * SUM(output_tokens) / NULLIF(COUNT(output_tokens), 0) AS output_per_item,
+    1.0 * SUM(reasoning_tokens) / NULLIF(COUNT(reasoning_tokens), 0) AS reasoning_per_item,
+    SUM(output_tokens) / NULLIF(SUM(duration), 0) AS tokens_per_second
+FROM reviews
+WHERE true {where}
+GROUP BY job_id
+HAVING COUNT(input_tokens) > 0
+"""
+
+# compares a batched job with the single-item jobs of the same model on the human-labelled set
+CALIBRATION_QUERY = """
+WITH target AS (
+    SELECT publication_id, AVG(rating) AS rating
+    FROM reviews
+    WHERE job_id = :job_id AND NOT prefiltered
+    GROUP BY publication_id
 ),
-aggregated AS (
-    SELECT
-        job_id,
-        job_name,
-        model_name,
-        SUM(CASE WHEN predicted_relevant = 1 THEN 1 ELSE 0 END) as predicted_relevant,
-        SUM(CASE WHEN predicted_relevant = 1 THEN 0 ELSE 1 END) as predicted_irrelevant,
-        SUM(CASE WHEN is_relevant = 1 THEN 1 ELSE 0 END) AS relevant_papers,
-        SUM(CASE WHEN is_relevant = 0 THEN 1 ELSE 0 END) AS irrelevant_papers,
-        SUM(CASE WHEN predicted_relevant = 1 AND is_relevant = 1 THEN 1 ELSE 0 END) AS true_positives,
-        SUM(CASE WHEN predicted_relevant = 1 AND is_relevant = 0 THEN 1 ELSE 0 END) AS false_positives,
-        SUM(CASE WHEN predicted_relevant = 0 AND is_relevant = 1 THEN 1 ELSE 0 END) AS false_negatives,
-        SUM(CASE WHEN predicted_relevant = 0 AND is_relevant = 0 THEN 1 ELSE 0 END) AS true_negatives
-    FROM joined
-    GROUP BY job_name
+reference AS (
+    SELECT r.job_id, r.publication_id, AVG(r.rating) AS rating
+    FROM reviews AS r JOIN jobs AS j ON j.id = r.job_id
+    WHERE j.model = :model AND j.batch_size = 1 AND j.id != :job_id AND NOT r.prefiltered
+    GROUP BY r.job_id, r.publication_id
 )
 SELECT
-    job_id,
-    job_name,
-    model_name,
-    predicted_relevant,
-    predicted_irrelevant,
-    relevant_papers,
-    irrelevant_papers,
-    true_positives,
-    false_positives,
-    false_negatives,
-    true_negatives,
-    ROUND(1.0 * true_positives / NULLIF(true_positives + false_negatives, 0), 3) AS sensitivity,
-    ROUND(1.0 * true_negatives / NULLIF(true_negatives + false_positives, 0), 3) AS specificity
-FROM aggregated
-ORDER BY sensitivity DESC;
+    j.id AS job_id,
+    j.name AS job_name,
+    j.time_taken / NULLIF(j.num_completed, 0) AS seconds_per_item,
+    COUNT(*) AS common,
+    ROUND(AVG(ABS(t.rating - f.rating)), 1) AS mean_abs_diff,
+    ROUND(AVG((t.rating > :threshold) = (f.rating > :threshold)), 3) AS agreement,
+    ROUND(1.0 * SUM(t.rating > :threshold AND p.human_score > :threshold) / NULLIF(SUM(p.human_score > :threshold), 0), 3) AS sensitivity,
+    ROUND(1.0 * SUM(f.rating > :threshold AND p.human_score > :threshold) / NULLIF(SUM(p.human_score > :threshold), 0), 3) AS ref_sensitivity,
+    ROUND(1.0 * SUM(t.rating <= :threshold AND p.human_score <= :threshold) / NULLIF(SUM(p.human_score <= :threshold), 0), 3) AS specificity,
+    ROUND(1.0 * SUM(f.rating <= :threshold AND p.human_score <= :threshold) / NULLIF(SUM(p.human_score <= :threshold), 0), 3) AS ref_specificity
+FROM reference AS f
+JOIN target AS t ON t.publication_id = f.publication_id
+JOIN publications AS p ON p.id = f.publication_id AND p.human_score IS NOT NULL
+JOIN jobs AS j ON j.id = f.job_id
+GROUP BY f.job_id
+ORDER BY common DESC;
 """
 
 ITEMS_PER_PAGE = 1000
 
+# every publication with the reviews of one job, reviews_slot is the fast way to find them
+PUBLICATION_REVIEWS = 'publications AS p LEFT JOIN reviews AS r INDEXED BY reviews_slot ON r.job_id = :job_id AND r.publication_id = p.id'
+
+# sort orders of the publication index, NULLs come first in ascending order like in SQL
+INDEX_SEGMENTS = {
+    'id': [
+        Segment(f'{PUBLICATION_REVIEWS} WHERE true', ('p.id', 'IFNULL(r.attempt, -1)')),
+    ],
+    'human': [
+        Segment(f'{PUBLICATION_REVIEWS} WHERE p.human_score IS NULL', ('p.id', 'IFNULL(r.attempt, -1)')),
+        Segment(f'{PUBLICATION_REVIEWS} WHERE p.human_score IS NOT NULL', ('p.human_score', 'p.id', 'IFNULL(r.attempt, -1)')),
+    ],
+    'ai': [
+        # unreviewed publications, the join finds no review so r.rating is NULL
+        Segment(f'{PUBLICATION_REVIEWS} WHERE r.id IS NULL', ('p.id',)),
+        Segment('reviews AS r JOIN publications AS p ON p.id = r.publication_id WHERE r.job_id = :job_id', ('r.rating', 'r.publication_id', 'r.attempt')),
+    ],
+}
+
+JOB_REVIEWS_SEGMENTS = [
+    Segment('reviews AS r JOIN publications AS p ON p.id = r.publication_id WHERE r.job_id = :job_id', ('r.rating', 'r.publication_id', 'r.attempt')),
+]
+
 def get_available_models():
     return (
         'llama3.1:8b', 
@@ -95,6 +137,9 @@ def inject_globals():
     return {
         'current_year': datetime.now().year,
         'available_models': get_available_models(),
+        'priorities': tuple(PRIORITIES),
+        'max_batch_size': MAX_BATCH_SIZE,
+        'recall_floors': RECALL_FLOORS,
         'job_in_progress': job_in_progress(),
         'nav': [
             {
@@ -115,14 +160,16 @@ def inject_globals():
         ],
     }
 
-def job_in_progress():
-    conn = get_connection()
-    if res := conn.execute("SELECT * FROM jobs WHERE status = 'RUNNING'").fetchone():
-        count, complete = conn.execute('SELECT (SELECT COUNT(*) FROM publications) as ttl, (SELECT COUNT(*) FROM reviews WHERE job_id = ?) as complete', (res['id'],)).fetchone()
-        return {
-            **res,
-            'eta': (res['time_taken'] / complete) * (res['repeats'] * count - complete) if complete else None
-        }
+@app.before_request
+def start_timer():
+    g.t0 = time.perf_counter()
+
+@app.after_request
+def record_request(response: Response):
+    if request.endpoint is not None:
+        metrics.observe('http_request_seconds', time.perf_counter() - g.t0, endpoint=request.endpoint, status=response.status_code)
+        metrics.maybe_flush()
+    return response
 
 # register duration as a template filter:
 app.template_filter('duration')(duration)
@@ -136,7 +183,6 @@ def dt(t: float | int):
 def index():
     db = get_connection()
 
-    page = request.args.get('p', 0, type=int)
     job_id = request.args.get('job', None)
     if job_id is None:
         job_id = db.execute('SELECT job_id FROM reviews ORDER BY id DESC LIMIT 1').fetchone()
@@ -144,22 +190,12 @@ def index():
             job_id = job_id[0]
 
     col_order = request.args.get('order', 'id')
-    asc_desc = 'ASC'
-    if col_order[0] == '-':
-        asc_desc = 'DESC'
-        col_order = col_order[1:]
-
-    col_order = {'human': 'p.human_score', 'ai': 'r.rating', 'id': 'p.id'}.get(col_order, None)
-
-    # catch invalid order
-    if col_order is None:
-        col_order = 'p.id'
+    descending = col_order.startswith('-')
+    segments = INDEX_SEGMENTS.get(col_order.lstrip('-'), INDEX_SEGMENTS['id'])
 
     return render_template(
         'index.html',
-        publications=db.execute(f'SELECT p.*, r.rating FROM publications as p LEFT OUTER JOIN reviews as r ON p.id = r.publication_id AND r.job_id = ? ORDER BY {col_order} {asc_desc} LIMIT ? OFFSET ?', (job_id, ITEMS_PER_PAGE, ITEMS_PER_PAGE * page)).fetchall(),
-        page=page,
-        has_next=db.execute('SELECT COUNT(*) FROM publications').fetchone()[0] > (ITEMS_PER_PAGE * (page+1)),
+        pager=keyset_page(db, 'p.*, r.rating', segments, {'job_id': job_id}, request.args.to_dict(), ITEMS_PER_PAGE, descending),
     )
 
 
@@ -227,26 +263,27 @@ def stats():
         thresholds.insert(0, u_thresh)
     tables = []
 
-    sensitivity_map=[]
-    specificity_map=[]
-    jobs = []
+    histograms = load_histograms(db)
+    prefilters = {row['job_id']: row for row in db.execute(PREFILTER_STATS_QUERY)}
 
     for threshold in thresholds:
-        rows = db.execute(STATS_QUERY, (threshold, threshold)).fetchall()
+        rows = []
+        for h in histograms:
+            row = h.confusion(threshold)
+            row['auc'] = auc(h.roc(threshold))
+            rows.append(row)
+        rows.sort(key=lambda row: (row['sensitivity'] is None, -(row['sensitivity'] or 0)))
         tables.append({
             'threshold': threshold,
-            'rows': rows
+            'rows': rows,
+            'prefilter': prefilters,
         })
-        sensitivity_map.append(tuple(
-            row['sensitivity'] for row in rows
-        ))
-        specificity_map.append(tuple(
-            row['specificity'] for row in rows
-        ))
-        jobs = tuple(
-            row['job_name'] for row in rows
-        )
-    
+
+    # the heatmaps keep the jobs in the same order for every threshold
+    jobs = tuple(h.job_name for h in histograms)
+    sensitivity_map = [tuple(h.confusion(t)['sensitivity'] for h in histograms) for t in thresholds]
+    specificity_map = [tuple(h.confusion(t)['specificity'] for h in histograms) for t in thresholds]
+
     sens, spec = [render_heatmap(data, jobs, thresholds, title) for data, title in [(sensitivity_map, 'Sensitivity'),(specificity_map, 'Specificity')]]
 
     return render_template('model_comparison.html', 
@@ -257,12 +294,34 @@ def stats():
                            )
 
 
+@app.route('/stats/roc')
+def stats_roc():
+    """
+    ROC curves of all jobs, publications with a human score above `threshold` are relevant.
+    """
+    threshold = request.args.get('threshold', 50, type=int)
+    curves = []
+    for h in load_histograms(get_connection()):
+        points = h.roc(threshold)
+        curves.append({
+            'job_id': h.job_id,
+            'job_name': h.job_name,
+            'model_name': h.model_name,
+            'auc': auc(points),
+            'points': [{'threshold': t, 'fpr': fpr, 'tpr': tpr} for t, fpr, tpr in points],
+        })
+    return {'threshold': threshold, 'jobs': curves}
+
+
 @app.route('/create_job', methods=['POST'])
 def create_job():
     name = request.form.get('name', '').strip()
     model = request.form.get('model', '').strip()
     prompt = request.form.get('prompt', '').strip()
     repeats = request.form.get('repeats', '').strip()
+    priority = request.form.get('priority', DEFAULT_PRIORITY).strip()
+    batch_size = request.form.get('batch_size', '1').strip()
+    prefilter = request.form.get('prefilter', '').strip()
 
     if not all([name, model, prompt, repeats]):
         flash("All fields are required.", "danger")
@@ -280,6 +339,31 @@ def create_job():
         flash("Invalid model selected.", "danger")
         return redirect(url_for('index'))
 
+    if priority not in PRIORITIES:
+        flash("Invalid priority selected.", "danger")
+        return redirect(url_for('index'))
+
+    try:
+        batch_size = int(batch_size)
+        if not 1 <= batch_size <= MAX_BATCH_SIZE:
+            raise ValueError
+    except ValueError:
+        flash(f"Batch size must be between 1 and {MAX_BATCH_SIZE}.", "danger")
+        return redirect(url_for('index'))
+
+    try:
+        prefilter = float(prefilter) if prefilter else None
+        if prefilter is not None and prefilter not in RECALL_FLOORS:
+            raise ValueError
+    except ValueError:
+        flash("Invalid prefilter recall selected.", "danger")
+        return redirect(url_for('index'))
+
+    if prefilter is not None and model in OPENAI_MODELS:
+        # OpenAI jobs are sent as a whole and never go through the leases that apply the prefilter
+        flash("The prefilter is only available for ollama models.", "danger")
+        return redirect(url_for('index'))
+
     conn = get_connection()
     try:
         existing = conn.execute("SELECT 1 FROM jobs WHERE name = ?", (name,)).fetchone()
@@ -290,9 +374,16 @@ def create_job():
         job_id = str(uuid.uuid4())
         now = time.time()
         conn.execute("""
-            INSERT INTO jobs (id, name, model, prompt, repeats, status, time_created, time_started, time_taken, num_completed, eval_run)
-            VALUES (?, ?, ?, ?, ?, 'WAITING', ?, 0, 0.0, '0', true)
-        """, (job_id, name, model, prompt, repeats, now))
+            INSERT INTO jobs (id, name, model, prompt, repeats, status, time_created, time_started, time_taken, num_completed, eval_run, priority, batch_size)
+            VALUES (?, ?, ?, ?, ?, 'WAITING', ?, 0, 0.0, '0', true, ?, ?)
+        """, (job_id, name, model, prompt, repeats, now, priority, batch_size))
+        if prefilter is not None:
+            pf = train_prefilter(conn, prefilter)
+            if pf is None:
+                flash("Not enough human labels to train a prefilter, the job runs without one.", "warning")
+            else:
+                save_prefilter(conn, job_id, pf)
+                flash(f"Prefilter trained: keeps {pf.sensitivity:.1%} of relevant publications and filters out {pf.filtered:.1%} of the labelled set (cross-validated).", "info")
         conn.commit()
         flash("Job created successfully.", "success")
     except Exception as e:
@@ -317,12 +408,16 @@ def job_detail(job_id):
         else:
             # set eval_mode = false if fullrun in request args
             eval_mode = ('fullrun' not in request.args)
-            conn.execute("UPDATE jobs SET status = ?, eval_run = ? WHERE id = ?", (status, eval_mode, job_id))
+            # the queue of open slots is written again when the job starts, eval_run may have changed
+            conn.execute("UPDATE jobs SET status = ?, eval_run = ?, queued = NULL WHERE id = ?", (status, eval_mode, job_id))
+            # a paused job leaves the navbar right away instead of after the next worker flush
+            write_snapshot(conn)
+            if status == 'WAITING':
+                # give dead-lettered items another chance on resume/re-run
+                revive_dead_letters(conn, job_id)
             flash(f'Launched job{' on full set' if not eval_mode else ''}', 'success')
             return redirect(url_for('job_detail', job_id=job_id))
 
-    page = request.args.get('p', 0, type=int)
-
     if bool(job['eval_run']):
         total_items = job['repeats'] * conn.execute('SELECT COUNT(*) FROM publications WHERE human_score is not null').fetchone()[0]
     else:
@@ -335,6 +430,11 @@ def job_detail(job_id):
 
     histogram = conn.execute('SELECT rating, COUNT(rating) AS count FROM reviews WHERE job_id = ? GROUP BY rating ORDER BY rating', (job_id,)).fetchall()
 
+    calibration_threshold = request.args.get('threshold', 50, type=int)
+    calibration = []
+    if job['batch_size'] > 1:
+        calibration = conn.execute(CALIBRATION_QUERY, {'job_id': job_id, 'model': job['model'], 'threshold': calibration_threshold}).fetchall()
+
     return render_template(
         "job_detail.html",
         job=job,
@@ -343,10 +443,13 @@ def job_detail(job_id):
         progress=progress,
         seconds_per_item=seconds_per_item,
         estimated_remaining=estimated_remaining,
-        reviews=conn.execute("SELECT p.id, p.title, p.year, p.human_score, r.rating as score, r.id as review_id FROM publications as p JOIN reviews as r ON r.publication_id = p.id WHERE job_id = ? ORDER BY r.rating DESC LIMIT ? OFFSET ?", (job_id, ITEMS_PER_PAGE, ITEMS_PER_PAGE * page)).fetchall(),
-        page=page,
-        has_next=conn.execute('SELECT COUNT(*) FROM reviews WHERE job_id = ?', (job_id,)).fetchone()[0] > (ITEMS_PER_PAGE * (page+1)),
-        exports=EXPORTER.get_files_for_job(job_id),
+        pager=keyset_page(conn, 'p.id, p.title, p.year, p.human_score, r.rating AS score, r.id AS review_id', JOB_REVIEWS_SEGMENTS, {'job_id': job_id}, request.args.to_dict(), ITEMS_PER_PAGE, descending=True),
+        dead_letters=dead_letters(conn, job_id),
+        failures=failure_summary(conn, job_id),
+        export_jobs=conn.execute("SELECT id, name, model FROM jobs WHERE id != ? AND status = 'FINISHED' ORDER BY time_created DESC", (job_id,)).fetchall(),
+        calibration=calibration,
+        calibration_threshold=calibration_threshold,
+        usage=conn.execute(USAGE_QUERY.format(where='AND job_id = ?'), (job_id,)).fetchone(),
         histogram=[[r['rating'], r['count']] for r in  histogram],
     )
 
@@ -355,28 +458,45 @@ def export_job(job_id: str):
     cmp = request.args.get('cutoff_mode')
     rating = request.args.get('rating', type=int)
     format = request.args.get('format')
+    gzip = request.args.get('gzip', 0, type=int) == 1
+    consensus = request.args.get('consensus', 'each')
+    level = request.args.get('level', 'review')
+    k = request.args.get('k', 1, type=int)
+    # other jobs whose reviews are exported together with this one
+    jobs = [job_id] + request.args.getlist('jobs')
 
     if format not in ('csv', 'ris'):
         raise ValueError(format)
     if cmp not in ('lt', 'le', 'gt', 'ge'):
         raise ValueError(cmp)
-    if rating > 100 or rating < 0:
-        raise ValueError(cmp)  
-
-    EXPORTER.submit(job_id, cmp, rating, format)
-
-    return redirect(url_for('job_detail', job_id=job_id))
+    if rating is None or rating > 100 or rating < 0:
+        raise ValueError(rating)
+    if consensus not in CONSENSUS_MODES or level not in CONSENSUS_LEVELS:
+        raise ValueError(consensus, level)
+    if k is None or k < 1:
+        raise ValueError(k)
+
+    exp = Export(jobs, cmp, rating, format, gzip, consensus, level, k)
+    download_name = f'export_{date.today():%Y-%m-%d}.{exp.extension}'
+    if exp.cached:
+        metrics.inc('exports_total', format=format, consensus=consensus, cache='hit')
+        return send_file(os.path.join(os.getcwd(), exp.file_name), exp.mimetype, as_attachment=True, download_name=download_name)
+
+    metrics.inc('exports_total', format=format, consensus=consensus, cache='miss')
+    return Response(
+        stream_with_context(exp.stream()),
+        mimetype=exp.mimetype,
+        headers={'Content-Disposition': f'attachment; filename={download_name}'},
+    )
 
 
 @app.route('/export/<uuid>')
 def download_export(uuid: str):
-    exp = EXPORTER.get(uuid)
+    # exports made before streaming was added, kept so old links keep working
+    exp = get_connection().execute('SELECT * FROM exports WHERE id = ?', (uuid,)).fetchone()
     if exp is None:
         return "Not found", 404
-    if not exp.done:
-        return "Not Done Yet!"
-    
-    return send_file(os.path.join(os.getcwd(), exp.file_name()), 'application/octet-stream', as_attachment=True, download_name=f'export_{date.today():%Y-%m-%d}.{exp.format}')
+    return send_file(os.path.join(os.getcwd(), f'out/{exp["id"]}.{exp["format"]}'), 'application/octet-stream', as_attachment=True, download_name=f'export_{date.today():%Y-%m-%d}.{exp["format"]}')
 
 
 @app.route('/jobs')
@@ -386,5 +506,82 @@ def jobs():
         'jobs.html',
         item_count=conn.execute('SELECT COUNT(*) FROM publications').fetchone()[0],
         eval_count=conn.execute('SELECT COUNT(*) FROM publications WHERE human_score is not null').fetchone()[0],
-        jobs=conn.execute("SELECT * FROM jobs ORDER BY time_created DESC").fetchall()
+        jobs=conn.execute("SELECT * FROM jobs ORDER BY time_created DESC").fetchall(),
+        usage={row['job_id']: row for row in conn.execute(USAGE_QUERY.format(where=''))},
     )
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    metrics.flush()
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def _worker_request() -> dict:
+    """
+    The JSON body of a worker API request, after checking the worker token. Without a token the
+    API is only served if WORKER_API_OPEN=1 is set, anybody reaching it could write reviews.
+    """
+    token = os.environ.get('WORKER_TOKEN')
+    if token is None:
+        if os.environ.get('WORKER_API_OPEN') != '1':
+            abort(403, description="the worker API needs WORKER_TOKEN (or WORKER_API_OPEN=1)")
+    elif request.headers.get('Authorization') != f'Bearer {token}':
+        abort(403)
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('worker'), str):
+        abort(400, description="expected a JSON object with the worker id")
+    return body
+
+@app.route('/api/lease', methods=['POST'])
+def api_lease():
+    body = _worker_request()
+    try:
+        count = min(int(body.get('count', 10)), 1000)
+    except (TypeError, ValueError):
+        abort(400, description="count must be a number")
+    jobs, items = leases.lease_items(body['worker'], count)
+    return {'jobs': jobs, 'items': items, 'ttl': leases.LEASE_TTL}
+
+@app.route('/api/heartbeat', methods=['POST'])
+def api_heartbeat():
+    body = _worker_request()
+    try:
+        ids = [int(i) for i in body['leases']]
+    except (KeyError, TypeError, ValueError):
+        abort(400, description="leases must be a list of lease ids")
+    return {'lost': leases.heartbeat(body['worker'], ids)}
+
+@app.route('/api/submit', methods=['POST'])
+def api_submit():
+    body = _worker_request()
+    try:
+        item = body['item']
+        work = item['work']
+        args = (body['worker'], int(item['lease_id']), str(item['job_id']), int(work['id']), int(work['attempt']))
+        error = body['error'] if 'error' in body else None
+        if error is not None:
+            error = (str(error['type']), str(error['message']))
+        else:
+            result = body['result']
+    except (KeyError, TypeError, ValueError):
+        abort(400, description="expected an item with lease_id, job_id and work, and a result or an error")
+
+    try:
+        if error is not None:
+            return {'dead': leases.fail_item(*args, *error)}
+        if not is_result(result):
+            abort(400, description="result needs an integer score from 0 to 100 and a non-empty reason")
+        return {'stored': leases.submit_result(*args, result)}
+    except leases.LeaseConflict as e:
+        abort(409, description=str(e))
+
+@app.route('/api/release', methods=['POST'])
+def api_release():
+    body = _worker_request()
+    ids = body.get('leases')
+    try:
+        ids = None if ids is None else [int(i) for i in ids]
+    except (TypeError, ValueError):
+        abort(400, description="leases must be a list of lease ids")
+    return {'jobs': list(leases.release(body['worker'], ids))}
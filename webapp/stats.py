@@ -0,0 +1,111 @@
+"""
+Sensitivity and specificity of jobs against the human labels, computed from the rating
+histograms the database keeps up to date for every job (see `rating_histogram` in db.py).
+
+A histogram cell counts the reviews of a job with a given rating on publications with a given
+human score, which is all that's needed to get the confusion matrix for any threshold. As in
+the tables on the stats page, a publication is relevant if its human score is above the
+threshold, publications without a human score count as irrelevant.
+"""
+from dataclasses import dataclass, field
+import sqlite3
+
+HISTOGRAM_QUERY = """
+SELECT h.job_id, j.name AS job_name, j.model AS model_name, h.rating, h.human_score, h.count
+FROM rating_histogram AS h JOIN jobs AS j ON j.id = h.job_id
+WHERE h.count > 0
+ORDER BY j.name, h.job_id
+"""
+
+
+@dataclass
+class JobHistogram:
+    job_id: str
+    job_name: str
+    model_name: str
+    # (rating, human score or None, number of reviews)
+    cells: list[tuple[float, int | None, int]] = field(default_factory=list)
+
+    def confusion(self, threshold: float, label_threshold: float | None = None) -> dict:
+        """
+        Confusion matrix of ratings above `threshold` against human scores above `label_threshold`,
+        which defaults to the same threshold. Keys match the columns of the stats tables.
+        """
+        if label_threshold is None:
+            label_threshold = threshold
+        tp = fp = fn = tn = 0
+        for rating, human_score, count in self.cells:
+            relevant = human_score is not None and human_score > label_threshold
+            if rating > threshold:
+                if relevant:
+                    tp += count
+                else:
+                    fp += count
+            elif relevant:
+                fn += count
+            else:
+                tn += count
+        return {
+            'job_id': self.job_id,
+            'job_name': self.job_name,
+            'model_name': self.model_name,
+            'predicted_relevant': tp + fp,
+            'predicted_irrelevant': fn + tn,
+            'relevant_papers': tp + fn,
+            'irrelevant_papers': fp + tn,
+            'true_positives': tp,
+            'false_positives': fp,
+            'false_negatives': fn,
+            'true_negatives': tn,
+            'sensitivity': round(tp / (tp + fn), 3) if tp + fn else None,
+            'specificity': round(tn / (tn + fp), 3) if tn + fp else None,
+        }
+
+    def roc(self, label_threshold: float) -> list[tuple[float, float, float]]:
+        """
+        The ROC curve for a fixed human label threshold as (threshold, false positive rate,
+        true positive rate) points, from the strictest threshold to the most lenient one.
+        Empty if the human labels are all on one side.
+        """
+        ratings = {}
+        for rating, human_score, count in self.cells:
+            pos, neg = ratings.get(rating, (0, 0))
+            if human_score is not None and human_score > label_threshold:
+                ratings[rating] = (pos + count, neg)
+            else:
+                ratings[rating] = (pos, neg + count)
+        positives = sum(pos for pos, _ in ratings.values())
+        negatives = sum(neg for _, neg in ratings.values())
+        if not positives or not negatives:
+            return []
+
+        # lowering the threshold below a rating adds all of its reviews to the predicted relevant
+        points = [(max(ratings), 0.0, 0.0)]
+        tp = fp = 0
+        for rating in sorted(ratings, reverse=True):
+            pos, neg = ratings[rating]
+            tp += pos
+            fp += neg
+            points.append((rating, fp / negatives, tp / positives))
+        return points
+
+
+def auc(points: list[tuple[float, float, float]]) -> float | None:
+    """
+    Area under a ROC curve, ties between relevant and irrelevant reviews count half.
+    """
+    if not points:
+        return None
+    return sum((x1 - x0) * (y0 + y1) / 2 for (_, x0, y0), (_, x1, y1) in zip(points, points[1:]))
+
+
+def load_histograms(conn: sqlite3.Connection) -> list[JobHistogram]:
+    """
+    The rating histograms of all jobs with reviews, ordered by job name.
+    """
+    jobs = {}
+    for row in conn.execute(HISTOGRAM_QUERY):
+        if row['job_id'] not in jobs:
+            jobs[row['job_id']] = JobHistogram(row['job_id'], row['job_name'], row['model_name'])
+        jobs[row['job_id']].cells.append((row['rating'], row['human_score'], row['count']))
+    return list(jobs.values())